@@ -1,72 +1,20 @@
 """Parsing code for DICOMS and contour files"""
 
-import dicom
-from dicom.errors import InvalidDicomError
+from solution.parsing import (parse_dicom_array, parse_contour_file,
+                              poly_to_mask)
 
-import numpy as np
-from PIL import Image, ImageDraw
 
-
-def parse_contour_file(filename):
-    """Parse the given contour filename
-
-    :param filename: filepath to the contourfile to parse
-    :return: list of tuples holding x, y coordinates of the contour
-    """
-
-    coords_lst = []
-
-    with open(filename, 'r') as infile:
-        for line in infile:
-            coords = line.strip().split()
-
-            x_coord = float(coords[0])
-            y_coord = float(coords[1])
-            coords_lst.append((x_coord, y_coord))
-
-    return coords_lst
-
-
-def parse_dicom_file(filename):
+def parse_dicom_file(filename, dtype=None, rescale=True, pixels_only=False):
     """Parse the given DICOM filename
 
     :param filename: filepath to the DICOM file to parse
+    :param dtype: output dtype, defaults to the stored dtype or float64
+     when rescaled
+    :param rescale: apply rescale slope and intercept, False decodes only
+    :param pixels_only: only parse tags needed to decode pixels
     :return: dictionary with DICOM image data
     """
-
-    try:
-        dcm = dicom.read_file(filename)
-        dcm_image = dcm.pixel_array
-
-        try:
-            intercept = dcm.RescaleIntercept
-        except AttributeError:
-            intercept = 0.0
-        try:
-            slope = dcm.RescaleSlope
-        except AttributeError:
-            slope = 0.0
-
-        if intercept != 0.0 and slope != 0.0:
-            dcm_image = dcm_image*slope + intercept
-        dcm_dict = {'pixel_data' : dcm_image}
-        return dcm_dict
-    except InvalidDicomError:
+    dcm_image = parse_dicom_array(filename, dtype, rescale, pixels_only)
+    if dcm_image is None:
         return None
-
-
-def poly_to_mask(polygon, width, height):
-    """Convert polygon to mask
-
-    :param polygon: list of pairs of x, y coords [(x1, y1), (x2, y2), ...]
-     in units of pixels
-    :param width: scalar image width
-    :param height: scalar image height
-    :return: Boolean mask of shape (height, width)
-    """
-
-    # http://stackoverflow.com/a/3732128/1410871
-    img = Image.new(mode='L', size=(width, height), color=0)
-    ImageDraw.Draw(img).polygon(xy=polygon, outline=0, fill=1)
-    mask = np.array(img).astype(bool)
-    return mask
+    return {'pixel_data': dcm_image}
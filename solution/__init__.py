@@ -0,0 +1,19 @@
+import importlib
+
+# submodules are imported on first attribute access, so `import solution`
+# stays cheap and heavy dependencies like torch load only with the module
+# needing them, e.g. solution.dataset
+SUBMODULES = ('archive', 'benchmarks', 'cache', 'catalog', 'contours', 'dataset',
+              'dicom_index', 'dicom_utils', 'export', 'heuristics', 'lazy', 'loader',
+              'masks', 'memo', 'metrics', 'parsing', 'plots', 'prefetch', 'profiling',
+              'roi', 'search', 'stats')
+
+
+def __getattr__(name):
+    if name in SUBMODULES:
+        return importlib.import_module(f'.{name}', __name__)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def __dir__():
+    return sorted(set(globals()) | set(SUBMODULES))
@@ -0,0 +1,422 @@
+import json
+import os
+import struct
+import zlib
+import numpy as np
+from .dicom_utils import Patient
+from .lazy import ArrayLRU
+from .profiling import profiled
+from .roi import mask_bbox, polygon_bbox
+from .parsing import (parse_contour_array, parse_dicom_meta, poly_to_mask,
+                      read_dicom_pixels, rescale_pixels)
+
+MAGIC = b'HEARTARC'
+ARRAY_NAMES = ('dicom', 'i_contour', 'o_contour')
+META_KEYS = ('slice_location', 'image_position', 'pixel_spacing')
+# footer is the index offset followed by MAGIC
+FOOTER = struct.Struct('<Q8s')
+
+
+def _pack_chunk(chunk, name, level):
+    """
+    Compressed bytes of a (n, H, W) chunk. Masks are bit-packed, images
+    are byte shuffled, all high bytes before all low bytes, which
+    compresses smooth images much better
+    """
+    if name != 'dicom':
+        chunk = np.packbits(chunk.reshape(len(chunk), -1), axis=1)
+    else:
+        chunk = np.ascontiguousarray(chunk).view(np.uint8).reshape(-1, chunk.itemsize).T
+    return zlib.compress(np.ascontiguousarray(chunk).tobytes(), level)
+
+
+def _unpack_chunk(data, name, n, shape, dtype):
+    """(n, H, W) array of a chunk written by _pack_chunk"""
+    h, w = shape
+    raw = np.frombuffer(zlib.decompress(data), dtype=np.uint8)
+    if name == 'dicom':
+        # unshuffle one byte plane at a time, much faster than a transpose
+        chunk = np.empty((n, h, w), dtype=dtype)
+        planes = raw.reshape(dtype.itemsize, -1)
+        chunk_bytes = chunk.reshape(-1).view(np.uint8).reshape(-1, dtype.itemsize)
+        for b in range(dtype.itemsize):
+            chunk_bytes[:, b] = planes[b]
+        return chunk
+    return np.unpackbits(raw.reshape(n, -1), axis=1, count=h * w).reshape(n, h, w)
+
+
+def stored_volume(patient, sidecar_dir=None):
+    """
+    Volumes of a patient as they are archived, built in one pass over its
+    files: every dicom is read once, before rescale, and contours are
+    rasterized at the shape from its header. Slices are ordered by slice
+    number, slices without a valid dicom are zeros with None rescale and
+    tags, like Patient.to_volume.
+
+    Inputs:
+        patient (Patient): patient object
+        sidecar_dir (str): if given, contours are loaded from binary sidecars
+    Return:
+        volume_dict (dict): 'slice_nos', 'dicom_volume' (S, H, W) stored
+            pixels, 'i_contour_volume', 'o_contour_volume' and the
+            '*_valid' vectors as in Patient.to_volume, plus 'image_dtype'
+            of the pixels after rescale, 'rescale' (slope, intercept) or
+            None and 'meta' dict of META_KEYS or None per slice,
+            'file_order', slice numbers in all_files_dict order, and
+            '*_contour_bbox' polygon bbox or None per slice, see
+            roi.polygon_bbox
+    """
+    tasks = patient.slice_tasks(False, sidecar_dir)
+    file_order = list(patient.all_files_dict)
+    order = np.argsort(file_order, kind='stable')
+
+    metas, images = [], []
+    for i in order:
+        dicom_fn = tasks[i][0]
+        meta = parse_dicom_meta(dicom_fn) if dicom_fn is not None else None
+        metas.append(meta)
+        images.append(read_dicom_pixels(meta, rescale=False) if meta is not None else None)
+
+    valid_images = [img for img in images if img is not None]
+    shapes = set(img.shape for img in valid_images)
+    if len(shapes) > 1:
+        raise ValueError(f'slices of patient {patient.dicom_id} have different shapes {shapes}')
+    h, w = shapes.pop() if shapes else (0, 0)
+    dtype = np.result_type(*valid_images) if valid_images else np.dtype(np.int16)
+    rescales = [meta['rescale'] if meta is not None else None for meta in metas]
+    # rescaled slices are float64, see rescale_pixels
+    image_dtype = np.result_type(dtype, *[np.float64 for params in rescales if params])
+
+    n = len(order)
+    volume_dict = {'slice_nos': np.array([file_order[i] for i in order], dtype=np.int64),
+                   'dicom_volume': np.zeros((n, h, w), dtype=dtype),
+                   'dicom_valid': np.array([img is not None for img in images], dtype=bool),
+                   'image_dtype': image_dtype,
+                   'rescale': rescales,
+                   'meta': [{key: meta[key] for key in META_KEYS} if meta is not None else None
+                            for meta in metas],
+                   'file_order': file_order}
+    for j, img in enumerate(images):
+        if img is not None:
+            volume_dict['dicom_volume'][j] = img
+
+    for position, name in ((1, 'i_contour'), (2, 'o_contour')):
+        volume = np.zeros((n, h, w), dtype=np.uint8)
+        valid = np.zeros(n, dtype=bool)
+        bboxes = [None] * n
+        for j, i in enumerate(order):
+            contour = tasks[i][position]
+            # masks only for slices with a dicom, as in slice_arrays
+            if contour is None or images[j] is None:
+                continue
+            if not isinstance(contour, np.ndarray):
+                contour = parse_contour_array(contour)
+            poly_to_mask(contour, w, h, out=volume[j])
+            valid[j] = True
+            bboxes[j] = polygon_bbox(contour, (h, w))
+        volume_dict[f'{name}_volume'] = volume
+        volume_dict[f'{name}_valid'] = valid
+        volume_dict[f'{name}_bbox'] = bboxes
+    return volume_dict
+
+
+def write_archive(path, all_patients, chunk_slices=4, level=6, sidecar_dir=None):
+    """
+    Write a cohort into a single archive file. Every patient volume is
+    split into chunks of chunk_slices slices, each compressed on its own
+    so a slice is served by reading and inflating one chunk. Images are
+    stored before rescale, which is applied on read, and masks are
+    bit-packed. Patients are written one at a time, so memory stays at
+    one patient volume. Volumes are stored by slice number, the order of
+    the patient's files is kept as well, see CohortArchive.file_order.
+
+    File layout:
+        MAGIC, compressed chunks back to back, JSON index, footer with
+        the index offset and MAGIC
+
+    Inputs:
+        path (str): archive file path
+        all_patients (list): list of Patient objects
+        chunk_slices (int): number of slices per chunk
+        level (int): zlib compression level, 0-9
+        sidecar_dir (str): if given, contours are loaded from binary sidecars
+    Return:
+        index (dict): archive index, see CohortArchive
+    """
+    dirname = os.path.dirname(str(path))
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+
+    patients = []
+    # write to a temporary file so readers never see a partial archive
+    tmp_path = str(path) + '.tmp'
+    with open(tmp_path, 'wb') as outfile:
+        outfile.write(MAGIC)
+        for patient in all_patients:
+            volume_dict = stored_volume(patient, sidecar_dir)
+            slice_nos = volume_dict['slice_nos'].tolist()
+            stored = volume_dict['dicom_volume']
+            chunks = {name: [] for name in ARRAY_NAMES}
+            for start in range(0, len(slice_nos), chunk_slices):
+                for name in ARRAY_NAMES:
+                    data = _pack_chunk(volume_dict[f'{name}_volume'][start:start + chunk_slices],
+                                       name, level)
+                    chunks[name].append([outfile.tell(), len(data)])
+                    outfile.write(data)
+            patients.append({'dicom_id': str(patient.dicom_id),
+                             'contour_id': str(patient.contour_id),
+                             'slice_nos': slice_nos,
+                             'file_order': volume_dict['file_order'],
+                             'shape': list(stored.shape[1:]),
+                             'image_dtype': volume_dict['image_dtype'].str,
+                             'stored_dtype': stored.dtype.str,
+                             'rescale': volume_dict['rescale'],
+                             'chunk_slices': chunk_slices,
+                             'chunks': chunks,
+                             'valid': {name: volume_dict[f'{name}_valid'].tolist()
+                                       for name in ARRAY_NAMES},
+                             'bbox': {name: volume_dict[f'{name}_bbox']
+                                      for name in ARRAY_NAMES[1:]},
+                             'meta': volume_dict['meta']})
+
+        index = {'patients': patients}
+        index_offset = outfile.tell()
+        outfile.write(json.dumps(index).encode())
+        outfile.write(FOOTER.pack(index_offset, MAGIC))
+    os.replace(tmp_path, str(path))
+    return index
+
+
+class CohortArchive:
+    """
+    Reader of archives written by write_archive. Slices are read with one
+    seek and one read of their chunk, recently inflated chunks are kept in
+    a byte limited LRU so neighbouring slices are served from memory. The
+    file handle is opened on first use, so archives can be sent to worker
+    processes.
+
+    Inputs:
+        path (str): archive file path
+        lru (ArrayLRU): cache of inflated chunks, defaults to a 64MB one
+    """
+    def __init__(self, path, lru=None):
+        self.path = str(path)
+        self.lru = lru if lru is not None else ArrayLRU(64 * 1024 ** 2)
+        self._file = None
+        with open(self.path, 'rb') as infile:
+            if infile.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f'{self.path} is not a cohort archive')
+            infile.seek(-FOOTER.size, os.SEEK_END)
+            index_end = infile.tell()
+            index_offset, magic = FOOTER.unpack(infile.read(FOOTER.size))
+            if magic != MAGIC:
+                raise ValueError(f'{self.path} is truncated')
+            infile.seek(index_offset)
+            index = json.loads(infile.read(index_end - index_offset))
+        self.entries = {entry['dicom_id']: entry for entry in index['patients']}
+        self.slice_positions = {dicom_id: {slice_no: i for i, slice_no in enumerate(entry['slice_nos'])}
+                                for dicom_id, entry in self.entries.items()}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_file'] = None
+        return state
+
+    def _read(self, offset, nbytes):
+        if self._file is None:
+            self._file = open(self.path, 'rb')
+        self._file.seek(offset)
+        return self._file.read(nbytes)
+
+    @profiled('archive.inflate', count_bytes=True)
+    def _inflate(self, entry, name, k, out=None):
+        """Read and inflate chunk k, rescaling images into image_dtype"""
+        offset, nbytes = entry['chunks'][name][k]
+        start = k * entry['chunk_slices']
+        n = min(entry['chunk_slices'], len(entry['slice_nos']) - start)
+        if name != 'dicom':
+            chunk = _unpack_chunk(self._read(offset, nbytes), name, n, entry['shape'], None)
+            if out is None:
+                return chunk
+            out[...] = chunk
+            return out
+        stored = _unpack_chunk(self._read(offset, nbytes), name, n, entry['shape'],
+                               np.dtype(entry['stored_dtype']))
+        if out is None:
+            out = np.empty(stored.shape, dtype=np.dtype(entry['image_dtype']))
+        for j, params in enumerate(entry['rescale'][start:start + n]):
+            rescale_pixels(stored[j], tuple(params) if params else None, out=out[j])
+        return out
+
+    def chunk(self, dicom_id, name, k):
+        """
+        Inflated chunk k of an array of a patient
+
+        Inputs:
+            dicom_id (str): patient dicom id
+            name (str): 'dicom', 'i_contour' or 'o_contour'
+            k (int): chunk index
+        Return:
+            chunk (np.array): (n, H, W) read only array, masks are uint8
+        """
+        key = (self.path, dicom_id, name, k)
+        chunk = self.lru.get(key)
+        if chunk is None:
+            chunk = self._inflate(self.entries[dicom_id], name, k)
+            chunk.flags.writeable = False
+            self.lru.put(key, chunk, chunk.nbytes)
+        return chunk
+
+    def read_slice(self, dicom_id, slice_no, name='dicom'):
+        """
+        Array of a single slice, a view of its inflated chunk
+
+        Inputs:
+            dicom_id (str): patient dicom id
+            slice_no (int): slice number
+            name (str): 'dicom', 'i_contour' or 'o_contour'
+        Return:
+            array (np.array): (H, W) read only array, None if the slice
+                has no such file
+        """
+        entry = self.entries[dicom_id]
+        i = self.slice_positions[dicom_id][slice_no]
+        if not entry['valid'][name][i]:
+            return None
+        k, j = divmod(i, entry['chunk_slices'])
+        return self.chunk(dicom_id, name, k)[j]
+
+    def contour_bbox(self, dicom_id, slice_no, name):
+        """
+        Bounding box of the contour polygon of a slice, see roi.polygon_bbox,
+        the same box the files give to crops. Archives written before it was
+        stored fall back to the bbox of the mask, None if the slice has no
+        such contour
+        """
+        entry = self.entries[dicom_id]
+        i = self.slice_positions[dicom_id][slice_no]
+        if not entry['valid'][name][i]:
+            return None
+        if 'bbox' not in entry:
+            return mask_bbox(self.read_slice(dicom_id, slice_no, name))
+        bbox = entry['bbox'][name][i]
+        return tuple(bbox) if bbox is not None else None
+
+    def read_volume(self, dicom_id):
+        """
+        Volumes of a patient read sequentially chunk by chunk, same dict as
+        Patient.to_volume
+        """
+        entry = self.entries[dicom_id]
+        n = len(entry['slice_nos'])
+        h, w = entry['shape']
+        volume_dict = {'slice_nos': np.array(entry['slice_nos'], dtype=np.int64)}
+        for name in ARRAY_NAMES:
+            dtype = np.dtype(entry['image_dtype']) if name == 'dicom' else np.uint8
+            volume = np.empty((n, h, w), dtype=dtype)
+            # inflate every chunk straight into place
+            for k in range(len(entry['chunks'][name])):
+                start = k * entry['chunk_slices']
+                end = min(start + entry['chunk_slices'], n)
+                self._inflate(entry, name, k, out=volume[start:end])
+            volume_dict[f'{name}_volume'] = volume
+            volume_dict[f'{name}_valid'] = np.array(entry['valid'][name], dtype=bool)
+        return volume_dict
+
+    def file_order(self, dicom_id):
+        """
+        Slice numbers of a patient in the order of its directory listing
+        when it was archived, the order file backed Patient and
+        HeartDataset2D use. Volumes are stored by slice number.
+        """
+        entry = self.entries[dicom_id]
+        return entry.get('file_order', entry['slice_nos'])
+
+    def slice_nos(self, dicom_id, names=('dicom',)):
+        """Slice numbers of a patient having all given arrays, in file_order"""
+        entry = self.entries[dicom_id]
+        positions = self.slice_positions[dicom_id]
+        return [slice_no for slice_no in self.file_order(dicom_id)
+                if all(entry['valid'][name][positions[slice_no]] for name in names)]
+
+    def slice_meta(self, dicom_id, slice_no):
+        """Spatial DICOM tags of a slice, see META_KEYS"""
+        return self.entries[dicom_id]['meta'][self.slice_positions[dicom_id][slice_no]]
+
+    def patient(self, dicom_id):
+        """Patient object loaded from the archive, see Patient.load_archive"""
+        entry = self.entries[dicom_id]
+        patient = Patient(dicom_id, entry['contour_id'], None, None)
+        patient.load_archive(self)
+        return patient
+
+    def patients(self):
+        """Patient objects of every patient in archive order"""
+        return [self.patient(dicom_id) for dicom_id in self.entries]
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, dicom_id):
+        return dicom_id in self.entries
+
+
+def test_archive():
+    """unit test for write_archive and CohortArchive, same arrays and order as the files"""
+    import tempfile
+    from .benchmarks import write_synthetic_cohort
+
+    with tempfile.TemporaryDirectory() as root:
+        patients = write_synthetic_cohort(root, n_patients=2, n_slices=10, size=32)
+        path = os.path.join(root, 'cohort.archive')
+        # the last chunk of every patient is partial
+        write_archive(path, patients, chunk_slices=4)
+        archive = CohortArchive(path)
+        assert list(archive.entries) == [patient.dicom_id for patient in patients]
+
+        for patient in patients:
+            patient.create_numpy_arrays(False)
+            expected = patient.to_volume(False)
+            volume_dict = archive.read_volume(patient.dicom_id)
+            assert set(volume_dict) == set(expected)
+            for key, value in expected.items():
+                assert value.dtype == volume_dict[key].dtype
+                assert np.array_equal(value, volume_dict[key])
+
+            # slices and patients from the archive keep the file order
+            assert archive.file_order(patient.dicom_id) == list(patient.all_numpy_dict)
+            loaded = archive.patient(patient.dicom_id)
+            assert list(loaded.all_numpy_dict) == list(patient.all_numpy_dict)
+            for slice_no, slice_dict in patient.all_numpy_dict.items():
+                for name in ARRAY_NAMES:
+                    array = slice_dict[f'{name}_array']
+                    for stored in (loaded.all_numpy_dict[slice_no][f'{name}_array'],
+                                   archive.read_slice(patient.dicom_id, slice_no, name)):
+                        if array is None:
+                            assert stored is None
+                        else:
+                            assert np.array_equal(stored, array)
+                # crops center on the polygon bbox, older archives on the mask
+                for name in ARRAY_NAMES[1:]:
+                    contour = patient.all_files_dict[slice_no][f'{name}_fname']
+                    bbox = archive.contour_bbox(patient.dicom_id, slice_no, name)
+                    if contour is None:
+                        assert bbox is None
+                        continue
+                    array = slice_dict[f'{name}_array']
+                    assert bbox == polygon_bbox(parse_contour_array(contour), array.shape)
+                    entry = archive.entries[patient.dicom_id]
+                    stored_bbox = entry.pop('bbox')
+                    assert archive.contour_bbox(patient.dicom_id, slice_no, name) == \
+                        mask_bbox(array)
+                    entry['bbox'] = stored_bbox
+            assert archive.slice_nos(patient.dicom_id, ('i_contour',)) == \
+                [slice_no for slice_no, slice_dict in patient.all_numpy_dict.items()
+                 if slice_dict['i_contour_array'] is not None]
+        archive.close()
+    print("Test passed")
@@ -0,0 +1,550 @@
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+import numpy as np
+from .dicom_utils import Patient, poly_to_mask
+from .heuristics import i_contour_from_o_contour
+from .metrics import dice_score
+from .parsing import parse_dicom_file, parse_contour_file
+
+# heavy dependencies which must only load with the modules needing them
+HEAVY_MODULES = ('torch', 'cv2', 'skimage', 'scipy', 'matplotlib', 'seaborn', 'pandas')
+# module -> (import time budget in seconds, heavy modules it may import),
+# numpy alone takes about 0.1 s
+IMPORT_BUDGETS = {'solution': (0.05, ()),
+                  'solution.parsing': (0.3, ()),
+                  'solution.dicom_utils': (0.3, ()),
+                  'solution.heuristics': (0.3, ()),
+                  'solution.metrics': (0.3, ()),
+                  'solution.plots': (0.3, ()),
+                  'solution.export': (0.3, ()),
+                  'solution.archive': (0.3, ()),
+                  'solution.search': (0.3, ()),
+                  'solution.stats': (0.3, ()),
+                  'solution.benchmarks': (0.3, ()),
+                  'solution.dataset': (3.0, ('torch',)),
+                  'solution.loader': (3.0, ('torch',))}
+
+# MR image storage
+SOP_CLASS_UID = '1.2.840.10008.5.1.4.1.1.4'
+IMPLICIT_VR_LITTLE_ENDIAN = '1.2.840.10008.1.2'
+
+
+def time_it(func, repeat=3):
+    """Best wall clock time of func over repeats in seconds"""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def random_contours(n, size=256, n_points=120, seed=42):
+    """
+    Generate noisy circular contours similar to manual LV contours
+
+    Inputs:
+        n (int): number of contours
+        size (int): image size, contours are centered in a size x size image
+        n_points (int): number of points per contour
+        seed (int): random seed
+    Return:
+        contours (list): list of (n_points, 2) arrays of x, y coords
+    """
+    rng = np.random.RandomState(seed)
+    t = np.linspace(0, 2 * np.pi, n_points, endpoint=False)
+    contours = []
+    for _ in range(n):
+        r = size / 6 * (1 + 0.05 * rng.randn(n_points))
+        cx, cy = size / 2 + rng.randn(2) * size / 20
+        contours.append(np.stack([cx + r * np.cos(t), cy + r * np.sin(t)], 1))
+    return contours
+
+
+def benchmark_poly_to_mask(n_masks=500, size=256, repeat=3, verbose=True):
+    """
+    Per mask time of poly_to_mask with and without an out buffer on
+    size x size slices. Masks of all methods are checked to be identical.
+
+    Inputs:
+        n_masks (int): number of masks to rasterize
+        size (int): slice height and width
+        repeat (int): number of repeats, best time is reported
+        verbose (bool): print results
+    Return:
+        results (dict): microseconds per mask for each method
+    """
+    contours = random_contours(n_masks, size)
+    polygons = [[tuple(p) for p in c] for c in contours]
+    buffer = np.empty((n_masks, size, size), dtype=np.uint8)
+
+    def pil_astype():
+        return [poly_to_mask(p, size, size).astype(np.uint8) for p in polygons]
+
+    def pil_out():
+        for p, out in zip(polygons, buffer):
+            poly_to_mask(p, size, size, out=out)
+        return buffer
+
+    methods = [('pil + astype', pil_astype),
+               ('pil into buffer', pil_out)]
+
+    expected = np.stack(pil_astype())
+    results = {}
+    for name, func in methods:
+        assert np.array_equal(np.stack(func()), expected), name
+        results[name] = time_it(func, repeat) / n_masks * 1e6
+        if verbose:
+            print(f"{name:<16}: {results[name]:8.1f} us/mask")
+    return results
+
+
+def benchmark_loaders(dataset, batch_size=8, workers=(0, 2, 4, 8), epochs=2, verbose=True):
+    """
+    Throughput of the default DataLoader path, per item FloatTensors and
+    default collate, against SharedMemoryLoader. Workers of both loaders
+    are persistent, the first epoch is a warm up and isn't timed.
+
+    Inputs:
+        dataset (HeartDataset2D): dataset to load
+        batch_size (int): samples per batch
+        workers (list): numbers of workers to try
+        epochs (int): number of epochs, including the warm up epoch
+        verbose (bool): print results
+    Return:
+        results (dict): (loader name, num_workers) -> samples per second
+    """
+    from torch.utils.data import DataLoader
+    from .loader import SharedMemoryLoader
+
+    def run(loader):
+        best = float('inf')
+        for epoch in range(epochs):
+            start = time.perf_counter()
+            n_samples = sum(len(images) for images, _ in loader)
+            if epoch > 0 or epochs == 1:
+                best = min(best, time.perf_counter() - start)
+        return n_samples / best
+
+    results = {}
+    for num_workers in workers:
+        loader = DataLoader(dataset, batch_size=batch_size, num_workers=num_workers,
+                            persistent_workers=num_workers > 0)
+        results['dataloader', num_workers] = run(loader)
+        del loader
+
+        with SharedMemoryLoader(dataset, batch_size, num_workers) as loader:
+            results['shared memory', num_workers] = run(loader)
+
+        if verbose:
+            for name in ('dataloader', 'shared memory'):
+                print(f"{name:<14} workers={num_workers}: "
+                      f"{results[name, num_workers]:8.1f} samples/s")
+    return results
+
+
+def write_synthetic_dicom(fname, image, uid):
+    """
+    Write a (H, W) int16 image as an uncompressed MR DICOM file
+
+    Inputs:
+        fname (str): output file path
+        image (np.array): (H, W) int16 pixels
+        uid (str): SOP instance uid
+    """
+    from dicom.dataset import Dataset, FileDataset
+
+    file_meta = Dataset()
+    file_meta.MediaStorageSOPClassUID = SOP_CLASS_UID
+    file_meta.MediaStorageSOPInstanceUID = uid
+    file_meta.TransferSyntaxUID = IMPLICIT_VR_LITTLE_ENDIAN
+    ds = FileDataset(fname, {}, file_meta=file_meta, preamble=b'\0' * 128)
+    ds.is_little_endian = True
+    ds.is_implicit_VR = True
+    ds.SOPClassUID = SOP_CLASS_UID
+    ds.SOPInstanceUID = uid
+    ds.Rows, ds.Columns = image.shape
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = 'MONOCHROME2'
+    ds.BitsAllocated = 16
+    ds.BitsStored = 16
+    ds.HighBit = 15
+    ds.PixelRepresentation = 1
+    ds.PixelData = image.astype(np.int16).tobytes()
+    ds.save_as(fname)
+
+
+def write_synthetic_cohort(root, n_patients=2, n_slices=20, size=256, seed=42):
+    """
+    Write a synthetic cohort laid out like the original data: dicoms/,
+    contourfiles/ with i-contours and o-contours and link.csv. Every slice
+    is a noisy bright blood pool inside a darker myocardium ring. Every
+    slice has an o-contour, every other one an i-contour.
+
+    Inputs:
+        root (str): output directory
+        n_patients (int): number of patients
+        n_slices (int): slices per patient
+        size (int): slice height and width
+        seed (int): random seed
+    Return:
+        all_patients (list): Patient objects of the cohort
+    """
+    rng = np.random.RandomState(seed)
+    dicoms_path = os.path.join(str(root), 'dicoms')
+    contourfiles_path = os.path.join(str(root), 'contourfiles')
+    yy, xx = np.mgrid[:size, :size]
+    n_points = 120
+    t = np.linspace(0, 2 * np.pi, n_points, endpoint=False)
+
+    links = ['patient_id,original_id']
+    for p in range(n_patients):
+        dicom_id, contour_id = f'SCD{p + 1:05d}01', f'SC-HF-I-{p + 1}'
+        links.append(f'{dicom_id},{contour_id}')
+        dicom_dir = os.path.join(dicoms_path, dicom_id)
+        os.makedirs(dicom_dir, exist_ok=True)
+        for kind in ('i', 'o'):
+            os.makedirs(os.path.join(contourfiles_path, contour_id, f'{kind}-contours'),
+                        exist_ok=True)
+
+        for slice_no in range(1, n_slices + 1):
+            cx, cy = size / 2 + rng.randn(2) * size / 40
+            radius = np.hypot(xx - cx, yy - cy)
+            r_in, r_out = size / 8, size / 6
+            image = (200 + 300 * (radius < r_in) + 100 * ((radius >= r_in) & (radius < r_out)) +
+                     20 * rng.randn(size, size))
+            write_synthetic_dicom(os.path.join(dicom_dir, f'{slice_no}.dcm'), image,
+                                  f'1.2.826.0.1.3680043.2.{p + 1}.{slice_no}')
+
+            for kind, r in (('i', r_in), ('o', r_out)):
+                if kind == 'i' and slice_no % 2:
+                    continue
+                rr = r * (1 + 0.02 * rng.randn(n_points))
+                coords = np.stack([cx + rr * np.cos(t), cy + rr * np.sin(t)], 1)
+                fname = os.path.join(contourfiles_path, contour_id, f'{kind}-contours',
+                                     f'IM-0001-{slice_no:04d}-{kind}contour-manual.txt')
+                np.savetxt(fname, coords, fmt='%.2f')
+
+    with open(os.path.join(str(root), 'link.csv'), 'w') as outfile:
+        outfile.write('\n'.join(links) + '\n')
+    return [Patient(f'SCD{p + 1:05d}01', f'SC-HF-I-{p + 1}',
+                    Path(dicoms_path), Path(contourfiles_path)) for p in range(n_patients)]
+
+
+def peak_alloc_mb(func):
+    """
+    Peak memory allocated by Python and NumPy during a call of func in MB,
+    counted from the start of the call so it is the stage's own peak.
+    Allocations of worker processes are not included.
+    """
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1] / 1024 ** 2
+    finally:
+        tracemalloc.stop()
+
+
+def _pipeline_benchmarks(all_patients, batch_size, num_workers):
+    """(name, func, n_items) of every pipeline stage on a cohort"""
+    from torch.utils.data import DataLoader
+    from .dataset import HeartDataset2D
+
+    for patient in all_patients:
+        patient.create_file_dicts(verbose=False)
+    files = [slice_dict for patient in all_patients
+             for slice_dict in patient.all_files_dict.values()]
+    dicom_fnames = [f['dicom_fname'] for f in files]
+    contour_fnames = [f[key] for f in files for key in ('i_contour_fname', 'o_contour_fname')
+                      if f[key] is not None]
+    h, w = parse_dicom_file(dicom_fnames[0]).shape
+    polygons = [parse_contour_file(fname) for fname in contour_fnames]
+
+    def create_numpy_arrays():
+        for patient in all_patients:
+            fresh = Patient(patient.dicom_id, patient.contour_id,
+                            patient.dicoms_path, patient.contourfiles_path)
+            fresh.create_numpy_arrays(verbose=False)
+
+    all_patients[0].create_numpy_arrays(verbose=False)
+    pairs = [(s['dicom_array'], s['o_contour_array'], s['i_contour_array'])
+             for patient in all_patients[:1] for s in patient.all_numpy_dict.values()
+             if s['o_contour_array'] is not None]
+    proposals = [i_contour_from_o_contour(img, o_mask) for img, o_mask, _ in pairs]
+    scored = [(proposal, i_mask) for proposal, (_, _, i_mask) in zip(proposals, pairs)
+              if i_mask is not None]
+
+    dataset = HeartDataset2D(all_patients, 'i_contour')
+
+    def dataloader():
+        loader = DataLoader(dataset, batch_size=batch_size, num_workers=num_workers)
+        return sum(len(images) for images, _ in loader)
+
+    return [('parse_dicom_file', lambda: [parse_dicom_file(f) for f in dicom_fnames],
+             len(dicom_fnames)),
+            ('parse_contour_file', lambda: [parse_contour_file(f) for f in contour_fnames],
+             len(contour_fnames)),
+            ('poly_to_mask', lambda: [poly_to_mask(p, w, h) for p in polygons], len(polygons)),
+            ('create_numpy_arrays', create_numpy_arrays, len(files)),
+            ('dataloader', dataloader, len(dataset)),
+            ('i_contour_from_o_contour',
+             lambda: [i_contour_from_o_contour(img, o_mask) for img, o_mask, _ in pairs],
+             len(pairs)),
+            ('dice_score', lambda: [dice_score(p, t) for p, t in scored], len(scored))]
+
+
+def cohort_config(all_patients):
+    """
+    Description of a loaded cohort, so runs on different data are told
+    apart whatever arguments wrote it
+
+    Inputs:
+        all_patients (list): list of Patient objects
+    Return:
+        config (dict): 'n_patients', 'n_slices', 'n_i_contours' and
+            'n_o_contours' per patient and sorted distinct slice 'shapes'
+    """
+    from .parsing import parse_dicom_shape
+
+    config = {'n_patients': len(all_patients), 'n_slices': [], 'n_i_contours': [],
+              'n_o_contours': []}
+    shapes = set()
+    for patient in all_patients:
+        if not hasattr(patient, 'all_files_dict'):
+            patient.create_file_dicts(verbose=False)
+        files = list(patient.all_files_dict.values())
+        config['n_slices'].append(len(files))
+        for key in ('i_contour', 'o_contour'):
+            config[f'n_{key}s'].append(sum(f[f'{key}_fname'] is not None for f in files))
+        shapes.update(parse_dicom_shape(f['dicom_fname']) for f in files
+                      if f['dicom_fname'] is not None)
+    config['shapes'] = sorted([list(shape) for shape in shapes if shape is not None])
+    return config
+
+
+def run_benchmarks(root=None, n_patients=2, n_slices=20, size=256, repeat=3,
+                   batch_size=8, num_workers=0, json_path=None, verbose=True):
+    """
+    Time every stage of the DICOM to tensor pipeline and the heuristics on
+    a synthetic cohort, see write_synthetic_cohort. Best time over repeats
+    gives the throughput, peak allocations of each stage come from one
+    extra traced run, see peak_alloc_mb.
+
+    Inputs:
+        root (str): cohort directory, written if it has no link.csv.
+            Defaults to a temporary directory removed afterwards
+        n_patients (int): number of patients of a written cohort
+        n_slices (int): slices per patient of a written cohort
+        size (int): slice height and width of a written cohort
+        repeat (int): number of timed runs per stage
+        batch_size (int): DataLoader batch size
+        num_workers (int): DataLoader workers
+        json_path (str): if given, results are written there
+        verbose (bool): print results
+    Return:
+        results (dict): 'config' of the loaded cohort, see cohort_config,
+            and of the run, 'environment' and per stage 'benchmarks' with
+            seconds, items, items_per_s and peak_alloc_mb
+    """
+    tmp_root = None
+    if root is None:
+        root = tmp_root = tempfile.mkdtemp(prefix='heart_bench_')
+    try:
+        if os.path.exists(os.path.join(str(root), 'link.csv')):
+            with open(os.path.join(str(root), 'link.csv'), 'r') as infile:
+                ids = [line.strip().split(',') for line in infile.readlines()[1:] if line.strip()]
+            all_patients = [Patient(dicom_id, contour_id, Path(root, 'dicoms'),
+                                    Path(root, 'contourfiles')) for dicom_id, contour_id in ids]
+        else:
+            all_patients = write_synthetic_cohort(root, n_patients, n_slices, size)
+        config = cohort_config(all_patients)
+
+        benchmarks = {}
+        for name, func, n_items in _pipeline_benchmarks(all_patients, batch_size, num_workers):
+            seconds = time_it(func, repeat)
+            benchmarks[name] = {'seconds': seconds, 'items': n_items,
+                                'items_per_s': n_items / seconds if seconds else float('inf'),
+                                'peak_alloc_mb': peak_alloc_mb(func)}
+            if verbose:
+                print(f"{name:<26}: {benchmarks[name]['items_per_s']:10.1f} items/s "
+                      f"{benchmarks[name]['peak_alloc_mb']:8.1f} MB peak alloc")
+    finally:
+        if tmp_root is not None:
+            shutil.rmtree(tmp_root, ignore_errors=True)
+
+    config.update({'repeat': repeat, 'batch_size': batch_size, 'num_workers': num_workers})
+    results = {'config': config,
+               'environment': {'python': platform.python_version(), 'numpy': np.__version__,
+                               'machine': platform.machine(), 'cpus': os.cpu_count()},
+               'benchmarks': benchmarks}
+    if json_path is not None:
+        with open(json_path, 'w') as outfile:
+            json.dump(results, outfile, indent=1)
+    return results
+
+
+def compare_benchmarks(baseline, current, tolerance=0.1, alloc_floor_mb=0.0, verbose=True):
+    """
+    Flag stages whose throughput dropped or peak allocations grew by more
+    than tolerance between two runs of run_benchmarks. A stage which
+    allocated nothing in the baseline is flagged once it allocates more
+    than alloc_floor_mb.
+
+    Inputs:
+        baseline (dict, str): results or path of their JSON
+        current (dict, str): results or path of their JSON
+        tolerance (float): allowed relative change, e.g. 0.1 for 10%
+        alloc_floor_mb (float): allocation growth in MB never flagged,
+            e.g. to ignore noise of stages allocating almost nothing
+        verbose (bool): print a table
+    Return:
+        rows (list): one dict per stage in both runs with speedup,
+            memory ratio and regression flag
+    """
+    runs = []
+    for run in (baseline, current):
+        if not isinstance(run, dict):
+            with open(run, 'r') as infile:
+                run = json.load(infile)
+        runs.append(run)
+    if verbose and runs[0]['config'] != runs[1]['config']:
+        print(f"configs differ: {runs[0]['config']} vs {runs[1]['config']}")
+    baseline, current = runs[0]['benchmarks'], runs[1]['benchmarks']
+    if verbose:
+        print(f"{'stage':<26}{'baseline/s':>12}{'current/s':>12}{'speedup':>9}{'memory':>9}")
+
+    rows = []
+    for name in baseline:
+        if name not in current:
+            continue
+        old, new = baseline[name], current[name]
+        speedup = new['items_per_s'] / old['items_per_s']
+        old_mb, new_mb = old['peak_alloc_mb'], new['peak_alloc_mb']
+        if old_mb:
+            memory = new_mb / old_mb
+        else:
+            memory = float('inf') if new_mb else 1.0
+        memory_regression = memory > 1 + tolerance and new_mb - old_mb > alloc_floor_mb
+        regression = speedup < 1 - tolerance or memory_regression
+        rows.append({'stage': name, 'baseline_items_per_s': old['items_per_s'],
+                     'current_items_per_s': new['items_per_s'], 'speedup': speedup,
+                     'memory_ratio': memory, 'regression': regression})
+        if verbose:
+            print(f"{name:<26}{old['items_per_s']:>12.1f}{new['items_per_s']:>12.1f}"
+                  f"{speedup:>8.2f}x{memory:>8.2f}x{'  REGRESSION' if regression else ''}")
+    return rows
+
+
+def _import_time(module, heavy_modules):
+    """Seconds to import module in a fresh interpreter and heavy modules it loaded"""
+    script = ('import sys, time\n'
+              'start = time.perf_counter()\n'
+              f'import {module}\n'
+              'seconds = time.perf_counter() - start\n'
+              f'print(seconds, *[m for m in {tuple(heavy_modules)!r} if m in sys.modules])\n')
+    # the package is importable from the interpreter however it was found here
+    package_parent = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([package_parent] + sys.path[1:])
+    output = subprocess.run([sys.executable, '-c', script], env=env, check=True,
+                            capture_output=True, text=True).stdout.split()
+    return float(output[0]), output[1:]
+
+
+def benchmark_imports(budgets=None, repeat=3, verbose=True):
+    """
+    Import time of the package and its submodules, each in a fresh
+    interpreter, against a time budget. Imports over budget or loading a
+    heavy dependency the module doesn't need fail the check.
+
+    Inputs:
+        budgets (dict): module -> (seconds, allowed heavy modules),
+            defaults to IMPORT_BUDGETS
+        repeat (int): number of fresh imports, best time is reported
+        verbose (bool): print results
+    Return:
+        results (dict): module -> seconds, budget, heavy modules loaded and
+            'ok' flag
+    """
+    budgets = IMPORT_BUDGETS if budgets is None else budgets
+    results = {}
+    for module, (budget, allowed) in budgets.items():
+        timings = [_import_time(module, HEAVY_MODULES) for _ in range(repeat)]
+        seconds = min(seconds for seconds, _ in timings)
+        heavy = timings[0][1]
+        unexpected = [name for name in heavy if name not in allowed]
+        results[module] = {'seconds': seconds, 'budget': budget, 'heavy_modules': heavy,
+                           'ok': seconds <= budget and not unexpected}
+        if verbose:
+            print(f"{module:<24}: {seconds:6.3f} s / {budget:5.2f} s "
+                  f"{' '.join(heavy):<10}{'' if results[module]['ok'] else '  FAIL'}")
+    return results
+
+
+def test_write_synthetic_cohort():
+    """unit test for write_synthetic_cohort, files parse like the original data"""
+    with tempfile.TemporaryDirectory() as root:
+        patients = write_synthetic_cohort(root, n_patients=2, n_slices=4, size=32)
+        with open(os.path.join(root, 'link.csv')) as infile:
+            assert infile.read().split() == ['patient_id,original_id', 'SCD0000101,SC-HF-I-1',
+                                             'SCD0000201,SC-HF-I-2']
+        for patient in patients:
+            patient.create_numpy_arrays(False)
+            assert sorted(patient.all_numpy_dict) == [1, 2, 3, 4]
+            for slice_no, slice_dict in patient.all_numpy_dict.items():
+                assert slice_dict['dicom_array'].shape == (32, 32)
+                assert slice_dict['o_contour_array'].any()
+                assert (slice_dict['i_contour_array'] is None) == bool(slice_no % 2)
+                if slice_dict['i_contour_array'] is not None:
+                    # the blood pool lies inside the myocardium
+                    assert not (slice_dict['i_contour_array'] &
+                                ~slice_dict['o_contour_array'].astype(bool)).any()
+
+        # configs describe the cohort on disk, not the arguments which wrote it
+        config = cohort_config(patients)
+        assert config == {'n_patients': 2, 'n_slices': [4, 4], 'n_i_contours': [2, 2],
+                          'n_o_contours': [4, 4], 'shapes': [[32, 32]]}
+        assert cohort_config([Patient(p.dicom_id, p.contour_id, p.dicoms_path,
+                                      p.contourfiles_path) for p in patients[:1]]) != config
+    print("Test passed")
+
+
+def test_compare_benchmarks():
+    """unit test for compare_benchmarks, slower or larger stages are flagged"""
+    def run(items_per_s, peak_alloc_mb):
+        return {'config': {}, 'benchmarks': {
+            name: {'items_per_s': speed, 'peak_alloc_mb': mb}
+            for name, speed, mb in zip(('parse', 'dataloader', 'masks'),
+                                       items_per_s, peak_alloc_mb)}}
+
+    baseline = run([100.0, 50.0, 10.0], [10.0, 0.0, 4.0])
+    current = run([95.0, 100.0, 5.0], [10.5, 3.0, 4.0])
+    del current['benchmarks']['masks']
+    rows = compare_benchmarks(baseline, current, verbose=False)
+    assert [row['stage'] for row in rows] == ['parse', 'dataloader']
+    assert np.isclose(rows[0]['speedup'], 0.95) and not rows[0]['regression']
+    # allocations of a stage which allocated nothing before are flagged
+    assert rows[1]['speedup'] == 2.0 and rows[1]['memory_ratio'] == np.inf
+    assert rows[1]['regression']
+    assert not compare_benchmarks(baseline, current, alloc_floor_mb=5.0,
+                                  verbose=False)[1]['regression']
+
+    current['benchmarks']['masks'] = {'items_per_s': 5.0, 'peak_alloc_mb': 4.0}
+    current['benchmarks']['parse']['peak_alloc_mb'] = 12.0
+    with tempfile.TemporaryDirectory() as root:
+        path = os.path.join(root, 'current.json')
+        with open(path, 'w') as outfile:
+            json.dump(current, outfile)
+        rows = compare_benchmarks(baseline, path, verbose=False)
+        assert [row['regression'] for row in rows] == [True, True, True]
+        rows = compare_benchmarks(baseline, path, alloc_floor_mb=5.0, verbose=False)
+        assert [row['regression'] for row in rows] == [False, False, True]
+    print("Test passed")
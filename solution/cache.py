@@ -0,0 +1,288 @@
+import json
+import os
+import shutil
+import numpy as np
+from .dicom_utils import parse_dicom_file, poly_to_mask
+from .contours import parse_contour_array
+from .dicom_index import file_stamp
+from .roi import polygon_bbox
+
+INDEX_FNAME = 'index.json'
+IMAGES_FNAME = 'images.npy'
+MASKS_FNAME = 'masks.npy'
+
+
+def patient_cache_dir(cache_dir, patient, contour_type):
+    """
+    Directory of the slice cache of a patient for a given contour type
+
+    Inputs:
+        cache_dir (str): main directory for all caches
+        patient (Patient): patient object
+        contour_type (str): either 'i_contour' or 'o_contour'
+    Return:
+        dirname (str): cache directory of the patient
+    """
+    return os.path.join(str(cache_dir), contour_type, str(patient.dicom_id))
+
+
+def patient_fname_pairs(patient, contour_type):
+    """
+    Ordered (dicom filename, contour filename) pairs of a patient
+    for slices which has the given contour type
+
+    Inputs:
+        patient (Patient): patient object
+        contour_type (str): either 'i_contour' or 'o_contour'
+    Return:
+        fname_pairs (list): list of (dicom_fname, contour_fname) tuples
+    """
+    if not hasattr(patient, 'all_files_dict'):
+        patient.create_file_dicts(False)
+
+    fname_pairs = []
+    for slice_no in patient.all_files_dict:
+        slice_dict = patient.all_files_dict[slice_no]
+        dicom_fname = slice_dict['dicom_fname']
+        contour_fname = slice_dict[f'{contour_type}_fname']
+        if contour_fname is not None:
+            fname_pairs.append((dicom_fname, contour_fname))
+    return fname_pairs
+
+
+def read_cache_index(dirname):
+    """
+    Read cache index of a patient, returns None if there is no cache
+
+    Inputs:
+        dirname (str): cache directory of the patient
+    Return:
+        index (dict): cache index with keys 'image_dtype' and 'slices'
+    """
+    index_path = os.path.join(dirname, INDEX_FNAME)
+    if not os.path.exists(index_path):
+        return None
+    with open(index_path, 'r') as infile:
+        return json.load(infile)
+
+
+def write_patient_cache(fname_pairs, dirname):
+    """
+    Parse every (dicom, contour) pair once and write images and masks
+    into two flat .npy files with an offset index. Slices are stored back
+    to back so they can be served later as views of a np.memmap.
+
+    The cache is written into a temporary directory which then replaces
+    dirname, so a crash never leaves an index next to partial stores and
+    memmaps of the previous cache held by other processes stay valid.
+
+    Inputs:
+        fname_pairs (list): list of (dicom_fname, contour_fname) tuples
+        dirname (str): cache directory of the patient
+    Return:
+        index (dict): cache index with keys 'image_dtype' and 'slices'
+    """
+    # parse image and contour files, stamps are taken before reading so a
+    # file rewritten meanwhile makes the cache stale
+    images, polygons, slices = [], [], []
+    offset = 0
+    for dicom_fname, contour_fname in fname_pairs:
+        stamps = [file_stamp(dicom_fname), file_stamp(contour_fname)]
+        img = parse_dicom_file(dicom_fname)
+        h, w = img.shape
+        polygon = parse_contour_array(contour_fname)
+        images.append(img)
+        polygons.append(polygon)
+        # crops are centered on the polygon bbox, as for samples read from files
+        bbox = polygon_bbox(polygon, (h, w))
+        slices.append({'dicom_fname': dicom_fname,
+                       'contour_fname': contour_fname,
+                       'stamps': stamps,
+                       'offset': offset,
+                       'shape': [h, w],
+                       'bbox': list(bbox) if bbox is not None else None})
+        offset += h * w
+
+    # images of a patient may be both raw and rescaled
+    image_dtype = np.result_type(*images) if images else np.dtype(np.int16)
+
+    tmp_dir = f'{dirname}.{os.getpid()}.tmp'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    # write contiguous stores, never write an empty memmap
+    total = max(offset, 1)
+    images_mm = np.lib.format.open_memmap(os.path.join(tmp_dir, IMAGES_FNAME),
+                                          mode='w+', dtype=image_dtype,
+                                          shape=(total,))
+    masks_mm = np.lib.format.open_memmap(os.path.join(tmp_dir, MASKS_FNAME),
+                                         mode='w+', dtype=np.uint8,
+                                         shape=(total,))
+    for img, polygon, slice_info in zip(images, polygons, slices):
+        start = slice_info['offset']
+        end = start + img.size
+        h, w = img.shape
+        images_mm[start:end] = img.ravel()
+        # rasterize straight into the store
+        poly_to_mask(polygon, w, h, out=masks_mm[start:end].reshape(h, w))
+    images_mm.flush()
+    masks_mm.flush()
+    del images_mm, masks_mm
+
+    index = {'image_dtype': image_dtype.str, 'slices': slices}
+    with open(os.path.join(tmp_dir, INDEX_FNAME), 'w') as outfile:
+        json.dump(index, outfile)
+
+    # a directory can't replace a non empty one, the old cache is moved
+    # aside first and removed once the new one is in place
+    old_dir = None
+    if os.path.exists(dirname):
+        old_dir = f'{dirname}.{os.getpid()}.old'
+        shutil.rmtree(old_dir, ignore_errors=True)
+        os.replace(dirname, old_dir)
+    else:
+        os.makedirs(os.path.dirname(dirname) or '.', exist_ok=True)
+    os.replace(tmp_dir, dirname)
+    if old_dir is not None:
+        shutil.rmtree(old_dir, ignore_errors=True)
+    return index
+
+
+def cache_is_stale(index, fname_pairs):
+    """
+    Check if a cache was built from other files, or from files rewritten
+    since, by their (mtime, size) stamps. Caches written before slices
+    kept their stamps and bbox are stale too
+
+    Inputs:
+        index (dict): cache index, see read_cache_index
+        fname_pairs (list): list of (dicom_fname, contour_fname) tuples
+    Return:
+        stale (bool): True if cache needs to be rebuilt
+    """
+    cached_pairs = [(o['dicom_fname'], o['contour_fname']) for o in index['slices']]
+    if cached_pairs != fname_pairs or any('bbox' not in o for o in index['slices']):
+        return True
+    try:
+        return any(o.get('stamps') != [file_stamp(o['dicom_fname']),
+                                       file_stamp(o['contour_fname'])]
+                   for o in index['slices'])
+    except FileNotFoundError:
+        return True
+
+
+def build_patient_cache(patient, contour_type, cache_dir, overwrite=False):
+    """
+    Create slice cache of a patient if it doesn't exist or if it is stale,
+    i.e. files listed in the index differ from the patient files or were
+    rewritten since the cache was built
+
+    Inputs:
+        patient (Patient): patient object
+        contour_type (str): either 'i_contour' or 'o_contour'
+        cache_dir (str): main directory for all caches
+        overwrite (bool): rebuild cache even if it is up to date
+    Return:
+        dirname (str): cache directory of the patient
+        index (dict): cache index with keys 'image_dtype' and 'slices'
+    """
+    dirname = patient_cache_dir(cache_dir, patient, contour_type)
+    fname_pairs = patient_fname_pairs(patient, contour_type)
+
+    index = None if overwrite else read_cache_index(dirname)
+    if index is not None and cache_is_stale(index, fname_pairs):
+        index = None
+    if index is None:
+        index = write_patient_cache(fname_pairs, dirname)
+    return dirname, index
+
+
+class SliceCache:
+    """
+    Read only access to patient slice caches through np.memmap. Memory maps
+    are opened lazily in each process so DataLoader workers share the OS
+    page cache instead of holding a copy each.
+
+    Inputs:
+        dirnames (list): cache directories of patients
+    """
+    def __init__(self, dirnames):
+        self.dirnames = list(dirnames)
+        self._memmaps = {}
+
+    def memmaps(self, patient_idx):
+        """Return (images, masks) memmaps for a patient"""
+        if patient_idx not in self._memmaps:
+            dirname = self.dirnames[patient_idx]
+            images = np.load(os.path.join(dirname, IMAGES_FNAME), mmap_mode='r')
+            masks = np.load(os.path.join(dirname, MASKS_FNAME), mmap_mode='r')
+            self._memmaps[patient_idx] = (images, masks)
+        return self._memmaps[patient_idx]
+
+    def get(self, patient_idx, offset, shape):
+        """
+        Zero-copy (image, mask) views of a single slice
+
+        Inputs:
+            patient_idx (int): index of patient in dirnames
+            offset (int): start of slice in flat stores
+            shape (tuple): (h, w) of the slice
+        """
+        images, masks = self.memmaps(patient_idx)
+        h, w = shape
+        img = images[offset:offset + h * w].reshape(h, w)
+        msk = masks[offset:offset + h * w].reshape(h, w)
+        return img, msk
+
+    def __getstate__(self):
+        # don't pickle memory maps to workers, they reopen their own
+        state = self.__dict__.copy()
+        state['_memmaps'] = {}
+        return state
+
+
+def test_slice_cache():
+    """unit test for build_patient_cache and SliceCache, cached slices equal parsed ones"""
+    import tempfile
+    from .benchmarks import write_synthetic_cohort
+
+    with tempfile.TemporaryDirectory() as root:
+        patient = write_synthetic_cohort(root, n_patients=1, n_slices=4, size=32)[0]
+        cache_dir = os.path.join(root, 'cache')
+        dirname, index = build_patient_cache(patient, 'i_contour', cache_dir)
+        fname_pairs = patient_fname_pairs(patient, 'i_contour')
+        assert len(index['slices']) == len(fname_pairs) == 2
+
+        cache = SliceCache([dirname])
+        for (dicom_fname, contour_fname), slice_info in zip(fname_pairs, index['slices']):
+            img, msk = cache.get(0, slice_info['offset'], slice_info['shape'])
+            expected = parse_dicom_file(dicom_fname)
+            h, w = expected.shape
+            assert np.array_equal(img, expected)
+            assert np.array_equal(msk, poly_to_mask(parse_contour_array(contour_fname), w, h))
+            assert slice_info['bbox'] == list(polygon_bbox(parse_contour_array(contour_fname),
+                                                           (h, w)))
+
+        # up to date caches are reused, caches of other files are rebuilt
+        mtime = os.path.getmtime(os.path.join(dirname, INDEX_FNAME))
+        assert build_patient_cache(patient, 'i_contour', cache_dir)[1] == index
+        assert os.path.getmtime(os.path.join(dirname, INDEX_FNAME)) == mtime
+        # indexes of older caches lack the bbox
+        old_index = {**index, 'slices': [{key: value for key, value in o.items() if key != 'bbox'}
+                                         for o in index['slices']]}
+        assert not cache_is_stale(index, fname_pairs) and cache_is_stale(old_index, fname_pairs)
+
+        # files edited in place are parsed again
+        dicom_fname, contour_fname = fname_pairs[0]
+        with open(contour_fname, 'w') as outfile:
+            outfile.write('4.0 4.0\n20.0 4.0\n20.0 12.0\n4.0 12.0\n')
+        dirname, index = build_patient_cache(patient, 'i_contour', cache_dir)
+        _, msk = SliceCache([dirname]).get(0, 0, index['slices'][0]['shape'])
+        assert msk.sum() == poly_to_mask(parse_contour_array(contour_fname), 32, 32).sum()
+        assert sorted(os.listdir(os.path.dirname(dirname))) == [patient.dicom_id]
+
+        for slice_no in list(patient.all_files_dict)[1:]:
+            patient.all_files_dict[slice_no]['i_contour_fname'] = None
+        _, index = build_patient_cache(patient, 'i_contour', cache_dir)
+        assert len(index['slices']) == 1
+        assert read_cache_index(dirname) == index
+    print("Test passed")
@@ -0,0 +1,236 @@
+import csv
+import json
+import os
+import secrets
+from pathlib import Path
+from .dicom_utils import (Patient, get_patient_files, dicom_slice_dict,
+                          contour_slice_dict, patient_files_dict)
+
+CATALOG_FNAME = 'catalog.json'
+FILE_TYPES = ('dicom', 'i_contour', 'o_contour')
+CONTOUR_DIRS = {'i_contour': 'i-contours', 'o_contour': 'o-contours'}
+
+
+def read_links(link_path):
+    """
+    Read (dicom_id, contour_id) pairs from link.csv
+
+    Inputs:
+        link_path (str): path of link.csv with patient_id, original_id columns
+    Return:
+        link_pairs (list): list of (dicom_id, contour_id) tuples
+    """
+    with open(link_path, 'r', newline='') as infile:
+        return [(row['patient_id'], row['original_id']) for row in csv.DictReader(infile)]
+
+
+def patient_dirs(dicom_id, contour_id, dicoms_path, contourfiles_path):
+    """Directories scanned for a patient: dicoms, i-contours, o-contours"""
+    contour_dir = Path(contourfiles_path) / contour_id
+    return [Path(dicoms_path) / dicom_id,
+            contour_dir / CONTOUR_DIRS['i_contour'],
+            contour_dir / CONTOUR_DIRS['o_contour']]
+
+
+def dir_mtimes(dirnames):
+    """Modification times in ns, changes when files are added or removed"""
+    return [os.stat(dirname).st_mtime_ns for dirname in dirnames]
+
+
+def scan_patient(dicom_id, contour_id, dicoms_path, contourfiles_path):
+    """
+    Scan the directories of a patient and record every file and slice
+
+    Inputs:
+        dicom_id (str): patient directory name under dicoms_path
+        contour_id (str): patient directory name under contourfiles_path
+        dicoms_path (str): main directory for dicoms
+        contourfiles_path (str): main directory for contours
+    Return:
+        entry (dict): 'dicom_id', 'contour_id', 'dir_mtimes',
+            'files' and 'mtimes' with file names and mtimes of dicoms,
+            i_contours and o_contours in scan order, and 'slices', a list of
+            {'slice_no', 'dicom', 'i_contour', 'o_contour'} file names
+            (None if missing) in slice dict order
+    """
+    # read mtimes before listing so a change during the scan triggers a rescan
+    mtimes = dir_mtimes(patient_dirs(dicom_id, contour_id, dicoms_path, contourfiles_path))
+    file_lists = get_patient_files(dicom_id, contour_id, Path(dicoms_path),
+                                   Path(contourfiles_path), False)
+    all_files_dict = patient_files_dict(dicom_slice_dict(file_lists[0]),
+                                        contour_slice_dict(file_lists[1]),
+                                        contour_slice_dict(file_lists[2]))
+
+    slices = []
+    for slice_no, slice_dict in all_files_dict.items():
+        record = {'slice_no': slice_no}
+        for name in FILE_TYPES:
+            fname = slice_dict[f'{name}_fname']
+            record[name] = os.path.basename(fname) if fname is not None else None
+        slices.append(record)
+
+    return {'dicom_id': dicom_id,
+            'contour_id': contour_id,
+            'dir_mtimes': mtimes,
+            'files': {name: [os.path.basename(f) for f in fnames]
+                      for name, fnames in zip(FILE_TYPES, file_lists)},
+            'mtimes': {name: [os.stat(f).st_mtime_ns for f in fnames]
+                       for name, fnames in zip(FILE_TYPES, file_lists)},
+            'slices': slices}
+
+
+class Catalog:
+    """
+    Persistent index of every patient, slice and file of a dataset,
+    keyed on link.csv. Stored as JSON next to the data and updated
+    incrementally: only patients whose directories changed are rescanned.
+
+    Data directory layout:
+        data_path/link.csv
+        data_path/dicoms/{dicom_id}/{slice_no}.dcm
+        data_path/contourfiles/{contour_id}/{i-contours, o-contours}/
+
+    Inputs:
+        data_path (str): main data directory, e.g. final_data/
+        catalog_path (str): catalog file, defaults to data_path/catalog.json
+        update (bool): update the catalog on creation
+    """
+    def __init__(self, data_path, catalog_path=None, update=True):
+        self.data_path = Path(data_path)
+        self.dicoms_path = self.data_path / 'dicoms'
+        self.contourfiles_path = self.data_path / 'contourfiles'
+        self.link_path = self.data_path / 'link.csv'
+        if catalog_path is None:
+            catalog_path = self.data_path / CATALOG_FNAME
+        self.catalog_path = str(catalog_path)
+
+        self.entries = {}
+        if os.path.exists(self.catalog_path):
+            with open(self.catalog_path, 'r') as infile:
+                self.entries = {entry['dicom_id']: entry for entry in json.load(infile)['patients']}
+        if update:
+            self.update()
+
+    def update(self):
+        """
+        Rescan new patients and patients whose directories changed,
+        drop patients removed from link.csv and save if anything changed
+
+        Return:
+            rescanned (list): dicom_ids which were scanned
+        """
+        link_pairs = read_links(self.link_path)
+        entries, rescanned = {}, []
+        for dicom_id, contour_id in link_pairs:
+            entry = self.entries.get(dicom_id)
+            dirnames = patient_dirs(dicom_id, contour_id, self.dicoms_path,
+                                    self.contourfiles_path)
+            if (entry is None or entry['contour_id'] != contour_id or
+                    entry['dir_mtimes'] != dir_mtimes(dirnames)):
+                entry = scan_patient(dicom_id, contour_id, self.dicoms_path,
+                                     self.contourfiles_path)
+                rescanned.append(dicom_id)
+            entries[dicom_id] = entry
+
+        changed = bool(rescanned) or list(entries) != list(self.entries)
+        self.entries = entries
+        if changed:
+            self.save()
+        return rescanned
+
+    def save(self):
+        """
+        Write catalog through a temporary file unique to the process so
+        readers never see a partial one and concurrent saves never write
+        the same temporary file
+        """
+        tmp_path = f'{self.catalog_path}.{os.getpid()}.{secrets.token_hex(4)}.tmp'
+        with open(tmp_path, 'w') as outfile:
+            json.dump({'patients': list(self.entries.values())}, outfile)
+        os.replace(tmp_path, self.catalog_path)
+
+    def file_lists(self, dicom_id):
+        """
+        Dicom, i_contour and o_contour file lists of a patient, same as
+        get_patient_files but without touching the data directories
+        """
+        entry = self.entries[dicom_id]
+        dirs = patient_dirs(dicom_id, entry['contour_id'], self.dicoms_path,
+                            self.contourfiles_path)
+        return tuple([str(dirname / fname) for fname in entry['files'][name]]
+                     for dirname, name in zip(dirs, FILE_TYPES))
+
+    def patient(self, dicom_id):
+        """Patient object with file dicts filled from the catalog"""
+        entry = self.entries[dicom_id]
+        patient = Patient(dicom_id, entry['contour_id'], self.dicoms_path,
+                          self.contourfiles_path)
+        patient.set_file_lists(*self.file_lists(dicom_id))
+        patient.create_file_dicts(False)
+        return patient
+
+    def patients(self):
+        """Patient objects of every patient in link.csv order"""
+        return [self.patient(dicom_id) for dicom_id in self.entries]
+
+    def slices_with(self, dicom_id, contour_types):
+        """
+        Slice numbers of a patient having a dicom and all given contour types
+
+        Inputs:
+            dicom_id (str): patient dicom id
+            contour_types (list): e.g. ['i_contour', 'o_contour']
+        """
+        return [record['slice_no'] for record in self.entries[dicom_id]['slices']
+                if record['dicom'] is not None and
+                all(record[c] is not None for c in contour_types)]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, dicom_id):
+        return dicom_id in self.entries
+
+
+def test_catalog():
+    """unit test for Catalog, same files as a scan and incremental updates"""
+    import shutil
+    import tempfile
+    from .benchmarks import write_synthetic_cohort
+
+    with tempfile.TemporaryDirectory() as root:
+        patients = write_synthetic_cohort(root, n_patients=2, n_slices=4, size=32)
+        catalog = Catalog(root)
+        assert len(catalog) == 2 and os.path.exists(catalog.catalog_path)
+        for patient in patients:
+            patient.create_file_dicts(False)
+            file_lists = catalog.file_lists(patient.dicom_id)
+            assert file_lists == tuple([str(fname) for fname in fnames] for fnames in
+                                       (patient.dicoms, patient.i_contours, patient.o_contours))
+            assert catalog.patient(patient.dicom_id).all_files_dict == patient.all_files_dict
+            expected = [slice_no for slice_no, slice_dict in patient.all_files_dict.items()
+                        if slice_dict['i_contour_fname'] is not None]
+            assert catalog.slices_with(patient.dicom_id, ['i_contour']) == expected
+
+        # a saved catalog is loaded without rescanning
+        assert Catalog(root, update=False).entries == catalog.entries
+        assert Catalog(root).update() == []
+        assert not [fname for fname in os.listdir(root) if fname.endswith('.tmp')]
+
+        # only patients whose directories changed are rescanned
+        patient = patients[1]
+        slice_no = next(slice_no for slice_no, slice_dict in patient.all_files_dict.items()
+                        if slice_dict['i_contour_fname'] is None)
+        i_contour_fname = os.path.join(root, 'contourfiles', patient.contour_id, 'i-contours',
+                                       f'IM-0001-{slice_no:04d}-icontour-manual.txt')
+        shutil.copyfile(patient.all_files_dict[slice_no]['o_contour_fname'], i_contour_fname)
+        assert catalog.update() == [patient.dicom_id]
+        assert slice_no in catalog.slices_with(patient.dicom_id, ['i_contour'])
+        assert i_contour_fname in catalog.file_lists(patient.dicom_id)[1]
+
+        # patients removed from link.csv are dropped
+        with open(catalog.link_path, 'w') as outfile:
+            outfile.write(f'patient_id,original_id\n{patient.dicom_id},{patient.contour_id}\n')
+        assert catalog.update() == []
+        assert list(Catalog(root, update=False).entries) == [patient.dicom_id]
+    print("Test passed")
@@ -0,0 +1,354 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from .heuristics import get_kernel
+from .masks import dense_mask
+from .parsing import parse_contour_array
+from .profiling import profiled
+from .roi import mask_bbox
+
+CONTOUR_TYPES = ['i_contour', 'o_contour']
+
+
+def sidecar_is_stale(path, contour_fnames):
+    """
+    Check if a contour sidecar is missing, was compiled from a different
+    set of files or is older than any of its contour files
+
+    Inputs:
+        path (str): sidecar file path
+        contour_fnames (dict): {contour_type: {slice_no: contour filename}}
+    Return:
+        stale (bool): True if sidecar needs to be compiled
+    """
+    if not os.path.exists(path):
+        return True
+
+    with np.load(path) as sidecar:
+        fnames = sidecar['fnames'].tolist()
+    expected = [contour_fnames[contour_type][slice_no]
+                for contour_type in CONTOUR_TYPES
+                for slice_no in contour_fnames[contour_type]]
+    if fnames != expected:
+        return True
+
+    sidecar_mtime = os.path.getmtime(path)
+    return any(os.path.getmtime(fname) > sidecar_mtime for fname in fnames)
+
+
+def write_contour_sidecar(path, contour_fnames):
+    """
+    Compile all contours of a patient into one binary file. Points of
+    every contour are concatenated into a single (M, 2) float64 array and
+    contour k is points[offsets[k]:offsets[k + 1]].
+
+    Inputs:
+        path (str): sidecar file path, .npz
+        contour_fnames (dict): {contour_type: {slice_no: contour filename}}
+    """
+    contours, fnames, slice_nos, type_ids = [], [], [], []
+    for type_id, contour_type in enumerate(CONTOUR_TYPES):
+        for slice_no, fname in contour_fnames[contour_type].items():
+            contours.append(parse_contour_array(fname))
+            fnames.append(fname)
+            slice_nos.append(slice_no)
+            type_ids.append(type_id)
+
+    lengths = [len(c) for c in contours]
+    offsets = np.zeros(len(contours) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(lengths)
+    points = np.concatenate(contours) if contours else np.zeros((0, 2), np.float64)
+
+    dirname = os.path.dirname(path)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    # write to a temporary file so readers never see a partial sidecar
+    tmp_path = path + '.tmp.npz'
+    np.savez(tmp_path, points=points, offsets=offsets,
+             slice_nos=np.array(slice_nos, dtype=np.int32),
+             type_ids=np.array(type_ids, dtype=np.uint8),
+             fnames=np.array(fnames, dtype=str))
+    os.replace(tmp_path, path)
+
+
+def read_contour_sidecar(path):
+    """
+    Load every contour of a patient from its sidecar in one read
+
+    Inputs:
+        path (str): sidecar file path
+    Return:
+        contours_dict (dict): {contour_type: {slice_no: (N, 2) np.array}},
+            arrays are views of a single points array
+    """
+    with np.load(path) as sidecar:
+        points = sidecar['points']
+        offsets = sidecar['offsets']
+        slice_nos = sidecar['slice_nos']
+        type_ids = sidecar['type_ids']
+
+    contours_dict = {contour_type: {} for contour_type in CONTOUR_TYPES}
+    for k, (slice_no, type_id) in enumerate(zip(slice_nos.tolist(), type_ids.tolist())):
+        contours_dict[CONTOUR_TYPES[type_id]][slice_no] = points[offsets[k]:offsets[k + 1]]
+    return contours_dict
+
+
+def contour_file_name(slice_no, contour_type):
+    """
+    Contour file name of a slice, e.g. IM-0001-0048-icontour-manual.txt,
+    the slice number is read back by contour_slice_dict
+    """
+    return f'IM-0001-{slice_no:04d}-{contour_type[0]}contour-manual.txt'
+
+
+def contour_dir(contourfiles_path, contour_id, contour_type):
+    """Directory of a contour type of a patient, e.g. SC-HF-I-1/i-contours"""
+    return os.path.join(str(contourfiles_path), str(contour_id),
+                        f'{contour_type[0]}-contours')
+
+
+@profiled()
+def mask_to_polygon(mask, epsilon=0.0):
+    """
+    Trace the boundary of a mask into a polygon, the inverse of
+    poly_to_mask. poly_to_mask leaves pixels under the outline out, so the
+    polygon runs through the pixels just outside the mask and
+    poly_to_mask(polygon) gives the mask back, up to a few pixels along
+    diagonal edges. Only the largest connected region is kept since a
+    contour file holds a single polygon, holes are filled.
+
+    Inputs:
+        mask (np.array, PackedMask): (H, W) boolean or 0/1 mask
+        epsilon (float): maximum distance in pixels between the traced
+            boundary and its simplification, 0 keeps every corner
+    Return:
+        polygon (np.array): (N, 2) float32 x, y coordinates, may lie one
+            pixel outside the image, None if the mask is empty
+    """
+    import cv2
+
+    # trace only the bounding box, padded so masks touching the image
+    # border are still surrounded by background after dilation
+    bbox = mask_bbox(mask)
+    if bbox is None:
+        return None
+    r0, r1, c0, c1 = bbox
+    roi = np.pad(dense_mask(mask)[r0:r1, c0:c1].astype(np.uint8, copy=False), 2)
+    # a 3x3 cross adds the ring of pixels 4-connected to the mask
+    outer = cv2.dilate(roi, get_kernel(2, 3))
+    contours, _ = cv2.findContours(outer, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE,
+                                   offset=(int(c0) - 2, int(r0) - 2))
+    contour = max(contours, key=cv2.contourArea)
+    if epsilon > 0:
+        contour = cv2.approxPolyDP(contour, epsilon, True)
+    return contour.reshape(-1, 2).astype(np.float32)
+
+
+def masks_to_polygons(masks, epsilon=0.0, workers=None):
+    """
+    mask_to_polygon over a batch of masks on a thread pool, OpenCV
+    releases the GIL while tracing
+
+    Inputs:
+        masks (np.array, list): (N, H, W) array or list of (H, W) masks
+        epsilon (float): simplification tolerance, see mask_to_polygon
+        workers (int): number of threads, defaults to number of cpus
+    Return:
+        polygons (list): N polygons, None for empty masks
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers == 1 or len(masks) <= 1:
+        return [mask_to_polygon(mask, epsilon) for mask in masks]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(lambda mask: mask_to_polygon(mask, epsilon), masks))
+
+
+def format_contour(polygon):
+    """Text of a contour file, one 'x y' line per point with 2 decimals"""
+    return '%.2f %.2f\n' * len(polygon) % tuple(np.asarray(polygon, np.float64).ravel())
+
+
+def write_contour_file(fname, polygon, overwrite=False):
+    """
+    Write a polygon in the contour file format. The file is written under
+    a dot name first, which directory scans skip, then renamed, so readers
+    never see a partial file.
+
+    Inputs:
+        fname (str): contour file path
+        polygon (np.array): (N, 2) x, y coordinates
+        overwrite (bool): replace an existing file, e.g. a manual contour,
+            else FileExistsError is raised
+    """
+    if not overwrite and os.path.exists(fname):
+        raise FileExistsError(f'{fname} exists, pass overwrite=True to replace it')
+    dirname, basename = os.path.split(str(fname))
+    tmp_path = os.path.join(dirname, f'.{basename}.tmp')
+    with open(tmp_path, 'w') as outfile:
+        outfile.write(format_contour(polygon))
+    os.replace(tmp_path, fname)
+
+
+def _export_contour(args):
+    """Trace a mask and write its contour file, returns the file or None"""
+    mask, fname, epsilon, overwrite = args
+    polygon = mask_to_polygon(mask, epsilon)
+    if polygon is None:
+        return None
+    write_contour_file(fname, polygon, overwrite)
+    return fname
+
+
+def export_contours(all_patients, predictions, contourfiles_path, contour_type='i_contour',
+                    epsilon=0.0, workers=None, overwrite=False):
+    """
+    Write predicted masks, e.g. heuristic proposals or model outputs, as
+    contour files following the layout get_patient_files reads,
+    contourfiles_path/{contour_id}/i-contours/IM-0001-XXXX-icontour-manual.txt.
+    Masks are traced and written slice by slice on a thread pool, so files
+    stream out while the rest of the batch is traced. Empty masks are
+    skipped. The names are those of manual contours, so existing files
+    are never replaced unless overwrite is set, write predictions into
+    their own contourfiles_path to keep them apart from annotations.
+
+    Inputs:
+        all_patients (list): list of Patient objects
+        predictions (dict): {dicom_id: {slice_no: (H, W) mask}} or
+            {dicom_id: (slice_nos, (N, H, W) masks)}, e.g. from
+            memo.patient_proposals
+        contourfiles_path (str): main directory for contours
+        contour_type (str): either 'i_contour' or 'o_contour'
+        epsilon (float): simplification tolerance, see mask_to_polygon
+        workers (int): number of threads, defaults to number of cpus
+        overwrite (bool): replace existing contour files, else
+            FileExistsError is raised before anything is written
+    Return:
+        written (dict): {dicom_id: list of written contour files}
+    """
+    if contour_type not in CONTOUR_TYPES:
+        raise ValueError(f'contour_type must be one of {CONTOUR_TYPES}')
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    tasks, dicom_ids = [], []
+    for patient in all_patients:
+        if patient.dicom_id not in predictions:
+            continue
+        patient_predictions = predictions[patient.dicom_id]
+        if isinstance(patient_predictions, dict):
+            slice_nos, masks = list(patient_predictions), list(patient_predictions.values())
+        else:
+            slice_nos, masks = patient_predictions
+        out_dir = contour_dir(contourfiles_path, patient.contour_id, contour_type)
+        for slice_no, mask in zip(slice_nos, masks):
+            fname = os.path.join(out_dir, contour_file_name(int(slice_no), contour_type))
+            tasks.append((mask, fname, epsilon, overwrite))
+            dicom_ids.append(patient.dicom_id)
+
+    if not overwrite:
+        existing = [task[1] for task in tasks if os.path.exists(task[1])]
+        if existing:
+            raise FileExistsError(f'{len(existing)} contour files exist, e.g. {existing[0]}, '
+                                  'pass overwrite=True to replace them')
+    for out_dir in set(os.path.dirname(task[1]) for task in tasks):
+        os.makedirs(out_dir, exist_ok=True)
+
+    if workers == 1 or len(tasks) <= 1:
+        fnames = list(map(_export_contour, tasks))
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            fnames = list(executor.map(_export_contour, tasks))
+
+    written = {patient.dicom_id: [] for patient in all_patients
+               if patient.dicom_id in predictions}
+    for dicom_id, fname in zip(dicom_ids, fnames):
+        if fname is not None:
+            written[dicom_id].append(fname)
+    return written
+
+
+def test_contour_sidecar():
+    """unit test for contour sidecars, round trip and staleness"""
+    import tempfile
+    from .benchmarks import write_synthetic_cohort
+
+    with tempfile.TemporaryDirectory() as root:
+        patient = write_synthetic_cohort(root, n_patients=1, n_slices=4, size=32)[0]
+        patient.create_file_dicts(False)
+        contour_fnames = {'i_contour': patient.i_contours_dict,
+                          'o_contour': patient.o_contours_dict}
+        path = os.path.join(root, 'sidecars', f'{patient.dicom_id}.npz')
+        assert sidecar_is_stale(path, contour_fnames)
+
+        write_contour_sidecar(path, contour_fnames)
+        assert not sidecar_is_stale(path, contour_fnames)
+        contours_dict = read_contour_sidecar(path)
+        for contour_type in CONTOUR_TYPES:
+            assert list(contours_dict[contour_type]) == list(contour_fnames[contour_type])
+            for slice_no, fname in contour_fnames[contour_type].items():
+                assert np.array_equal(contours_dict[contour_type][slice_no],
+                                      parse_contour_array(fname))
+
+        # a rewritten contour file or another set of files needs a new sidecar
+        fname = next(iter(patient.o_contours_dict.values()))
+        mtime = os.path.getmtime(path)
+        os.utime(fname, (mtime + 1, mtime + 1))
+        assert sidecar_is_stale(path, contour_fnames)
+        os.utime(fname, (mtime - 1, mtime - 1))
+        assert not sidecar_is_stale(path, contour_fnames)
+        assert sidecar_is_stale(path, {'i_contour': {}, 'o_contour': patient.o_contours_dict})
+    print("Test passed")
+
+
+def test_export_contours():
+    """unit test for export_contours, exported files rasterize back to the masks"""
+    import tempfile
+    from .benchmarks import write_synthetic_cohort
+    from .metrics import dice_score
+    from .parsing import poly_to_mask
+
+    with tempfile.TemporaryDirectory() as root:
+        patient = write_synthetic_cohort(root, n_patients=1, n_slices=4, size=64)[0]
+        patient.create_numpy_arrays(False)
+        masks = {slice_no: slice_dict['o_contour_array']
+                 for slice_no, slice_dict in patient.all_numpy_dict.items()}
+        masks[0] = np.zeros((64, 64), dtype=np.uint8)
+
+        out_path = os.path.join(root, 'predicted')
+        written = export_contours([patient], {patient.dicom_id: masks}, out_path,
+                                  'o_contour', workers=2)
+        # empty masks are skipped
+        assert len(written[patient.dicom_id]) == len(masks) - 1
+        for slice_no, mask in masks.items():
+            fname = os.path.join(contour_dir(out_path, patient.contour_id, 'o_contour'),
+                                 contour_file_name(slice_no, 'o_contour'))
+            if not mask.any():
+                assert not os.path.exists(fname)
+                continue
+            polygon = parse_contour_array(fname)
+            assert np.array_equal(polygon, np.round(mask_to_polygon(mask), 2))
+            assert dice_score(poly_to_mask(polygon, 64, 64), mask) > 0.98
+
+        # existing files, e.g. manual contours, are never replaced by default
+        manual_dir = contour_dir(patient.contourfiles_path, patient.contour_id, 'o_contour')
+
+        def read_manual():
+            contents = {}
+            for fname in os.listdir(manual_dir):
+                with open(os.path.join(manual_dir, fname)) as infile:
+                    contents[fname] = infile.read()
+            return contents
+
+        manual = read_manual()
+        for path in (out_path, patient.contourfiles_path):
+            try:
+                export_contours([patient], {patient.dicom_id: masks}, path, 'o_contour')
+                assert False, 'FileExistsError expected'
+            except FileExistsError:
+                pass
+        assert read_manual() == manual
+        written = export_contours([patient], {patient.dicom_id: masks}, out_path,
+                                  'o_contour', overwrite=True)
+        assert len(written[patient.dicom_id]) == len(masks) - 1
+    print("Test passed")
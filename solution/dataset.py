@@ -1,7 +1,26 @@
+import io
+from collections import OrderedDict
 import numpy as np
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Sampler, get_worker_info
+import torch
 from torch import FloatTensor
-from .dicom_utils import parse_dicom_file, poly_to_mask, parse_contour_file
+from .parsing import poly_to_mask
+from .dicom_index import DicomIndex
+from .roi import polygon_bbox, clip_bbox, bbox_contains, centered_box, crop_array
+from .contours import parse_contour_array
+from .cache import build_patient_cache, SliceCache
+from .prefetch import PrefetchReader
+from .profiling import profiled
+
+# supported image dtypes of batches
+TORCH_DTYPES = {np.dtype(np.float32): torch.float32,
+                np.dtype(np.float16): torch.float16}
+
+
+@profiled('dataset.to_tensor')
+def _sample_tensors(img, msk):
+    """(1, H, W) FloatTensors of an image and its mask"""
+    return FloatTensor(img)[None, :], FloatTensor(msk)[None, :]
 
 
 class HeartDataset2D(Dataset):
@@ -11,38 +30,563 @@ class HeartDataset2D(Dataset):
     Inputs:
         all_patients (list): list containing Patient objects
         contour_type (str): either 'i_contour' or 'o_contour'
+        cache_dir (str): if given, every (image, mask) pair is parsed once
+            and written under this directory, later reads are served
+            from np.memmap instead of parsing DICOM and contour files
+        overwrite_cache (bool): rebuild caches even if they are up to date
+        image_dtype (np.dtype): image dtype of batches, np.float32 or np.float16
+        pin_memory (bool): allocate batches in pinned memory, needs CUDA
+        dicom_index (DicomIndex): header index used to size batches and
+            read pixels without parsing headers again, defaults to a new
+            in-memory index
+        archive (CohortArchive): if given, samples are read from this
+            archive instead of DICOM and contour files, all_patients may
+            then be None to use every patient of the archive. Samples
+            keep the order of the files the archive was written from
+        crop_size (tuple): if given, every sample is a (h, w) crop centered
+            on the bounding box of its contour, zero padded where it
+            reaches outside the slice. Masks are rasterized on the crop only.
+
+    Indexing with a list of indices returns a whole batch instead of a
+    single sample: contiguous (B, 1, H, W) images of image_dtype and uint8
+    masks filled in place, no per-sample tensors or collate copies. All
+    slices of a batch must have the same shape, use BucketBatchSampler:
+
+        sampler = BucketBatchSampler(dataset.slice_shapes(), batch_size=16)
+        loader = DataLoader(dataset, sampler=sampler, batch_size=None)
     """
-    def __init__(self, all_patients, contour_type):
+    def __init__(self, all_patients, contour_type, cache_dir=None,
+                 overwrite_cache=False, image_dtype=np.float32, pin_memory=False,
+                 dicom_index=None, archive=None, crop_size=None):
 
         self.all_patients = all_patients
         self.contour_type = contour_type
+        self.cache_dir = cache_dir
+        self.image_dtype = np.dtype(image_dtype)
+        if self.image_dtype not in TORCH_DTYPES:
+            raise ValueError('image_dtype must be either np.float32 or np.float16')
+        self.pin_memory = pin_memory
+        self.dicom_index = dicom_index if dicom_index is not None else DicomIndex()
+        self.archive = archive
+        self.crop_size = tuple(crop_size) if crop_size is not None else None
+        self._shapes = None
+        self.reader = None
         # self.model_type = model_type
 
         # get filenames
         self.dicom_contour_fnames = []
-        for patient in self.all_patients:
-            # create all files dict
-            patient.create_file_dicts(False)
-            # loop over slices
-            for slice_no in patient.all_files_dict:
-                slice_dict = patient.all_files_dict[slice_no]
-                dicom_fname = slice_dict['dicom_fname']
-                contour_fname = slice_dict[f'{self.contour_type}_fname']
-                if contour_fname is not None:
-                    self.dicom_contour_fnames.append((dicom_fname, contour_fname))
+        if self.archive is not None:
+            # (dicom_id, slice_no) of slices having the contour, in the order
+            # of their files, so samples come in the same order as from files
+            dicom_ids = (list(self.archive.entries) if self.all_patients is None
+                         else [patient.dicom_id for patient in self.all_patients])
+            self.archive_samples = [(dicom_id, slice_no) for dicom_id in dicom_ids
+                                    for slice_no in self.archive.slice_nos(
+                                        dicom_id, ('dicom', self.contour_type))]
+        else:
+            for patient in self.all_patients:
+                # create all files dict, unless it's already known e.g. from a Catalog
+                if not hasattr(patient, 'all_files_dict'):
+                    patient.create_file_dicts(False)
+                # loop over slices
+                for slice_no in patient.all_files_dict:
+                    slice_dict = patient.all_files_dict[slice_no]
+                    dicom_fname = slice_dict['dicom_fname']
+                    contour_fname = slice_dict[f'{self.contour_type}_fname']
+                    if contour_fname is not None:
+                        self.dicom_contour_fnames.append((dicom_fname, contour_fname))
+
+        # build caches and locate each sample in them
+        self.slice_cache = None
+        if self.cache_dir is not None and self.archive is None:
+            dirnames, self.cache_locations, self.cache_bboxes = [], [], []
+            for patient_idx, patient in enumerate(self.all_patients):
+                dirname, index = build_patient_cache(patient, self.contour_type,
+                                                     self.cache_dir, overwrite_cache)
+                dirnames.append(dirname)
+                for slice_info in index['slices']:
+                    self.cache_locations.append((patient_idx,
+                                                 slice_info['offset'],
+                                                 tuple(slice_info['shape'])))
+                    bbox = slice_info['bbox']
+                    self.cache_bboxes.append(tuple(bbox) if bbox is not None else None)
+            self.slice_cache = SliceCache(dirnames)
+
+    def slice_shapes(self):
+        """
+        (H, W) of every sample, from the archive, the cache index or DICOM headers
+        """
+        if self._shapes is None:
+            if self.crop_size is not None:
+                self._shapes = [self.crop_size] * len(self)
+            elif self.archive is not None:
+                self._shapes = [tuple(self.archive.entries[dicom_id]['shape'])
+                                for dicom_id, _ in self.archive_samples]
+            elif self.slice_cache is not None:
+                self._shapes = [shape for _, _, shape in self.cache_locations]
+            else:
+                # headers are parsed once, workers get the filled index
+                self.dicom_index.update(dicom_fname for dicom_fname, _ in self.dicom_contour_fnames)
+                self._shapes = [self.dicom_index.shape(dicom_fname)
+                                for dicom_fname, _ in self.dicom_contour_fnames]
+        return self._shapes
+
+    def batch_shape(self, indices):
+        """(H, W) shared by all samples of a batch, raises if they differ"""
+        shapes = self.slice_shapes()
+        h, w = shapes[indices[0]]
+        if any(shapes[idx] != (h, w) for idx in indices):
+            raise ValueError('slices of a batch must have the same shape, '
+                             'use BucketBatchSampler')
+        return h, w
+
+    @profiled('dataset.fill_batch')
+    def fill_batch(self, indices, images, masks):
+        """
+        Write samples into given arrays, e.g. preallocated or shared memory
+
+        Inputs:
+            indices (list): sample indices
+            images (np.array): (B, 1, H, W) array for images
+            masks (np.array): (B, 1, H, W) uint8 array for masks
+        """
+        for k, idx in enumerate(indices):
+            self._fill_sample(idx, images[k, 0], masks[k, 0])
 
+    @profiled('dataset.sample')
+    def _fill_sample(self, idx, image, mask):
+        """
+        Write a sample, cropped if crop_size is set, into (H, W) arrays.
+        Crops of every source are centered on the contour polygon bbox
+        """
+        if self.archive is not None:
+            dicom_id, slice_no = self.archive_samples[idx]
+            img = self.archive.read_slice(dicom_id, slice_no)
+            msk = self.archive.read_slice(dicom_id, slice_no, self.contour_type)
+            if self.crop_size is not None:
+                polygon_box = self.archive.contour_bbox(dicom_id, slice_no, self.contour_type)
+        elif self.slice_cache is not None:
+            img, msk = self.slice_cache.get(*self.cache_locations[idx])
+            polygon_box = self.cache_bboxes[idx]
+        else:
+            dicom_fname, dicom_data, polygon = self._read_files(idx)
+            if self.crop_size is None:
+                # read and rescale straight into the batch
+                self.dicom_index.read(dicom_fname, out=image, data=dicom_data)
+                poly_to_mask(polygon, image.shape[1], image.shape[0], out=mask)
+                return
+            img = self.dicom_index.read(dicom_fname, data=dicom_data)
+            polygon_box = polygon_bbox(polygon, img.shape)
+            box = centered_box(polygon_box, self.crop_size, img.shape)
+            crop_array(img, box, out=image)
+            if (polygon_box is not None and clip_bbox(box, img.shape) == box and
+                    bbox_contains(box, polygon_box)):
+                # rasterize the crop only, polygon moved to crop coordinates,
+                # a polygon larger than the crop would be clipped differently
+                poly_to_mask(polygon - np.array([box[2], box[0]], dtype=polygon.dtype),
+                             self.crop_size[1], self.crop_size[0], out=mask)
+            else:
+                h, w = img.shape
+                crop_array(poly_to_mask(polygon, w, h), box, out=mask)
+            return
+
+        if self.crop_size is None:
+            np.copyto(image, img, casting='unsafe')
+            mask[...] = msk
+            return
+        box = centered_box(polygon_box, self.crop_size, img.shape)
+        crop_array(img, box, out=image)
+        crop_array(msk, box, out=mask)
+
+    @profiled('dataset.get_batch')
+    def get_batch(self, indices):
+        """
+        Contiguous batch of samples with the same shape
+
+        Inputs:
+            indices (list): sample indices
+        Return:
+            images (torch.Tensor): (B, 1, H, W) image_dtype images
+            masks (torch.Tensor): (B, 1, H, W) uint8 masks
+        """
+        h, w = self.batch_shape(indices)
+
+        # allocate once and write every sample into place
+        images = torch.empty((len(indices), 1, h, w), dtype=TORCH_DTYPES[self.image_dtype],
+                             pin_memory=self.pin_memory)
+        masks = torch.empty((len(indices), 1, h, w), dtype=torch.uint8,
+                            pin_memory=self.pin_memory)
+        self.fill_batch(indices, images.numpy(), masks.numpy())
+        return images, masks
+
+    @profiled('dataset.getitem')
     def __getitem__(self, idx):
-        # get filename pair by idx
-        dicom_contour_fname = self.dicom_contour_fnames[idx]
-        dicom_fname, contour_fname = dicom_contour_fname[0], dicom_contour_fname[1]
+        if isinstance(idx, (list, tuple, np.ndarray)):
+            return self.get_batch(idx)
+
+        if self.crop_size is not None:
+            img = np.empty(self.crop_size, dtype=np.float32)
+            msk = np.empty(self.crop_size, dtype=np.uint8)
+            self._fill_sample(idx, img, msk)
+            return _sample_tensors(img, msk)
+
+        if self.archive is not None:
+            # views of an inflated chunk, copy once while converting dtype
+            dicom_id, slice_no = self.archive_samples[idx]
+            img = self.archive.read_slice(dicom_id, slice_no).astype(np.float32)
+            msk = self.archive.read_slice(dicom_id, slice_no, self.contour_type).astype(np.float32)
+            return _sample_tensors(img, msk)
+
+        if self.slice_cache is not None:
+            # read views from memmap, copy once while converting dtype
+            img, msk = self.slice_cache.get(*self.cache_locations[idx])
+            img, msk = img.astype(np.float32), msk.astype(np.float32)
+            return _sample_tensors(img, msk)
 
         # parse image and mask files
-        img = parse_dicom_file(dicom_fname)
+        dicom_fname, dicom_data, polygon = self._read_files(idx)
+        img = self.dicom_index.read(dicom_fname, data=dicom_data)
         h, w = img.shape
-        msk = poly_to_mask(parse_contour_file(contour_fname), w, h).astype(np.uint8)
+        msk = poly_to_mask(polygon, w, h).view(np.uint8)
 
         # convert to FloatTensor and add channel (1)
-        return FloatTensor(img)[None, :], FloatTensor(msk)[None, :]
+        return _sample_tensors(img, msk)
+
+    def _read_files(self, idx):
+        """
+        (dicom_fname, dicom bytes, contour) of a sample read from files,
+        dicom bytes are None unless they come from the prefetch reader.
+        DataLoader workers forked while a reader runs inherit it without
+        its threads, they read on their own
+        """
+        dicom_fname, contour_fname = self.dicom_contour_fnames[idx]
+        if self.reader is None or get_worker_info() is not None:
+            return dicom_fname, None, parse_contour_array(contour_fname)
+        dicom_data = self.reader.get(dicom_fname)
+        polygon = parse_contour_array(io.BytesIO(self.reader.get(contour_fname)))
+        return dicom_fname, dicom_data, polygon
+
+    def prefetch(self, indices, window=32, workers=4):
+        """
+        Read files of samples ahead in the order they will be requested,
+        e.g. the sampler's permutation of an epoch, see PrefetchSampler.
+        Replaces the previous reader. Samples read from an archive or a
+        cache don't need it.
+
+        Inputs:
+            indices (list): sample indices in access order
+            window (int): maximum number of files in flight or buffered
+            workers (int): number of reader threads
+        Return:
+            reader (PrefetchReader): reader with latency and queue depth
+                metrics, None if samples aren't read from files
+        """
+        self.stop_prefetch()
+        if self.archive is not None or self.slice_cache is not None:
+            return None
+        fnames = [fname for idx in indices for fname in self.dicom_contour_fnames[idx]]
+        self.reader = PrefetchReader(fnames, window, workers)
+        return self.reader
+
+    def stop_prefetch(self):
+        if self.reader is not None:
+            self.reader.close()
+            self.reader = None
+
+    def __getstate__(self):
+        # reader threads stay in this process, workers read on their own
+        state = self.__dict__.copy()
+        state['reader'] = None
+        return state
+
+    def __len__(self):
+        if self.archive is not None:
+            return len(self.archive_samples)
+        return len(self.dicom_contour_fnames)
+
+class BucketBatchSampler(Sampler):
+    """
+    Batch sampler grouping samples by slice shape, so batches never need
+    padding. Batches are shuffled within and across shape buckets.
+
+    Inputs:
+        shapes (list): (H, W) of every sample, e.g. dataset.slice_shapes()
+        batch_size (int): number of samples per batch
+        shuffle (bool): shuffle samples and batches every epoch
+        drop_last (bool): drop the last incomplete batch of every bucket
+        seed (int): random seed, combined with the epoch set by set_epoch
+    """
+    def __init__(self, shapes, batch_size, shuffle=False, drop_last=False, seed=0):
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+        self.buckets = OrderedDict()
+        for idx, shape in enumerate(shapes):
+            self.buckets.setdefault(tuple(shape), []).append(idx)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        rng = np.random.RandomState(self.seed + self.epoch)
+        batches = []
+        for indices in self.buckets.values():
+            if self.shuffle:
+                indices = [indices[i] for i in rng.permutation(len(indices))]
+            for start in range(0, len(indices), self.batch_size):
+                batch = indices[start:start + self.batch_size]
+                if len(batch) == self.batch_size or not self.drop_last:
+                    batches.append(batch)
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        return iter(batches)
 
     def __len__(self):
-        return len(self.dicom_contour_fnames)
\ No newline at end of file
+        if self.drop_last:
+            return sum(len(indices) // self.batch_size for indices in self.buckets.values())
+        return sum(-(-len(indices) // self.batch_size) for indices in self.buckets.values())
+
+
+class PrefetchSampler(Sampler):
+    """
+    Wraps a sampler or batch sampler and starts prefetching the files of
+    every epoch in the order it yields, see HeartDataset2D.prefetch.
+    Reads happen on threads of the main process, so it only helps with
+    num_workers=0. DataLoader workers read on their own and never see the
+    reader, so once an order is dropped with nothing read from its reader,
+    as a DataLoader starting workers does with the first one, the sampler
+    stops prefetching and only passes the order through. At most window
+    files are then read in vain.
+
+    Inputs:
+        sampler (Sampler): yields indices or batches of indices
+        dataset (HeartDataset2D): dataset reading the files
+        window (int): maximum number of files in flight or buffered
+        workers (int): number of reader threads
+    """
+    def __init__(self, sampler, dataset, window=32, workers=4):
+        self.sampler = sampler
+        self.dataset = dataset
+        self.window = window
+        self.workers = workers
+        # False once samples turned out to be read in other processes
+        self.prefetching = True
+
+    def set_epoch(self, epoch):
+        if hasattr(self.sampler, 'set_epoch'):
+            self.sampler.set_epoch(epoch)
+
+    def __iter__(self):
+        order = list(self.sampler)
+        reader = self.dataset.reader
+        if reader is not None and reader.fnames and not reader.reads:
+            # the last order was loaded elsewhere, e.g. by DataLoader workers
+            self.prefetching = False
+        if not self.prefetching:
+            self.dataset.stop_prefetch()
+            return iter(order)
+        indices = [idx for item in order for idx in (item if isinstance(item, list) else [item])]
+        self.dataset.prefetch(indices, self.window, self.workers)
+        return iter(order)
+
+    def __len__(self):
+        return len(self.sampler)
+
+
+class HeartDataset25D(Dataset):
+    """
+    Create 2.5D dataset from given list of Patients. Each sample is a slice
+    with its neighbouring slices as channels, (2 * context + 1, H, W), and
+    the mask of the center slice, (1, H, W). Volumes are built once and
+    items are zero-copy views of them. First and last slices are repeated
+    at volume borders.
+
+    Inputs:
+        all_patients (list): list containing Patient objects
+        contour_type (str): either 'i_contour' or 'o_contour'
+        context (int): number of neighbouring slices on each side
+    """
+    def __init__(self, all_patients, contour_type, context=1):
+
+        self.all_patients = all_patients
+        self.contour_type = contour_type
+        self.context = context
+
+        # padded float32 volumes per patient and (patient, slice) samples
+        self.images, self.masks, self.samples = [], [], []
+        for patient_idx, patient in enumerate(self.all_patients):
+            volume_dict = patient.to_volume(False)
+            pad = ((context, context), (0, 0), (0, 0))
+            self.images.append(np.pad(volume_dict['dicom_volume'].astype(np.float32),
+                                      pad, mode='edge'))
+            self.masks.append(volume_dict[f'{self.contour_type}_volume'].astype(np.float32))
+            valid = volume_dict[f'{self.contour_type}_valid'] & volume_dict['dicom_valid']
+            self.samples.extend((patient_idx, s) for s in np.nonzero(valid)[0].tolist())
+
+    def __getitem__(self, idx):
+        patient_idx, s = self.samples[idx]
+        # padded index s is the first slice of the window centered on s
+        img = self.images[patient_idx][s:s + 2 * self.context + 1]
+        msk = self.masks[patient_idx][s:s + 1]
+        return torch.from_numpy(img), torch.from_numpy(msk)
+
+    def __len__(self):
+        return len(self.samples)
+
+
+class HeartDataset3D(Dataset):
+    """
+    Create 3D dataset from given list of Patients, one sample per patient.
+    Returns image and mask volumes of shape (1, S, H, W) and a (S,) bool
+    vector marking slices which have the contour.
+
+    Inputs:
+        all_patients (list): list containing Patient objects
+        contour_type (str): either 'i_contour' or 'o_contour'
+    """
+    def __init__(self, all_patients, contour_type):
+
+        self.all_patients = all_patients
+        self.contour_type = contour_type
+
+        self.images, self.masks, self.valid = [], [], []
+        for patient in self.all_patients:
+            volume_dict = patient.to_volume(False)
+            self.images.append(volume_dict['dicom_volume'].astype(np.float32))
+            self.masks.append(volume_dict[f'{self.contour_type}_volume'].astype(np.float32))
+            self.valid.append(volume_dict[f'{self.contour_type}_valid'] &
+                              volume_dict['dicom_valid'])
+
+    def __getitem__(self, idx):
+        return (torch.from_numpy(self.images[idx])[None],
+                torch.from_numpy(self.masks[idx])[None],
+                torch.from_numpy(self.valid[idx]))
+
+    def __len__(self):
+        return len(self.images)
+
+
+def test_crop():
+    """unit test for crop_size, crops equal the full sample cropped"""
+    import tempfile
+    from .benchmarks import write_synthetic_cohort
+
+    with tempfile.TemporaryDirectory() as root:
+        patients = write_synthetic_cohort(root, n_patients=1, n_slices=4, size=64)
+        full = HeartDataset2D(patients, 'o_contour')
+        # crops smaller than the contour, at the image border and larger
+        # than the image
+        for crop_size in [(16, 16), (40, 24), (64, 64), (80, 80)]:
+            dataset = HeartDataset2D(patients, 'o_contour', crop_size=crop_size)
+            images, masks = dataset.get_batch(list(range(len(dataset))))
+            for idx in range(len(dataset)):
+                img, msk = full[idx]
+                polygon = parse_contour_array(full.dicom_contour_fnames[idx][1])
+                box = centered_box(polygon_bbox(polygon, img.shape[1:]), crop_size,
+                                   img.shape[1:])
+                expected_img = crop_array(img[0].numpy(), box)
+                expected_msk = crop_array(msk[0].numpy(), box)
+                crop_img, crop_msk = dataset[idx]
+                assert np.array_equal(crop_img[0].numpy(), expected_img)
+                assert np.array_equal(crop_msk[0].numpy(), expected_msk)
+                assert np.array_equal(images[idx, 0].numpy(), expected_img)
+                assert np.array_equal(masks[idx, 0].numpy(), expected_msk)
+    print("Test passed")
+
+
+def test_sources():
+    """unit test for HeartDataset2D sources, all give the same samples and batches"""
+    import os
+    import tempfile
+    from .archive import CohortArchive, write_archive
+    from .benchmarks import write_synthetic_cohort
+
+    with tempfile.TemporaryDirectory() as root:
+        patients = write_synthetic_cohort(root, n_patients=2, n_slices=4, size=32)
+        full = HeartDataset2D(patients, 'i_contour')
+        expected = [full[idx] for idx in range(len(full))]
+        assert len(expected) == 4 and full.slice_shapes() == [(32, 32)] * 4
+
+        archive_path = os.path.join(root, 'cohort.archive')
+        write_archive(archive_path, patients)
+        datasets = [HeartDataset2D(patients, 'i_contour', cache_dir=os.path.join(root, 'cache')),
+                    HeartDataset2D(None, 'i_contour', archive=CohortArchive(archive_path)),
+                    HeartDataset2D(patients, 'i_contour')]
+        for dataset in datasets:
+            sampler = PrefetchSampler(BucketBatchSampler(dataset.slice_shapes(), 3,
+                                                         shuffle=True), dataset, window=2)
+            for indices in sampler:
+                images, masks = dataset[indices]
+                assert images.shape == (len(indices), 1, 32, 32) and masks.dtype == torch.uint8
+                for k, idx in enumerate(indices):
+                    assert torch.equal(images[k], expected[idx][0])
+                    assert torch.equal(masks[k], expected[idx][1])
+            # only file backed samples are prefetched
+            assert (dataset.reader is not None) == (dataset is datasets[-1])
+            if dataset.reader is not None:
+                assert dataset.reader.metrics()['misses'] == 0
+            dataset.stop_prefetch()
+            for idx, (img, msk) in enumerate(expected):
+                assert torch.equal(dataset[idx][0], img) and torch.equal(dataset[idx][1], msk)
+    print("Test passed")
+
+
+def test_source_crops():
+    """unit test for crop_size with every source, crops centered on the same box"""
+    import os
+    import tempfile
+    from .archive import CohortArchive, write_archive
+    from .benchmarks import write_synthetic_cohort
+
+    with tempfile.TemporaryDirectory() as root:
+        patients = write_synthetic_cohort(root, n_patients=2, n_slices=4, size=64)
+        archive_path = os.path.join(root, 'cohort.archive')
+        write_archive(archive_path, patients)
+        for crop_size in [(15, 15), (40, 23), (80, 80)]:
+            files = HeartDataset2D(patients, 'o_contour', crop_size=crop_size)
+            expected = files.get_batch(list(range(len(files))))
+            for dataset in [HeartDataset2D(patients, 'o_contour', crop_size=crop_size,
+                                           cache_dir=os.path.join(root, 'cache')),
+                            HeartDataset2D(None, 'o_contour', crop_size=crop_size,
+                                           archive=CohortArchive(archive_path))]:
+                assert len(dataset) == len(files)
+                images, masks = dataset.get_batch(list(range(len(dataset))))
+                assert torch.equal(images, expected[0]) and torch.equal(masks, expected[1])
+                for idx in range(len(dataset)):
+                    img, msk = dataset[idx]
+                    assert torch.equal(img, expected[0][idx]) and torch.equal(msk, expected[1][idx])
+    print("Test passed")
+
+
+def test_prefetch_sampler_workers():
+    """unit test for PrefetchSampler, prefetching stops when DataLoader workers load samples"""
+    import tempfile
+    from torch.utils.data import DataLoader
+    from .benchmarks import write_synthetic_cohort
+
+    with tempfile.TemporaryDirectory() as root:
+        patients = write_synthetic_cohort(root, n_patients=2, n_slices=4, size=32)
+        dataset = HeartDataset2D(patients, 'o_contour')
+        expected = [dataset[idx] for idx in range(len(dataset))]
+        for num_workers in [0, 2]:
+            sampler = PrefetchSampler(BucketBatchSampler(dataset.slice_shapes(), 3,
+                                                         shuffle=True), dataset, window=2)
+            loader = DataLoader(dataset, sampler=sampler, batch_size=None,
+                                num_workers=num_workers)
+            for epoch in range(2):
+                sampler.set_epoch(epoch)
+                order = list(sampler.sampler)
+                for indices, (images, masks) in zip(order, loader):
+                    for k, idx in enumerate(indices):
+                        assert torch.equal(images[k], expected[idx][0])
+                        assert torch.equal(masks[k], expected[idx][1])
+                # the main process reads every file ahead only without workers
+                if num_workers == 0:
+                    assert dataset.reader.metrics()['reads'] == 2 * len(dataset)
+                    assert dataset.reader.metrics()['misses'] == 0
+                else:
+                    assert not sampler.prefetching and dataset.reader is None
+            dataset.stop_prefetch()
+    print("Test passed")
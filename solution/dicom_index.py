@@ -0,0 +1,187 @@
+import atexit
+import json
+import os
+import secrets
+import weakref
+from .parsing import parse_dicom_meta, read_dicom_pixels
+
+
+def file_stamp(fname):
+    """(mtime in ns, size) of a file, changes when it is rewritten"""
+    stat = os.stat(fname)
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+# persisted indexes with unsaved entries, saved when the interpreter exits
+_UNSAVED = weakref.WeakSet()
+
+
+@atexit.register
+def _save_at_exit():
+    for index in list(_UNSAVED):
+        index.save()
+
+
+class DicomIndex:
+    """
+    Index of DICOM header metadata, shape, dtype, rescale, spatial tags and
+    pixel data offset per file, see parse_dicom_meta. Headers are parsed
+    once, pixel reads then go straight to the pixel data and buffers can be
+    sized without touching the files. Optionally stored as JSON and
+    reparsed only for files which changed. The JSON is written once per
+    update batch, entries parsed by single lookups are written by the
+    next update, save or at exit.
+
+    Inputs:
+        index_path (str): JSON file to load from and save to, None keeps
+            the index in memory
+    """
+    def __init__(self, index_path=None):
+        self.index_path = str(index_path) if index_path is not None else None
+        self.entries = {}
+        self.changed = False
+        # files whose stamp was compared with the disk in this session
+        self._checked = set()
+        if self.index_path is not None and os.path.exists(self.index_path):
+            with open(self.index_path, 'r') as infile:
+                self.entries = {entry['fname']: entry for entry in json.load(infile)['files']}
+
+    def update(self, fnames, save=True):
+        """
+        Parse headers of new files and files changed since they were indexed
+
+        Inputs:
+            fnames (list): dicom file paths
+            save (bool): write the index if anything changed, else it is
+                only marked as changed
+        Return:
+            parsed (list): file paths whose headers were parsed
+        """
+        parsed = []
+        for fname in fnames:
+            fname = str(fname)
+            entry = self.entries.get(fname)
+            stamp = file_stamp(fname)
+            self._checked.add(fname)
+            if entry is None or entry['stamp'] != stamp:
+                meta = parse_dicom_meta(fname)
+                if meta is None:
+                    # a rewritten file may no longer be a valid dicom
+                    self.changed |= self.entries.pop(fname, None) is not None
+                    continue
+                meta['stamp'] = stamp
+                self.entries[fname] = meta
+                parsed.append(fname)
+                self.changed = True
+        if self.changed and self.index_path is not None:
+            if save:
+                self.save()
+            else:
+                _UNSAVED.add(self)
+        return parsed
+
+    def save(self):
+        """
+        Write index if anything changed, through a temporary file unique to
+        the process so readers never see a partial one and processes
+        sharing the index never write the same temporary file
+        """
+        if not self.changed or self.index_path is None:
+            return
+        tmp_path = f'{self.index_path}.{os.getpid()}.{secrets.token_hex(4)}.tmp'
+        with open(tmp_path, 'w') as outfile:
+            json.dump({'files': list(self.entries.values())}, outfile)
+        os.replace(tmp_path, self.index_path)
+        self.changed = False
+        _UNSAVED.discard(self)
+
+    def meta(self, fname):
+        """
+        Metadata of a file, its header is parsed if it is not indexed yet.
+        A persisted entry is checked against the file once per session and
+        reparsed if the file was rewritten since it was saved. The index is
+        not written here, see update.
+        """
+        fname = str(fname)
+        if fname not in self._checked:
+            self.update([fname], save=False)
+        return self.entries.get(fname)
+
+    def shape(self, fname):
+        """(rows, columns) of a file, None for invalid files"""
+        meta = self.meta(fname)
+        return tuple(meta['shape']) if meta is not None else None
+
+    def read(self, fname, dtype=None, rescale=True, out=None, data=None):
+        """
+        Pixels of a file, see read_dicom_pixels
+
+        Inputs:
+            fname (str): dicom file path
+            dtype (np.dtype): output dtype, defaults to the stored dtype or
+                float64 when rescaled
+            rescale (bool): apply rescale slope and intercept
+            out (np.array): optional (rows, columns) array to write into
+            data (bytes): optional prefetched bytes of the file
+        Return:
+            dcm_image (np.array): pixels, None for invalid files
+        """
+        meta = self.meta(fname)
+        if meta is None:
+            return None
+        return read_dicom_pixels(meta, dtype, rescale, out, data)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, fname):
+        return str(fname) in self.entries
+
+
+def test_dicom_index():
+    """unit test for DicomIndex, reads equal parsed pixels and follow rewritten files"""
+    import shutil
+    import tempfile
+    import numpy as np
+    from .benchmarks import write_synthetic_cohort
+    from .parsing import parse_dicom_file
+
+    with tempfile.TemporaryDirectory() as root:
+        patient = write_synthetic_cohort(root, n_patients=1, n_slices=3, size=32)[0]
+        patient.create_file_lists(False)
+        fnames = [str(fname) for fname in patient.dicoms]
+        index_path = os.path.join(root, 'dicom_index.json')
+        index = DicomIndex(index_path)
+        assert index.update(fnames) == fnames and index.update(fnames) == []
+        for fname in fnames:
+            expected = parse_dicom_file(fname)
+            assert index.shape(fname) == expected.shape
+            assert np.array_equal(index.read(fname), expected)
+            out = np.empty(expected.shape, dtype=np.float64)
+            with open(fname, 'rb') as infile:
+                assert index.read(fname, np.float64, out=out, data=infile.read()) is out
+            assert np.array_equal(out, expected)
+
+        # persisted entries are rechecked against rewritten files
+        shutil.copyfile(fnames[1], fnames[0])
+        index = DicomIndex(index_path)
+        assert len(index) == len(fnames)
+        assert np.array_equal(index.read(fnames[0]), parse_dicom_file(fnames[1]))
+        with open(fnames[2], 'wb') as outfile:
+            outfile.write(b'not a dicom')
+        assert index.read(fnames[2]) is None and fnames[2] not in index
+        # lookups only mark the index as changed, it is written once
+        assert index.changed and fnames[2] in DicomIndex(index_path)
+        index.save()
+        assert not index.changed and fnames[2] not in DicomIndex(index_path)
+        assert sorted(os.listdir(root)) == ['contourfiles', 'dicom_index.json', 'dicoms',
+                                            'link.csv']
+
+        # lookups of new files are saved at exit
+        index_path = os.path.join(root, 'lookups.json')
+        index = DicomIndex(index_path)
+        index.meta(fnames[1])
+        assert not os.path.exists(index_path) and index in _UNSAVED
+        _save_at_exit()
+        assert fnames[1] in DicomIndex(index_path)
+    print("Test passed")
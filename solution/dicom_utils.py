@@ -1,80 +1,15 @@
-import dicom
-from dicom.errors import InvalidDicomError
+import io
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import numpy as np
-from PIL import Image, ImageDraw
-
-
-def parse_dicom_file(filename):
-    """Parse the given DICOM filename
-
-    :param filename: filepath to the DICOM file to parse
-    :return: dictionary with DICOM image data
-    """
-
-    try:
-        # extract pixel array
-        dcm = dicom.read_file(filename)
-        dcm_image = dcm.pixel_array
-
-        # linear transformation from disk to memory representation
-        # do only if rescale and slope is not 0 else leave disk
-        try:
-            intercept = dcm.RescaleIntercept
-        except AttributeError:
-            intercept = 0.0
-        try:
-            slope = dcm.RescaleSlope
-        except AttributeError:
-            slope = 0.0
-        if intercept != 0.0 and slope != 0.0:
-            dcm_image = dcm_image * slope + intercept
-
-        # store in dict
-        # dcm_dict = {'pixel_data' : dcm_image}
-        # return dcm_dict
-
-        # CHANGE IN CODE
-        # we are returning only pixel array
-        # we don't need to create a dict for that
-        return dcm_image
-
-    except InvalidDicomError:
-        return None
-
-
-def parse_contour_file(filename):
-    """Parse the given contour filename
-
-    :param filename: filepath to the contourfile to parse
-    :return: list of tuples holding x, y coordinates of the contour
-    """
-
-    coords_lst = []
-    with open(filename, 'r') as infile:
-        for line in infile:
-            coords = line.strip().split()
-
-            x_coord = float(coords[0])
-            y_coord = float(coords[1])
-            coords_lst.append((x_coord, y_coord))
-    return coords_lst
-
-
-def poly_to_mask(polygon, width, height):
-    """Convert polygon to mask
-
-    :param polygon: list of pairs of x, y coords [(x1, y1), (x2, y2), ...]
-     in units of pixels
-    :param width: scalar image width
-    :param height: scalar image height
-    :return: Boolean mask of shape (height, width)
-    """
-
-    # https://stackoverflow.com/questions/3654289/scipy-create-2d-polygon-mask/3732128#3732128
-    img = Image.new(mode='L', size=(width, height), color=0)
-    ImageDraw.Draw(img).polygon(xy=polygon, outline=0, fill=1)
-    mask = np.array(img).astype(bool)
-    return mask
+from .parsing import (parse_dicom_file, parse_dicom_shape, parse_contour_file,
+                      poly_to_mask)
+from .contours import (parse_contour_array, sidecar_is_stale,
+                       write_contour_sidecar, read_contour_sidecar)
+from .lazy import LazySliceDict
+from .masks import PackedMask
+from .prefetch import PrefetchReader
+from .profiling import profiled
 
 
 def get_patient_files(patient_dicom_id, patient_contour_id,
@@ -167,6 +102,127 @@ def patient_files_dict(dicoms_dict, i_contours_dict, o_contours_dict):
     return patient_files_dict
 
 
+@profiled()
+def slice_arrays(dicom_fn, i_contour, o_contour, packed_masks=False):
+    """
+    Parse dicom and rasterize contours of a single slice
+
+    Inputs:
+        dicom_fn (str): dicom file path, file-like object or None
+        i_contour (str, np.array): i_contour file path, file-like object,
+            parsed contour or None
+        o_contour (str, np.array): o_contour file path, file-like object,
+            parsed contour or None
+        packed_masks (bool): store contour masks as bit-packed PackedMask
+    Return:
+        slice_dict (dict): np.array for dicom, i_contour and o_contour
+    """
+    # parse dicom
+    if dicom_fn is not None:
+        img_array = parse_dicom_file(dicom_fn)
+    else:
+        img_array = None
+
+    if img_array is not None:
+        # get image size
+        h, w = img_array.shape
+
+        # parse contours
+        contour_arrays = []
+        for contour in (i_contour, o_contour):
+            if contour is None:
+                contour_arrays.append(None)
+                continue
+            if not isinstance(contour, np.ndarray):
+                contour = parse_contour_array(contour)
+            mask = poly_to_mask(contour, w, h).view(np.uint8)
+            contour_arrays.append(PackedMask.from_dense(mask) if packed_masks else mask)
+        i_contour_array, o_contour_array = contour_arrays
+    else:
+        img_array, i_contour_array, o_contour_array = None, None, None
+
+    return {'dicom_array': img_array,
+            'i_contour_array': i_contour_array,
+            'o_contour_array': o_contour_array}
+
+
+def _slice_arrays(args):
+    return slice_arrays(*args)
+
+
+def _prefetched_tasks(tasks, reader):
+    """Tasks with file paths replaced by file-like objects of prefetched bytes"""
+    for task in tasks:
+        yield tuple(io.BytesIO(reader.get(arg)) if isinstance(arg, str) else arg
+                    for arg in task)
+
+
+def load_patients(patients, workers=None, backend='process', verbose=False,
+                  sidecar_dir=None, chunksize=4, packed_masks=False, prefetch=0):
+    """
+    Create all_numpy_dict of many patients in parallel. Slices of all
+    patients are spread over a pool of workers and results are stored
+    back into each patient's all_numpy_dict in slice order.
+
+    Inputs:
+        patients (list): list of Patient objects
+        workers (int): number of workers, defaults to number of cpus,
+            1 loads serially in this process
+        backend (str): either 'process' or 'thread'
+        verbose (bool): print file counts of patients
+        sidecar_dir (str): if given, contours are loaded from binary sidecars
+        chunksize (int): number of slices sent to a process at once
+        packed_masks (bool): store contour masks as bit-packed PackedMask
+        prefetch (int): if > 0 and workers is 1, files are read ahead in
+            slice order by a PrefetchReader with this many reads in flight
+            while slices are decoded, which hides storage latency
+    Return:
+        patients (list): same Patient objects
+    """
+    if backend not in ('process', 'thread'):
+        raise ValueError("backend must be either 'process' or 'thread'")
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    # file lists are cheap, create them here
+    tasks, keys = [], []
+    for patient in patients:
+        patient_tasks = patient.slice_tasks(verbose, sidecar_dir)
+        tasks.extend(task + (packed_masks,) for task in patient_tasks)
+        keys.extend((patient, slice_no) for slice_no in patient.all_files_dict)
+
+    executor, reader = None, None
+    try:
+        if workers == 1 and prefetch > 0:
+            reader = PrefetchReader([arg for task in tasks for arg in task
+                                     if isinstance(arg, str)], window=prefetch)
+            results = map(_slice_arrays, _prefetched_tasks(tasks, reader))
+        elif workers == 1:
+            results = map(_slice_arrays, tasks)
+        elif backend == 'process':
+            executor = ProcessPoolExecutor(max_workers=workers)
+            results = executor.map(_slice_arrays, tasks, chunksize=chunksize)
+        else:
+            executor = ThreadPoolExecutor(max_workers=workers)
+            results = executor.map(_slice_arrays, tasks)
+
+        # map returns results in task order
+        for patient in patients:
+            patient.all_numpy_dict = {}
+        for (patient, slice_no), slice_dict in zip(keys, results):
+            patient.all_numpy_dict[slice_no] = slice_dict
+    finally:
+        # workers and reader threads are stopped even if a slice fails
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+        if reader is not None:
+            reader.close()
+
+    if reader is not None and verbose:
+        print(f"prefetch : {reader.metrics()}")
+    return patients
+
+
 class Patient:
     def __init__(self, dicom_id, contour_id, dicoms_path, contourfiles_path):
         """
@@ -193,6 +249,13 @@ class Patient:
                               self.dicoms_path, self.contourfiles_path,
                               verbose)
 
+    def set_file_lists(self, dicoms, i_contours, o_contours):
+        """
+        Use given dicom, i_contour and o_contour file lists, e.g. from a
+        Catalog, instead of scanning patient directories
+        """
+        self.dicoms, self.i_contours, self.o_contours = dicoms, i_contours, o_contours
+
     def create_file_dicts(self, verbose=True):
         """
         Create ordered dicts for dicoms, i_contours, o_contours
@@ -208,44 +271,184 @@ class Patient:
                                                  self.i_contours_dict,
                                                  self.o_contours_dict)
 
-    def create_numpy_arrays(self, verbose=True):
+    def load_contours(self, sidecar_dir, verbose=True):
         """
-        Create ordered dict of dicts having np.array for dicom, i_contour and o_contour
+        Load all i_contours and o_contours of the patient in one read from
+        a binary sidecar under sidecar_dir. Sidecar is compiled first if it
+        is missing or stale.
+
+        sidecar_dir (str): directory for sidecar files, one per patient
         """
         if not hasattr(self, 'all_files_dict'):
             self.create_file_dicts(verbose)
 
-        self.all_numpy_dict = {}
+        sidecar_path = os.path.join(str(sidecar_dir), f'{self.dicom_id}.npz')
+        contour_fnames = {'i_contour': self.i_contours_dict,
+                          'o_contour': self.o_contours_dict}
+        if sidecar_is_stale(sidecar_path, contour_fnames):
+            write_contour_sidecar(sidecar_path, contour_fnames)
+        self.contours_dict = read_contour_sidecar(sidecar_path)
+
+    def slice_tasks(self, verbose=True, sidecar_dir=None):
+        """
+        Arguments of slice_arrays for every slice in slice order
+
+        sidecar_dir (str): if given, contours are loaded from binary sidecar
+            files under this directory instead of contour text files
+        """
+        if not hasattr(self, 'all_files_dict'):
+            self.create_file_dicts(verbose)
+        if sidecar_dir is not None:
+            self.load_contours(sidecar_dir, verbose)
+
+        tasks = []
         for slice_no in self.all_files_dict:
+            slice_dict = self.all_files_dict[slice_no]
+            contours = []
+            for contour_type in ('i_contour', 'o_contour'):
+                contour = slice_dict[f'{contour_type}_fname']
+                if contour is not None and sidecar_dir is not None:
+                    contour = self.contours_dict[contour_type][slice_no]
+                contours.append(contour)
+            tasks.append((slice_dict['dicom_fname'], *contours))
+        return tasks
+
+    def create_numpy_arrays(self, verbose=True, sidecar_dir=None, workers=1,
+                            backend='thread', lazy=False, lru=None, packed_masks=False,
+                            prefetch=0):
+        """
+        Create ordered dict of dicts having np.array for dicom, i_contour and o_contour
+
+        sidecar_dir (str): if given, contours are loaded from binary sidecar
+            files under this directory instead of contour text files
+        workers (int): number of workers to parse slices with, see load_patients
+        backend (str): either 'process' or 'thread'
+        lazy (bool): if True, all_numpy_dict is a LazySliceDict which parses
+            a slice on first access and keeps it in a byte limited LRU
+            shared by all patients
+        lru (ArrayLRU): LRU for lazy mode, defaults to lazy.SHARED_LRU
+        packed_masks (bool): store contour masks as bit-packed PackedMask,
+            8x smaller, extract_patient_arrays unpacks them on access
+        prefetch (int): read files ahead in slice order, see load_patients
+        """
+        if lazy:
+            tasks = [task + (packed_masks,) for task in self.slice_tasks(verbose, sidecar_dir)]
+            slice_nos = list(self.all_files_dict)
+            keys = {slice_no: tuple(self.all_files_dict[slice_no].values())
+                    for slice_no in slice_nos}
+            if packed_masks:
+                # packed and dense slices are cached under different keys
+                keys = {slice_no: key + ('packed',) for slice_no, key in keys.items()}
+            self.all_numpy_dict = LazySliceDict(dict(zip(slice_nos, tasks)),
+                                                slice_arrays, keys, lru)
+        else:
+            load_patients([self], workers, backend, verbose, sidecar_dir,
+                          packed_masks=packed_masks, prefetch=prefetch)
+
+    def load_archive(self, archive):
+        """
+        Load volumes of the patient from a CohortArchive instead of dicom
+        and contour files. all_numpy_dict holds views of the volumes.
 
-            dicom_fn = self.all_files_dict[slice_no]['dicom_fname']
-            i_contour_fn = self.all_files_dict[slice_no]['i_contour_fname']
-            o_contour_fn = self.all_files_dict[slice_no]['o_contour_fname']
-
-            # parse dicom
-            if dicom_fn is not None:
-                img_array = parse_dicom_file(dicom_fn)
-            else:
-                img_array = None
-
-            if img_array is not None:
-                # get image size
-                h, w = img_array.shape
-
-                # parse i_contour
-                if i_contour_fn is not None:
-                    i_contour_array = poly_to_mask(parse_contour_file(i_contour_fn), w, h).astype(np.uint8)
-                else:
-                    i_contour_array = None
-
-                # parse o_contour
-                if o_contour_fn is not None:
-                    o_contour_array = poly_to_mask(parse_contour_file(o_contour_fn), w, h).astype(np.uint8)
-                else:
-                    o_contour_array = None
-            else:
-                img_array, i_contour_array, o_contour_array = None, None, None
-
-            self.all_numpy_dict[slice_no] = {'dicom_array': img_array,
-                                             'i_contour_array': i_contour_array,
-                                             'o_contour_array': o_contour_array}
+        archive (CohortArchive): archive holding the patient
+        """
+        self.volume_dict = archive.read_volume(self.dicom_id)
+        positions = archive.slice_positions[self.dicom_id]
+        self.all_numpy_dict = {}
+        # same slice order as all_numpy_dict of files
+        for slice_no in archive.file_order(self.dicom_id):
+            i = positions[slice_no]
+            self.all_numpy_dict[slice_no] = {
+                f'{name}_array': self.volume_dict[f'{name}_volume'][i]
+                if self.volume_dict[f'{name}_valid'][i] else None
+                for name in ('dicom', 'i_contour', 'o_contour')}
+
+    @profiled('dicom_utils.to_volume')
+    def to_volume(self, verbose=True, sidecar_dir=None):
+        """
+        Stack all slices into contiguous (S, H, W) volumes ordered by slice
+        number. Slices without a contour get an empty mask and are marked
+        invalid in the validity vectors. Uses all_numpy_dict if it exists.
+
+        Inputs:
+            verbose (bool): print parsing errors
+            sidecar_dir (str): if given, contours are loaded from binary sidecars
+        Return:
+            volume_dict (dict): 'slice_nos' (S,), 'dicom_volume' (S, H, W),
+                'i_contour_volume', 'o_contour_volume' (S, H, W) uint8 and
+                'dicom_valid', 'i_contour_valid', 'o_contour_valid' (S,) bool
+        """
+        if hasattr(self, 'all_numpy_dict'):
+            slice_nos = sorted(self.all_numpy_dict)
+            slice_dicts = [self.all_numpy_dict[slice_no] for slice_no in slice_nos]
+        else:
+            tasks = self.slice_tasks(verbose, sidecar_dir)
+            slice_nos = list(self.all_files_dict)
+            order = np.argsort(slice_nos)
+            slice_nos = [slice_nos[i] for i in order]
+            slice_dicts = [slice_arrays(*tasks[i]) for i in order]
+
+        images = [o['dicom_array'] for o in slice_dicts if o['dicom_array'] is not None]
+        shapes = set(img.shape for img in images)
+        if len(shapes) > 1:
+            raise ValueError(f'slices of patient {self.dicom_id} have different shapes {shapes}')
+        h, w = shapes.pop() if shapes else (0, 0)
+        dtype = np.result_type(*images) if images else np.dtype(np.int16)
+
+        # allocate once and copy every slice into place
+        n = len(slice_nos)
+        volume_dict = {'slice_nos': np.array(slice_nos, dtype=np.int64),
+                       'dicom_volume': np.zeros((n, h, w), dtype=dtype),
+                       'i_contour_volume': np.zeros((n, h, w), dtype=np.uint8),
+                       'o_contour_volume': np.zeros((n, h, w), dtype=np.uint8)}
+        for name in ('dicom', 'i_contour', 'o_contour'):
+            volume = volume_dict[f'{name}_volume']
+            valid = np.zeros(n, dtype=bool)
+            for i, slice_dict in enumerate(slice_dicts):
+                if slice_dict[f'{name}_array'] is not None:
+                    volume[i] = slice_dict[f'{name}_array']
+                    valid[i] = True
+            volume_dict[f'{name}_valid'] = valid
+
+        self.volume_dict = volume_dict
+        return volume_dict
+
+
+def test_load_patients():
+    """unit test for load_patients, every backend gives the serial arrays"""
+    import tempfile
+    from pathlib import Path
+    from .benchmarks import write_synthetic_cohort
+
+    def fresh_patients(root):
+        return [Patient(f'SCD{p:05d}01', f'SC-HF-I-{p}', Path(root) / 'dicoms',
+                        Path(root) / 'contourfiles') for p in (1, 2)]
+
+    with tempfile.TemporaryDirectory() as root:
+        write_synthetic_cohort(root, n_patients=2, n_slices=4, size=32)
+        # a corrupt dicom has no arrays
+        with open(os.path.join(root, 'dicoms', 'SCD0000201', '2.dcm'), 'wb') as outfile:
+            outfile.write(b'not a dicom')
+        expected = load_patients(fresh_patients(root), workers=1)
+        assert expected[1].all_numpy_dict[2] == {'dicom_array': None, 'i_contour_array': None,
+                                                 'o_contour_array': None}
+
+        for kwargs in ({'workers': 2, 'backend': 'thread'}, {'workers': 2, 'backend': 'process'},
+                       {'workers': 1, 'prefetch': 2}, {'workers': 1, 'packed_masks': True},
+                       {'workers': 1, 'sidecar_dir': os.path.join(root, 'sidecars')}):
+            patients = load_patients(fresh_patients(root), **kwargs)
+            for patient, expected_patient in zip(patients, expected):
+                assert list(patient.all_numpy_dict) == list(expected_patient.all_numpy_dict)
+                for slice_no, slice_dict in expected_patient.all_numpy_dict.items():
+                    for name, array in slice_dict.items():
+                        loaded = patient.all_numpy_dict[slice_no][name]
+                        if array is None:
+                            assert loaded is None
+                        else:
+                            assert np.array_equal(np.asarray(loaded), array)
+        try:
+            load_patients(fresh_patients(root), backend='gpu')
+            assert False, 'ValueError expected'
+        except ValueError:
+            pass
+    print("Test passed")
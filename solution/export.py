@@ -0,0 +1,290 @@
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from PIL import Image
+from .dicom_utils import parse_dicom_file, poly_to_mask
+from .contours import parse_contour_array
+
+
+def colormap_lut(cmap):
+    """(256, 3) uint8 RGB lookup table of a matplotlib colormap"""
+    from matplotlib import colormaps
+    return (colormaps[cmap](np.linspace(0, 1, 256))[:, :3] * 255).round().astype(np.uint8)
+
+
+def render_overlay(img_array, msk_array, image_lut, mask_color, alpha=0.7):
+    """
+    Render image with mask alpha-blended on top, next to the plain image,
+    same layout as show_img_msk_fromarray but without a figure
+
+    Inputs:
+        img_array (np.array): (H, W) image
+        msk_array (np.array): (H, W) boolean mask
+        image_lut (np.array): (256, 3) uint8 colormap for the image
+        mask_color (np.array): (3,) RGB color of the mask
+        alpha (float): mask opacity
+    Return:
+        rgb (np.array): (H, 2 * W, 3) uint8 image
+    """
+    # scale to 0..255 over the image range like imshow does
+    lo, hi = img_array.min(), img_array.max()
+    scale = 255.0 / (hi - lo) if hi > lo else 0.0
+    # subtract in float, int16 differences can overflow
+    idx = (np.subtract(img_array, lo, dtype=np.float32) * scale).astype(np.uint8)
+
+    h, w = img_array.shape
+    rgb = np.empty((h, 2 * w, 3), dtype=np.uint8)
+    image_lut.take(idx, axis=0, out=rgb[:, w:])
+    rgb[:, :w] = rgb[:, w:]
+
+    overlay = rgb[:, :w]
+    mask = msk_array.astype(bool, copy=False)
+    blended = (1 - alpha) * overlay[mask] + alpha * np.asarray(mask_color, dtype=np.float64)
+    overlay[mask] = blended.round().astype(np.uint8)
+    return rgb
+
+
+def is_fresh(out_path, sources):
+    """True if out_path exists and is newer than every source file"""
+    if not os.path.exists(out_path):
+        return False
+    out_mtime = os.path.getmtime(out_path)
+    return all(os.path.getmtime(source) <= out_mtime for source in sources)
+
+
+def _export_slice(args):
+    """Parse a dicom once and write an overlay png for each contour type"""
+    dicom_fname, outputs, image_lut, mask_color, alpha, compress_level = args
+    img_array = parse_dicom_file(dicom_fname)
+    if img_array is None:
+        return 0
+    h, w = img_array.shape
+    for contour_type, (contour_fname, out_path) in outputs.items():
+        msk_array = poly_to_mask(parse_contour_array(contour_fname), w, h)
+        rgb = render_overlay(img_array, msk_array, image_lut, mask_color, alpha)
+        Image.fromarray(rgb).save(out_path, compress_level=compress_level)
+    return len(outputs)
+
+
+def _export_contact_sheet(args):
+    """Tile the overlay half of slice pngs of a patient into one png"""
+    png_paths, out_path, n_cols, stride, compress_level = args
+    tiles = []
+    for png_path in png_paths:
+        rgb = np.asarray(Image.open(png_path))
+        tiles.append(rgb[::stride, :rgb.shape[1] // 2:][:, ::stride])
+
+    tile_h = max(tile.shape[0] for tile in tiles)
+    tile_w = max(tile.shape[1] for tile in tiles)
+    n_cols = min(n_cols, len(tiles))
+    n_rows = math.ceil(len(tiles) / n_cols)
+    sheet = np.zeros((n_rows * tile_h, n_cols * tile_w, 3), dtype=np.uint8)
+    for k, tile in enumerate(tiles):
+        r, c = divmod(k, n_cols)
+        sheet[r * tile_h:r * tile_h + tile.shape[0],
+              c * tile_w:c * tile_w + tile.shape[1]] = tile
+    Image.fromarray(sheet).save(out_path, compress_level=compress_level)
+    return 1
+
+
+def _export_roi_densities(args):
+    """Histogram figure of o-contour ROI intensities of a patient's slices"""
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    patient_idx, slices, out_path, bins = args
+    n_rows = math.ceil(len(slices) / 3)
+    fig = Figure(figsize=(15, 2.5 * max(n_rows, 4)))
+    FigureCanvasAgg(fig)
+    fig.suptitle(f'Patient {patient_idx}', fontsize=20)
+    axes = fig.subplots(nrows=max(n_rows, 1), ncols=3, squeeze=False)
+    for ax, (slice_no, dicom_fname, o_contour_fname) in zip(axes.flat, slices):
+        img_array = parse_dicom_file(dicom_fname)
+        if img_array is None:
+            continue
+        h, w = img_array.shape
+        msk_array = poly_to_mask(parse_contour_array(o_contour_fname), w, h)
+        # pixels inside the o-contour, no full size product
+        roi = img_array[msk_array]
+        roi = roi[roi > 0]
+        if roi.size:
+            ax.hist(roi, bins=bins, density=True)
+        ax.set_title(f'ROI slice {slice_no}')
+        ax.set_xlabel('pixel intensity')
+    for ax in axes.flat[len(slices):]:
+        ax.set_visible(False)
+    fig.tight_layout(rect=[0, 0.03, 1, 0.95])
+    fig.savefig(out_path)
+    return 1
+
+
+def _run(func, tasks, workers):
+    """Map func over tasks serially or on a process pool, return sum of results"""
+    if workers == 1 or len(tasks) <= 1:
+        return sum(map(func, tasks))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return sum(executor.map(func, tasks, chunksize=max(1, len(tasks) // (4 * workers))))
+
+
+def export_images(all_patients, contour_types=('i_contour',), main_dir='final_data/images/',
+                  workers=None, overwrite=False, contact_sheets=True, alpha=0.7,
+                  image_cmap='viridis', mask_cmap='Wistia', n_cols=6, stride=2,
+                  compress_level=1):
+    """
+    Batch version of save_images. Overlays are rendered with NumPy and
+    written with PIL on a process pool, every slice is parsed once for all
+    contour types and slices whose png is newer than their dicom and contour
+    files are skipped. Files are written to the same places as save_images,
+    main_dir/{contour_type}/{dicom_id}/slice_{slice_no}.png, and contact
+    sheets to main_dir/{contour_type}/contact_sheets/{dicom_id}.png.
+
+    Inputs:
+        all_patients (list): list of Patient objects
+        contour_types (list): contour types to export
+        main_dir (str): output directory
+        workers (int): number of processes, defaults to number of cpus
+        overwrite (bool): write every png even if it is up to date
+        contact_sheets (bool): write a mosaic of all slices of each patient
+        alpha (float): mask opacity
+        image_cmap (str): matplotlib colormap for images
+        mask_cmap (str): matplotlib colormap for masks, its lowest color is used
+        n_cols (int): number of columns of contact sheets
+        stride (int): downsampling of contact sheet tiles
+        compress_level (int): png compression, 0-9
+    Return:
+        counts (dict): number of 'slices' and 'contact_sheets' written
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    image_lut = colormap_lut(image_cmap)
+    mask_color = colormap_lut(mask_cmap)[0]
+
+    slice_tasks, sheets = [], []
+    for patient in all_patients:
+        if not hasattr(patient, 'all_files_dict'):
+            patient.create_file_dicts(False)
+        for contour_type in contour_types:
+            os.makedirs(os.path.join(main_dir, contour_type, str(patient.dicom_id)),
+                        exist_ok=True)
+
+        patient_pngs = {contour_type: [] for contour_type in contour_types}
+        for slice_no in sorted(patient.all_files_dict):
+            slice_dict = patient.all_files_dict[slice_no]
+            dicom_fname = slice_dict['dicom_fname']
+            outputs = {}
+            for contour_type in contour_types:
+                contour_fname = slice_dict[f'{contour_type}_fname']
+                if dicom_fname is None or contour_fname is None:
+                    continue
+                out_path = os.path.join(main_dir, contour_type, str(patient.dicom_id),
+                                        f'slice_{slice_no}.png')
+                patient_pngs[contour_type].append(out_path)
+                if overwrite or not is_fresh(out_path, [dicom_fname, contour_fname]):
+                    outputs[contour_type] = (contour_fname, out_path)
+            if outputs:
+                slice_tasks.append((dicom_fname, outputs, image_lut, mask_color,
+                                    alpha, compress_level))
+        sheets.append((patient.dicom_id, patient_pngs))
+
+    counts = {'slices': _run(_export_slice, slice_tasks, workers)}
+
+    # contact sheets are tiled from the pngs written above
+    sheet_tasks = []
+    if contact_sheets:
+        for contour_type in contour_types:
+            os.makedirs(os.path.join(main_dir, contour_type, 'contact_sheets'), exist_ok=True)
+        for dicom_id, patient_pngs in sheets:
+            for contour_type, png_paths in patient_pngs.items():
+                png_paths = [p for p in png_paths if os.path.exists(p)]
+                out_path = os.path.join(main_dir, contour_type, 'contact_sheets',
+                                        f'{dicom_id}.png')
+                if png_paths and (overwrite or not is_fresh(out_path, png_paths)):
+                    sheet_tasks.append((png_paths, out_path, n_cols, stride, compress_level))
+    counts['contact_sheets'] = _run(_export_contact_sheet, sheet_tasks, workers)
+    return counts
+
+
+def export_roi_densities(all_patients, main_dir='final_data/images/roi_intensities/',
+                         workers=None, overwrite=False, bins=50):
+    """
+    Batch version of plot_roi_densities, one figure per patient with ROI
+    intensity histograms of every slice having both contours. Figures are
+    drawn headless with the Agg canvas on a process pool and patients whose
+    figure is newer than their files are skipped.
+
+    Inputs:
+        all_patients (list): list of Patient objects
+        main_dir (str): output directory, figures are saved as
+            patient_{i}.png with i the index in all_patients, the same
+            files plot_roi_densities writes in the analysis notebook
+        workers (int): number of processes, defaults to number of cpus
+        overwrite (bool): draw every figure even if it is up to date
+        bins (int): number of histogram bins
+    Return:
+        n_written (int): number of figures written
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    os.makedirs(main_dir, exist_ok=True)
+
+    tasks = []
+    for i, patient in enumerate(all_patients):
+        if not hasattr(patient, 'all_files_dict'):
+            patient.create_file_dicts(False)
+        slices = []
+        for slice_no in sorted(patient.all_files_dict):
+            slice_dict = patient.all_files_dict[slice_no]
+            fnames = [slice_dict[f'{name}_fname'] for name in ('dicom', 'i_contour', 'o_contour')]
+            if all(fname is not None for fname in fnames):
+                slices.append((slice_no, fnames[0], fnames[2]))
+        if not slices:
+            continue
+        out_path = os.path.join(main_dir, f'patient_{i}.png')
+        sources = [fname for _, dicom_fname, o_fname in slices for fname in (dicom_fname, o_fname)]
+        if overwrite or not is_fresh(out_path, sources):
+            tasks.append((i, slices, out_path, bins))
+    return _run(_export_roi_densities, tasks, workers)
+
+
+def test_export_images():
+    """unit test for export_images and export_roi_densities, layout and freshness"""
+    import tempfile
+    from .benchmarks import write_synthetic_cohort
+
+    with tempfile.TemporaryDirectory() as root:
+        patients = write_synthetic_cohort(root, n_patients=2, n_slices=4, size=32)
+        main_dir = os.path.join(root, 'images')
+        counts = export_images(patients, ('i_contour', 'o_contour'), main_dir, workers=1)
+        assert counts == {'slices': 2 * (2 + 4), 'contact_sheets': 2 * 2}
+
+        image_lut, mask_color = colormap_lut('viridis'), colormap_lut('Wistia')[0]
+        for patient in patients:
+            for slice_no, slice_dict in patient.all_files_dict.items():
+                out_path = os.path.join(main_dir, 'i_contour', patient.dicom_id,
+                                        f'slice_{slice_no}.png')
+                if slice_dict['i_contour_fname'] is None:
+                    assert not os.path.exists(out_path)
+                    continue
+                img_array = parse_dicom_file(slice_dict['dicom_fname'])
+                msk_array = poly_to_mask(parse_contour_array(slice_dict['i_contour_fname']),
+                                         32, 32)
+                rgb = render_overlay(img_array, msk_array, image_lut, mask_color)
+                assert np.array_equal(np.asarray(Image.open(out_path)), rgb)
+                # the overlay differs from the plain image only under the mask
+                changed = (rgb[:, :32] != rgb[:, 32:]).any(axis=2)
+                assert changed.any() and not changed[~msk_array].any()
+            assert os.path.exists(os.path.join(main_dir, 'o_contour', 'contact_sheets',
+                                               f'{patient.dicom_id}.png'))
+
+        # up to date pngs are skipped
+        assert export_images(patients, ('i_contour', 'o_contour'), main_dir,
+                             workers=1) == {'slices': 0, 'contact_sheets': 0}
+        assert export_images(patients, ('i_contour',), main_dir, workers=1,
+                             overwrite=True, contact_sheets=False)['slices'] == 2 * 2
+
+        roi_dir = os.path.join(root, 'roi_intensities')
+        assert export_roi_densities(patients, roi_dir, workers=1) == 2
+        assert sorted(os.listdir(roi_dir)) == ['patient_0.png', 'patient_1.png']
+        assert export_roi_densities(patients, roi_dir, workers=1) == 0
+    print("Test passed")
@@ -1,17 +1,63 @@
-import cv2
 import numpy as np
-from skimage import filters
+from .lazy import LazySliceDict
+from .masks import dense_mask
+from .profiling import profiled, stage
+from .roi import mask_bbox, clip_bbox, paste_array
 
-# define kernel types
+# define kernel types, values of cv2.MORPH_RECT, cv2.MORPH_ELLIPSE and
+# cv2.MORPH_CROSS so cv2 is only imported once morphology is run
 KERNEL_TYPE = [
-    cv2.MORPH_RECT,
-    cv2.MORPH_ELLIPSE,
-    cv2.MORPH_CROSS,
+    0,
+    2,
+    1,
 ]
 
+# structuring elements by (kernel_type, kernel_sz)
+_KERNELS = {}
 
+
+def get_kernel(kernel_type, kernel_sz):
+    """
+    Structuring element for morphological operations, created once
+    per (kernel_type, kernel_sz) and reused afterwards
+
+    Inputs:
+        kernel_type (int): index in KERNEL_TYPE
+        kernel_sz (int): kernel size
+    """
+    key = (kernel_type, kernel_sz)
+    if key not in _KERNELS:
+        import cv2
+        _KERNELS[key] = cv2.getStructuringElement(KERNEL_TYPE[kernel_type],
+                                                  (kernel_sz, kernel_sz))
+    return _KERNELS[key]
+
+
+def _kernel_args(kernel_type, kernel_sz):
+    """Split kernel arguments into (closing, opening) types and sizes"""
+    if isinstance(kernel_type, list) & isinstance(kernel_sz, list):
+        kernel_type1, kernel_type2 = kernel_type
+        kernel_sz1, kernel_sz2 = kernel_sz
+
+    elif isinstance(kernel_type, int) & isinstance(kernel_sz, int):
+        kernel_type1, kernel_type2 = kernel_type, kernel_type
+        kernel_sz1, kernel_sz2 = kernel_sz, kernel_sz
+    else:
+        raise Exception('kernel_type and kernel_sz must be both int or list')
+    return kernel_type1, kernel_type2, kernel_sz1, kernel_sz2
+
+
+def crop_margin(kernel_sz1, kernel_sz2):
+    """
+    Margin around the o-contour so closing then opening of a crop equals
+    the uncropped result, twice the largest kernel covers both operations
+    """
+    return 2 * max(kernel_sz1, kernel_sz2) + 1
+
+
+@profiled()
 def i_contour_from_o_contour(dicom_array, o_contour_array, threshold="auto",
-                             kernel_type=0, kernel_sz=3):
+                             kernel_type=0, kernel_sz=3, crop=True, bbox=None):
     """
     Generate i-contour given a o-contour array
     by employing thresholding and morphological
@@ -37,42 +83,281 @@ def i_contour_from_o_contour(dicom_array, o_contour_array, threshold="auto",
         kernel_size (int, list): kernel size for operations
             If list, it must have 2 elements:
             one for opening, one for closing
+
+        crop (bool): threshold and apply morphology only on the
+            o-contour bounding box plus crop_margin and paste the result
+            back, same result as the whole slice. Negative thresholds
+            select pixels outside the o-contour, those use the whole slice.
+
+        bbox (tuple): (r0, r1, c0, c1) o-contour bounding box, e.g. from
+            roi.polygon_bbox, computed from the mask if None
     Return:
         i_contour_proposal (np.array): Proposed boolean
         mask array for i-contour
     """
+    import cv2
+
     # pdb.set_trace()
 
-    if isinstance(kernel_type, list) & isinstance(kernel_sz, list):
-        kernel_type1, kernel_type2 = kernel_type
-        kernel_sz1, kernel_sz2 = kernel_sz
+    kernel_type1, kernel_type2, kernel_sz1, kernel_sz2 = _kernel_args(kernel_type, kernel_sz)
 
-    elif isinstance(kernel_type, int) & isinstance(kernel_sz, int):
-        kernel_type1, kernel_type2 = kernel_type, kernel_type
-        kernel_sz1, kernel_sz2 = kernel_sz, kernel_sz
-    else:
-        raise Exception('kernel_type and kernel_sz must be both int or list')
+    box = None
+    if crop:
+        margin = crop_margin(kernel_sz1, kernel_sz2)
+        if bbox is None:
+            box = mask_bbox(o_contour_array, margin)
+        else:
+            box = clip_bbox((bbox[0] - margin, bbox[1] + margin,
+                             bbox[2] - margin, bbox[3] + margin), dicom_array.shape)
+    o_contour_array = dense_mask(o_contour_array)
 
-    # generate proposal
-    roi_array = dicom_array * o_contour_array
+    # generate proposal, every o-contour pixel is inside the box
+    if box is not None:
+        r0, r1, c0, c1 = box
+        roi_array = dicom_array[r0:r1, c0:c1] * o_contour_array[r0:r1, c0:c1]
+    else:
+        roi_array = dicom_array * o_contour_array
     if threshold == "auto":
-        threshold = filters.threshold_otsu(roi_array[roi_array != 0])
+        from skimage.filters import threshold_otsu
+        threshold = threshold_otsu(roi_array[roi_array != 0])
+    if box is not None and threshold < 0:
+        box = None
+        roi_array = dicom_array * o_contour_array
     roi_i_contour_proposal = (roi_array > threshold).astype(np.uint8)
 
     # apply closing
-    kernel = cv2.getStructuringElement(KERNEL_TYPE[kernel_type1],
-                                       (kernel_sz1, kernel_sz1))
+    kernel = get_kernel(kernel_type1, kernel_sz1)
     roi_i_contour_proposal = cv2.morphologyEx(roi_i_contour_proposal,
                                               cv2.MORPH_CLOSE, kernel)
     # apply opening
-    kernel = cv2.getStructuringElement(KERNEL_TYPE[kernel_type2],
-                                       (kernel_sz2, kernel_sz2))
+    kernel = get_kernel(kernel_type2, kernel_sz2)
     roi_i_contour_proposal = cv2.morphologyEx(roi_i_contour_proposal,
                                               cv2.MORPH_OPEN, kernel)
 
+    if box is not None:
+        return paste_array(roi_i_contour_proposal, box, dicom_array.shape)
     return roi_i_contour_proposal
 
 
+def _slice_histograms(values, sizes, mins, maxs, nbins=256):
+    """
+    Histograms of many slices at once, binned like skimage.exposure.histogram:
+    one bin per integer value for integer images, nbins equal bins over the
+    slice range for float images. Rows are padded with empty bins.
+
+    Inputs:
+        values (np.array): (M,) pixel values of all slices, grouped by slice
+        sizes (np.array): (N,) number of values of each slice
+        mins (np.array): (N,) min value of each slice
+        maxs (np.array): (N,) max value of each slice
+        nbins (int): number of bins for float images
+    Return:
+        counts (np.array): (N, L) float32 counts
+        bin_centers (np.array): (N, L) bin centers
+        n_bins (np.array): (N,) number of valid bins of each slice
+    """
+    n_slices = len(sizes)
+    if np.issubdtype(values.dtype, np.integer):
+        mins, maxs = mins.astype(np.int64), maxs.astype(np.int64)
+        n_bins = maxs - mins + 1
+        length = int(n_bins.max())
+        # flat bin of a value is its row start plus value - slice min
+        offsets = np.arange(n_slices) * length - mins
+        flat_idx = values + np.repeat(offsets, sizes)
+        bin_centers = mins[:, None] + np.arange(length)
+    else:
+        # same bin edges and index corrections as np.histogram
+        values = values.astype(np.float64, copy=False)
+        first, last = mins.astype(np.float64), maxs.astype(np.float64)
+        same = first == last
+        first[same] -= 0.5
+        last[same] += 0.5
+        edges = np.linspace(first, last, nbins + 1, axis=1)
+        n_bins = np.full(n_slices, nbins)
+        length = nbins
+        slice_ids = np.repeat(np.arange(n_slices), sizes)
+        first, last = first[slice_ids], last[slice_ids]
+        bin_idx = ((values - first) / (last - first) * nbins).astype(np.intp)
+        bin_idx[bin_idx == nbins] -= 1
+        bin_idx[values < edges[slice_ids, bin_idx]] -= 1
+        bin_idx[(values >= edges[slice_ids, bin_idx + 1]) & (bin_idx != nbins - 1)] += 1
+        flat_idx = slice_ids * length + bin_idx
+        bin_centers = (edges[:, :-1] + edges[:, 1:]) / 2.0
+
+    counts = np.bincount(flat_idx, minlength=n_slices * length)
+    counts = counts.reshape(n_slices, length).astype(np.float32)
+    return counts, bin_centers, n_bins
+
+
+@profiled()
+def otsu_thresholds(dicom_arrays, o_contour_arrays, nbins=256):
+    """
+    Otsu threshold of the non zero o-contour region of every slice from
+    one vectorized histogram, same values as skimage.filters.threshold_otsu
+    on each slice. Slices with an empty region get nan.
+
+    Inputs:
+        dicom_arrays (np.array): (N, H, W) raw DICOM images
+        o_contour_arrays (np.array): (N, H, W) boolean masks for o-contour
+        nbins (int): number of bins for float images
+    Return:
+        thresholds (np.array): (N,) float64 thresholds
+    """
+    n_slices = len(dicom_arrays)
+    dicom_arrays = dicom_arrays.reshape(n_slices, -1)
+    roi = np.not_equal(dicom_arrays, 0)
+    np.logical_and(roi, o_contour_arrays.reshape(n_slices, -1), out=roi)
+    values = dicom_arrays[roi]
+
+    # values are grouped by slice, count_nonzero is much faster per row
+    # than with axis=1
+    sizes = np.array([np.count_nonzero(row) for row in roi], dtype=np.int64)
+    present = sizes > 0
+    starts = (np.cumsum(sizes) - sizes)[present]
+    mins = np.zeros(n_slices, dtype=values.dtype)
+    maxs = np.zeros(n_slices, dtype=values.dtype)
+    if present.any():
+        mins[present] = np.minimum.reduceat(values, starts)
+        maxs[present] = np.maximum.reduceat(values, starts)
+
+    counts, bin_centers, n_bins = _slice_histograms(values, sizes, mins, maxs, nbins)
+
+    # class probabilities and means for all possible thresholds
+    weight1 = np.cumsum(counts, axis=1)
+    weight2 = np.cumsum(counts[:, ::-1], axis=1)[:, ::-1]
+    weighted = counts * bin_centers
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean1 = np.cumsum(weighted, axis=1) / weight1
+        mean2 = (np.cumsum(weighted[:, ::-1], axis=1) / weight2[:, ::-1])[:, ::-1]
+        variance12 = weight1[:, :-1] * weight2[:, 1:] * (mean1[:, :-1] - mean2[:, 1:]) ** 2
+    # padded bins are never picked
+    variance12[np.arange(variance12.shape[1]) >= (n_bins - 1)[:, None]] = -np.inf
+    idx = np.argmax(variance12, axis=1) if variance12.shape[1] else np.zeros(n_slices, int)
+    thresholds = bin_centers[np.arange(n_slices), idx].astype(np.float64)
+
+    # a single valued region thresholds at its value, empty ones at nan
+    single = mins == maxs
+    thresholds[single] = mins[single]
+    thresholds[~present] = np.nan
+    return thresholds
+
+
+@profiled()
+def threshold_roi_batch(dicom_arrays, o_contour_arrays, threshold="auto", out=None):
+    """
+    Initial proposals of i_contour_from_o_contour_batch before morphology,
+    (dicom_arrays * o_contour_arrays) > threshold for every slice
+
+    Inputs:
+        dicom_arrays (np.array): (N, H, W) raw DICOM images
+        o_contour_arrays (np.array): (N, H, W) boolean masks for o-contour
+        threshold (int, np.array): scalar, one per slice or "auto"
+        out (np.array): optional (N, H, W) uint8 buffer for proposals
+    Return:
+        proposals (np.array): (N, H, W) uint8 thresholded proposals
+    """
+    if isinstance(threshold, str) and threshold == "auto":
+        threshold = otsu_thresholds(dicom_arrays, o_contour_arrays)
+    threshold = np.broadcast_to(np.asarray(threshold, dtype=np.float64), (len(dicom_arrays),))
+
+    if out is None:
+        out = np.empty(dicom_arrays.shape, dtype=np.uint8)
+    # roi > threshold without building roi, pixels outside the mask are 0
+    compare_threshold = threshold
+    if np.issubdtype(dicom_arrays.dtype, np.integer):
+        # img > t equals img > floor(t) for integer images, comparing in the
+        # image dtype avoids casting the whole stack to float
+        info = np.iinfo(dicom_arrays.dtype)
+        int_threshold = np.nan_to_num(np.floor(threshold), nan=info.max)
+        int_threshold = np.minimum(int_threshold, info.max)
+        if (int_threshold >= info.min).all():
+            compare_threshold = int_threshold.astype(dicom_arrays.dtype)
+
+    proposals = out.view(bool)
+    np.greater(dicom_arrays, compare_threshold[:, None, None], out=proposals)
+    np.logical_and(proposals, o_contour_arrays, out=proposals)
+    negative = threshold < 0
+    if negative.any():
+        proposals[negative] |= o_contour_arrays[negative] == 0
+    return out
+
+
+@profiled()
+def i_contour_from_o_contour_batch(dicom_arrays, o_contour_arrays, threshold="auto",
+                                   kernel_type=0, kernel_sz=3, out=None, crop=True):
+    """
+    Batched i_contour_from_o_contour over (N, H, W) stacks, e.g. a patient
+    volume from Patient.to_volume. Thresholds of all slices come from one
+    histogram pass, kernels are cached and proposals are written into out.
+    Slices with an empty o-contour region get an empty proposal.
+
+    Inputs:
+        dicom_arrays (np.array): (N, H, W) raw DICOM images
+
+        o_contour_arrays (np.array): (N, H, W) boolean mask
+            arrays for o-contour
+
+        threshold (int, np.array): threshold for i-contour
+            extraction, scalar or one per slice.
+            if "auto", thresholds will be estimated by OTSU
+
+        kernel_type (int, list): same as i_contour_from_o_contour
+
+        kernel_sz (int, list): same as i_contour_from_o_contour
+
+        out (np.array): optional (N, H, W) uint8 buffer for proposals
+
+        crop (bool): work on the bounding box of all o-contours of the
+            stack plus crop_margin, same as i_contour_from_o_contour
+    Return:
+        i_contour_proposals (np.array): (N, H, W) uint8 proposed
+        mask arrays for i-contour
+    """
+    _, _, kernel_sz1, kernel_sz2 = _kernel_args(kernel_type, kernel_sz)
+
+    if crop and len(dicom_arrays):
+        support = np.logical_or.reduce(o_contour_arrays, axis=0)
+        box = mask_bbox(support, crop_margin(kernel_sz1, kernel_sz2))
+        if box is not None:
+            r0, r1, c0, c1 = box
+            dicom_crops = np.ascontiguousarray(dicom_arrays[:, r0:r1, c0:c1])
+            o_contour_crops = np.ascontiguousarray(o_contour_arrays[:, r0:r1, c0:c1])
+            if isinstance(threshold, str) and threshold == "auto":
+                # o-contour pixels are all inside the box, thresholds are the same
+                threshold = otsu_thresholds(dicom_crops, o_contour_crops)
+            # negative thresholds select pixels outside the o-contour
+            if not (np.asarray(threshold) < 0).any():
+                proposals = _proposals_batch(dicom_crops, o_contour_crops, threshold,
+                                             kernel_type, kernel_sz)
+                if out is None:
+                    out = np.zeros(dicom_arrays.shape, dtype=np.uint8)
+                else:
+                    out[...] = 0
+                out[:, r0:r1, c0:c1] = proposals
+                return out
+    return _proposals_batch(dicom_arrays, o_contour_arrays, threshold,
+                            kernel_type, kernel_sz, out)
+
+
+def _proposals_batch(dicom_arrays, o_contour_arrays, threshold, kernel_type, kernel_sz,
+                     out=None):
+    """i_contour_from_o_contour_batch on whole slices"""
+    import cv2
+    kernel_type1, kernel_type2, kernel_sz1, kernel_sz2 = _kernel_args(kernel_type, kernel_sz)
+    kernel1 = get_kernel(kernel_type1, kernel_sz1)
+    kernel2 = get_kernel(kernel_type2, kernel_sz2)
+
+    out = threshold_roi_batch(dicom_arrays, o_contour_arrays, threshold, out)
+
+    # apply closing then opening on each slice through one scratch buffer
+    with stage('heuristics.morphology'):
+        closed = np.empty(dicom_arrays.shape[1:], dtype=np.uint8)
+        for proposal in out:
+            cv2.morphologyEx(proposal, cv2.MORPH_CLOSE, kernel1, dst=closed)
+            cv2.morphologyEx(closed, cv2.MORPH_OPEN, kernel2, dst=proposal)
+    return out
+
+
 def extract_all_mask_slices(patient):
     """
     For a given patient object exrtact slice idx
@@ -82,9 +367,13 @@ def extract_all_mask_slices(patient):
     Inputs:
         patient (Patient object): patient object
     """
-    # generate numpy arrays for the patient
+    # slices are parsed lazily, on first access
     if not hasattr(patient, "all_numpy_dict"):
-        patient.create_numpy_arrays(False)
+        patient.create_numpy_arrays(False, lazy=True)
+
+    # lazy arrays know which slices have contours without parsing them
+    if isinstance(patient.all_numpy_dict, LazySliceDict):
+        return patient.all_numpy_dict.slices_with(['i_contour', 'o_contour'])
 
     contour_slices = []
     for slice_no in patient.all_numpy_dict:
@@ -103,15 +392,44 @@ def extract_patient_arrays(patient, slice_idx):
         slice_idx (int): slice index for array extraction
     """
     dicom_array = patient.all_numpy_dict[slice_idx]['dicom_array']
-    i_contour_array = patient.all_numpy_dict[slice_idx]['i_contour_array']
-    o_contour_array = patient.all_numpy_dict[slice_idx]['o_contour_array']
+    # packed masks are unpacked here, only when arrays are needed
+    i_contour_array = dense_mask(patient.all_numpy_dict[slice_idx]['i_contour_array'])
+    o_contour_array = dense_mask(patient.all_numpy_dict[slice_idx]['o_contour_array'])
     return dicom_array, i_contour_array, o_contour_array
 
 
+def test_i_contour_from_o_contour():
+    """unit test for i-contour proposals, crops and batches equal whole slices"""
+    import tempfile
+    from skimage.filters import threshold_otsu
+    from .benchmarks import write_synthetic_cohort
+    from .roi import polygon_bbox
+    from .parsing import parse_contour_array
 
+    with tempfile.TemporaryDirectory() as root:
+        patient = write_synthetic_cohort(root, n_patients=1, n_slices=4, size=64)[0]
+        patient.create_numpy_arrays(False)
+        slice_nos = list(patient.all_numpy_dict)
+        dicom_arrays = np.stack([patient.all_numpy_dict[s]['dicom_array'] for s in slice_nos])
+        o_contour_arrays = np.stack([patient.all_numpy_dict[s]['o_contour_array']
+                                     for s in slice_nos])
 
+        thresholds = otsu_thresholds(dicom_arrays, o_contour_arrays)
+        for dicom_array, o_contour_array, threshold in zip(dicom_arrays, o_contour_arrays,
+                                                            thresholds):
+            roi_array = dicom_array * o_contour_array
+            assert threshold == threshold_otsu(roi_array[roi_array != 0])
 
-
-
-
-
+        for threshold, kernel_type, kernel_sz in (("auto", 0, 3), (450, [1, 2], [5, 3]),
+                                                  (-1, 2, 3)):
+            batch = i_contour_from_o_contour_batch(dicom_arrays, o_contour_arrays,
+                                                   threshold, kernel_type, kernel_sz)
+            for k, slice_no in enumerate(slice_nos):
+                args = (dicom_arrays[k], o_contour_arrays[k], threshold, kernel_type, kernel_sz)
+                expected = i_contour_from_o_contour(*args, crop=False)
+                assert np.array_equal(i_contour_from_o_contour(*args), expected)
+                fname = patient.all_files_dict[slice_no]['o_contour_fname']
+                bbox = polygon_bbox(parse_contour_array(fname), dicom_arrays[k].shape)
+                assert np.array_equal(i_contour_from_o_contour(*args, bbox=bbox), expected)
+                assert np.array_equal(batch[k], expected)
+    print("Test passed")
@@ -0,0 +1,217 @@
+import threading
+from collections import OrderedDict
+from collections.abc import Mapping
+from .parsing import parse_dicom_shape
+
+# default memory budget of the shared slice LRU
+DEFAULT_MAX_BYTES = 1024 ** 3
+
+
+def slice_nbytes(slice_dict):
+    """Total bytes of arrays in a slice dict"""
+    return sum(v.nbytes for v in slice_dict.values() if v is not None)
+
+
+class ArrayLRU:
+    """
+    Least recently used cache of slice dicts bounded by total array bytes.
+    A single instance is shared by all patients so memory stays within
+    max_bytes no matter how many studies are opened.
+
+    Inputs:
+        max_bytes (int): memory budget in bytes
+    """
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return cached value or None, marks key as recently used"""
+        with self._lock:
+            if key not in self._items:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._items.move_to_end(key)
+            return self._items[key][0]
+
+    def put(self, key, value, nbytes):
+        """Cache value and evict least recently used ones over budget"""
+        with self._lock:
+            if key in self._items:
+                self.nbytes -= self._items.pop(key)[1]
+            # a value larger than the budget is never cached
+            if nbytes > self.max_bytes:
+                return
+            self._items[key] = (value, nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                _, (_, evicted_nbytes) = self._items.popitem(last=False)
+                self.nbytes -= evicted_nbytes
+
+    def resize(self, max_bytes):
+        """Change memory budget, evicts right away if needed"""
+        with self._lock:
+            self.max_bytes = max_bytes
+            while self.nbytes > self.max_bytes:
+                _, (_, evicted_nbytes) = self._items.popitem(last=False)
+                self.nbytes -= evicted_nbytes
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.nbytes = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def __getstate__(self):
+        # workers start with an empty cache
+        state = self.__dict__.copy()
+        state['_items'] = OrderedDict()
+        state['nbytes'] = 0
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+
+SHARED_LRU = ArrayLRU()
+
+
+def set_cache_size(max_bytes):
+    """Set memory budget of the LRU shared by all patients"""
+    SHARED_LRU.resize(max_bytes)
+
+
+class LazySliceDict(Mapping):
+    """
+    Read only slice_no -> {'dicom_array', 'i_contour_array', 'o_contour_array'}
+    mapping which parses a slice on first access. Parsed slices live in a
+    byte limited LRU, so a slice may be parsed again after it is evicted.
+
+    Inputs:
+        tasks (dict): slice_no -> (dicom_fn, i_contour, o_contour) arguments
+            of slice_arrays, in slice order
+        loader (callable): function creating slice dict from task arguments
+        cache_keys (dict): slice_no -> hashable cache key, e.g. file names of the
+            slice, so the same slice is shared across Patient objects
+        lru (ArrayLRU): cache to use, defaults to SHARED_LRU
+    """
+    def __init__(self, tasks, loader, cache_keys, lru=None):
+        self.tasks = tasks
+        self.loader = loader
+        self.cache_keys = cache_keys
+        self.lru = SHARED_LRU if lru is None else lru
+        self._valid = {}
+
+    def __getitem__(self, slice_no):
+        key = self.cache_keys[slice_no]
+        slice_dict = self.lru.get(key)
+        if slice_dict is None:
+            slice_dict = self.loader(*self.tasks[slice_no])
+            self.lru.put(key, slice_dict, slice_nbytes(slice_dict))
+        return slice_dict
+
+    def __iter__(self):
+        return iter(self.tasks)
+
+    def __len__(self):
+        return len(self.tasks)
+
+    def __contains__(self, slice_no):
+        return slice_no in self.tasks
+
+    def dicom_is_valid(self, slice_no):
+        """
+        True if the dicom of a slice exists and parses, checked once from
+        its header, the eager dict has no arrays for invalid dicoms
+        """
+        if slice_no not in self._valid:
+            dicom_fn = self.tasks[slice_no][0]
+            self._valid[slice_no] = (dicom_fn is not None and
+                                     parse_dicom_shape(dicom_fn) is not None)
+        return self._valid[slice_no]
+
+    def slices_with(self, contour_types):
+        """
+        Slice numbers having a valid dicom and all given contour types,
+        same as filtering the eager dict on arrays which aren't None,
+        only dicom headers are read
+
+        Inputs:
+            contour_types (list): e.g. ['i_contour', 'o_contour']
+        """
+        positions = {'i_contour': 1, 'o_contour': 2}
+        return [slice_no for slice_no, task in self.tasks.items()
+                if all(task[positions[c]] is not None for c in contour_types) and
+                self.dicom_is_valid(slice_no)]
+
+
+def test_array_lru():
+    """unit test for ArrayLRU, bytes stay within budget and oldest go first"""
+    lru = ArrayLRU(max_bytes=10)
+    lru.put('a', 1, 4)
+    lru.put('b', 2, 4)
+    assert lru.get('a') == 1
+    # b is the least recently used
+    lru.put('c', 3, 4)
+    assert lru.get('b') is None and lru.get('a') == 1 and lru.get('c') == 3
+    assert lru.nbytes == 8 and len(lru) == 2
+    # values over budget are never cached
+    lru.put('d', 4, 11)
+    assert lru.get('d') is None and len(lru) == 2
+    lru.resize(4)
+    assert len(lru) == 1 and lru.get('c') == 3
+    assert (lru.hits, lru.misses) == (4, 2)
+    print("Test passed")
+
+
+def test_lazy_slice_dict():
+    """unit test for LazySliceDict, same slices as the eager dict"""
+    import tempfile
+    import numpy as np
+    from .benchmarks import write_synthetic_cohort
+
+    with tempfile.TemporaryDirectory() as root:
+        patient = write_synthetic_cohort(root, n_patients=1, n_slices=6, size=32)[0]
+        patient.create_file_dicts(False)
+        # a corrupt dicom has no arrays in either dict
+        broken_slice_no = list(patient.all_files_dict)[1]
+        with open(patient.all_files_dict[broken_slice_no]['dicom_fname'], 'wb') as outfile:
+            outfile.write(b'not a dicom')
+
+        patient.create_numpy_arrays(False)
+        eager = patient.all_numpy_dict
+        lru = ArrayLRU()
+        patient.create_numpy_arrays(False, lazy=True, lru=lru)
+        lazy = patient.all_numpy_dict
+        assert isinstance(lazy, LazySliceDict) and list(lazy) == list(eager)
+
+        for contour_types in (['i_contour'], ['o_contour'], ['i_contour', 'o_contour']):
+            expected = [slice_no for slice_no, slice_dict in eager.items()
+                        if slice_dict['dicom_array'] is not None and
+                        all(slice_dict[f'{c}_array'] is not None for c in contour_types)]
+            assert lazy.slices_with(contour_types) == expected
+        assert broken_slice_no not in lazy.slices_with([])
+        # slices_with reads headers only
+        assert len(lru) == 0
+
+        for slice_no in eager:
+            slice_dict = lazy[slice_no]
+            for name, array in eager[slice_no].items():
+                if array is None:
+                    assert slice_dict[name] is None
+                else:
+                    assert np.array_equal(slice_dict[name], array)
+        # every slice is parsed once and then served from the LRU
+        assert len(lru) == len(eager) and (lru.hits, lru.misses) == (0, len(eager))
+        assert lazy[broken_slice_no] is lazy[broken_slice_no]
+        assert (lru.hits, lru.misses) == (2, len(eager))
+    print("Test passed")
@@ -0,0 +1,223 @@
+import multiprocessing as mp
+import traceback
+from multiprocessing import shared_memory
+import numpy as np
+import torch
+from .dataset import BucketBatchSampler
+
+
+def _slot_arrays(buf, slot, slot_bytes, n, shape, image_dtype):
+    """
+    (images, masks) arrays of a batch living in slot of a shared buffer.
+    Images come first, masks right after them.
+
+    Inputs:
+        buf (memoryview): shared memory buffer
+        slot (int): slot index
+        slot_bytes (int): bytes reserved for every slot
+        n (int): number of samples
+        shape (tuple): (H, W) of samples
+        image_dtype (np.dtype): image dtype
+    """
+    h, w = shape
+    offset = slot * slot_bytes
+    images = np.ndarray((n, 1, h, w), dtype=image_dtype, buffer=buf, offset=offset)
+    masks = np.ndarray((n, 1, h, w), dtype=np.uint8, buffer=buf,
+                       offset=offset + images.nbytes)
+    return images, masks
+
+
+def _worker_loop(dataset, shm_name, slot_bytes, task_queue, result_queue):
+    """
+    Decode batches straight into shared memory slots until a None task.
+    Only (epoch, batch_no, slot, n, shape) goes back through the queue.
+    """
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        while True:
+            task = task_queue.get()
+            if task is None:
+                break
+            epoch, batch_no, slot, indices = task
+            try:
+                shape = dataset.batch_shape(indices)
+                images, masks = _slot_arrays(shm.buf, slot, slot_bytes, len(indices),
+                                             shape, dataset.image_dtype)
+                dataset.fill_batch(indices, images, masks)
+                del images, masks
+                result_queue.put((epoch, batch_no, slot, len(indices), shape, None))
+            except Exception:
+                result_queue.put((epoch, batch_no, slot, 0, None, traceback.format_exc()))
+    finally:
+        shm.close()
+
+
+class SharedMemoryLoader:
+    """
+    Batch loader for HeartDataset2D in which workers decode into a ring of
+    shared memory slots, one batch per slot. The main process wraps a slot
+    as tensors without any pickling or copy, only slot numbers go through
+    the queues. Workers are started once and reused across epochs.
+
+    Yielded tensors are views of a slot which is reused once the next
+    batch is requested, clone them to keep a batch around.
+
+    Inputs:
+        dataset (HeartDataset2D): dataset to load
+        batch_size (int): samples per batch
+        num_workers (int): number of worker processes, 0 loads in the
+            main process without shared memory
+        shuffle (bool): shuffle samples, see BucketBatchSampler
+        drop_last (bool): drop incomplete batches
+        n_slots (int): number of slots, defaults to 2 * num_workers + 1
+        sampler (Sampler): batch sampler, defaults to BucketBatchSampler
+        mp_context (str): multiprocessing start method, default of platform
+    """
+    def __init__(self, dataset, batch_size=8, num_workers=2, shuffle=False,
+                 drop_last=False, n_slots=None, sampler=None, mp_context=None):
+        self.dataset = dataset
+        self.num_workers = num_workers
+        self.n_slots = n_slots if n_slots is not None else 2 * num_workers + 1
+        if sampler is None:
+            sampler = BucketBatchSampler(dataset.slice_shapes(), batch_size,
+                                         shuffle, drop_last)
+        self.sampler = sampler
+        self.batch_size = max(len(batch) for batch in sampler) if len(sampler) else batch_size
+        self.mp_context = mp_context
+        self.epoch = 0
+        self.shm = None
+        self.workers = []
+        self._free_slots = list(range(self.n_slots))
+        self._held_slot = None
+
+    def _start(self):
+        """Create shared memory and start workers"""
+        max_hw = max(h * w for h, w in self.dataset.slice_shapes())
+        itemsize = self.dataset.image_dtype.itemsize + 1
+        self.slot_bytes = self.batch_size * max_hw * itemsize
+        self.shm = shared_memory.SharedMemory(create=True,
+                                              size=self.n_slots * self.slot_bytes)
+        ctx = mp.get_context(self.mp_context)
+        self.task_queue = ctx.Queue()
+        self.result_queue = ctx.Queue()
+        self.workers = [ctx.Process(target=_worker_loop, daemon=True,
+                                    args=(self.dataset, self.shm.name, self.slot_bytes,
+                                          self.task_queue, self.result_queue))
+                        for _ in range(self.num_workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def __iter__(self):
+        if self.num_workers == 0:
+            for indices in self.sampler:
+                yield self.dataset.get_batch(indices)
+            return
+
+        if self.shm is None:
+            self._start()
+        # a new epoch means the last batch of the previous one is done with
+        if self._held_slot is not None:
+            self._free_slots.append(self._held_slot)
+            self._held_slot = None
+        self.epoch += 1
+        epoch = self.epoch
+        batches = iter(list(self.sampler))
+        n_batches = len(self.sampler)
+        sent, done, ready = 0, 0, {}
+
+        try:
+            while done < n_batches:
+                # keep every free slot busy
+                while self._free_slots and sent < n_batches:
+                    self.task_queue.put((epoch, sent, self._free_slots.pop(), next(batches)))
+                    sent += 1
+
+                # results may arrive out of order, batches are yielded in order
+                while done not in ready:
+                    result_epoch, batch_no, slot, n, shape, error = self.result_queue.get()
+                    if result_epoch != epoch:
+                        # left over from an abandoned epoch
+                        self._free_slots.append(slot)
+                        continue
+                    if error is not None:
+                        self._free_slots.append(slot)
+                        raise RuntimeError(f'batch {batch_no} failed in worker:\n{error}')
+                    ready[batch_no] = (slot, n, shape)
+
+                slot, n, shape = ready.pop(done)
+                # the previous batch is done with once the next one is requested
+                if self._held_slot is not None:
+                    self._free_slots.append(self._held_slot)
+                self._held_slot = slot
+                images, masks = _slot_arrays(self.shm.buf, slot, self.slot_bytes, n,
+                                             shape, self.dataset.image_dtype)
+                done += 1
+                yield torch.from_numpy(images), torch.from_numpy(masks)
+        finally:
+            # slots of batches decoded but never yielded
+            self._free_slots.extend(slot for slot, _, _ in ready.values())
+
+    def __len__(self):
+        return len(self.sampler)
+
+    def close(self):
+        """Stop workers and free shared memory"""
+        for _ in self.workers:
+            self.task_queue.put(None)
+        for worker in self.workers:
+            worker.join(timeout=5)
+            if worker.is_alive():
+                worker.terminate()
+        self.workers = []
+        if self.shm is not None:
+            try:
+                self.shm.close()
+            except BufferError:
+                # tensors of the last batch are still alive, memory is
+                # freed when they are
+                pass
+            self.shm.unlink()
+            self.shm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __del__(self):
+        if self.shm is not None:
+            self.close()
+
+
+def test_shared_memory_loader():
+    """unit test for SharedMemoryLoader, same batches as get_batch in every epoch"""
+    import tempfile
+    from .benchmarks import write_synthetic_cohort
+    from .dataset import HeartDataset2D
+
+    with tempfile.TemporaryDirectory() as root:
+        patients = write_synthetic_cohort(root, n_patients=2, n_slices=5, size=32)
+        dataset = HeartDataset2D(patients, 'o_contour')
+        expected = [dataset.get_batch(indices)
+                    for indices in BucketBatchSampler(dataset.slice_shapes(), 3)]
+
+        with SharedMemoryLoader(dataset, batch_size=3, num_workers=2) as loader:
+            assert len(loader) == len(expected)
+            # an abandoned epoch doesn't leak into the next one
+            for _ in zip(range(1), loader):
+                pass
+            for _ in range(2):
+                n_batches = 0
+                for (images, masks), (expected_images, expected_masks) in zip(loader, expected):
+                    assert torch.equal(images, expected_images)
+                    assert torch.equal(masks, expected_masks)
+                    n_batches += 1
+                assert n_batches == len(expected)
+        assert loader.shm is None and not loader.workers
+
+        # without workers batches come straight from get_batch
+        loader = SharedMemoryLoader(dataset, batch_size=3, num_workers=0)
+        for (images, masks), (expected_images, expected_masks) in zip(loader, expected):
+            assert torch.equal(images, expected_images) and torch.equal(masks, expected_masks)
+    print("Test passed")
@@ -0,0 +1,380 @@
+import atexit
+import hashlib
+import json
+import os
+import secrets
+import weakref
+from collections import OrderedDict
+import numpy as np
+from .dicom_index import file_stamp
+from .masks import PackedMask
+from .profiling import stage
+
+# default disk budget of a memo directory
+DEFAULT_MAX_BYTES = 1024 ** 3
+DIGESTS_FNAME = 'digests.json'
+# bump when a memoized function changes, old results are never hit again
+MEMO_VERSION = 1
+
+# memos with unsaved digests, saved when the interpreter exits
+_UNSAVED = weakref.WeakSet()
+
+
+@atexit.register
+def _save_at_exit():
+    for memo in list(_UNSAVED):
+        memo.save()
+
+
+def content_digest(fname, chunk_size=1 << 20):
+    """Hex blake2b digest of a file content"""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(fname, 'rb') as infile:
+        for chunk in iter(lambda: infile.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _is_binary(value):
+    """bool arrays and 0/1 uint8 masks are stored bit-packed"""
+    if value.ndim != 2:
+        return False
+    if value.dtype == bool:
+        return True
+    return value.dtype == np.uint8 and (value.size == 0 or value.max() <= 1)
+
+
+class DiskMemo:
+    """
+    Content-addressed store of function results on disk. A result is keyed
+    on the content digests of its source files plus the function name and
+    parameters, so it is recomputed only when a file or a parameter
+    changes and results survive across sessions. Masks are stored
+    bit-packed and compressed. Total size is bounded by max_bytes, least
+    recently used results are evicted first.
+
+    Digests are cached per file by (mtime, size) stamp, files are rehashed
+    only after they are rewritten. New digests are written by save, once
+    per batch as in patient_proposals, or at exit.
+
+    Inputs:
+        memo_dir (str): directory of results, created if needed
+        max_bytes (int): disk budget in bytes
+    """
+    def __init__(self, memo_dir, max_bytes=DEFAULT_MAX_BYTES):
+        self.memo_dir = str(memo_dir)
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.memo_dir, exist_ok=True)
+
+        # results by last use, file mtimes are bumped on every hit
+        entries = []
+        for entry in os.scandir(self.memo_dir):
+            if entry.name.endswith('.npz'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime_ns, entry.name[:-4], stat.st_size))
+        self._items = OrderedDict()
+        for _, key, nbytes in sorted(entries):
+            self._items[key] = nbytes
+            self.nbytes += nbytes
+        self._evict()
+
+        self._digests = {}
+        self._digests_changed = False
+        digests_path = os.path.join(self.memo_dir, DIGESTS_FNAME)
+        if os.path.exists(digests_path):
+            with open(digests_path, 'r') as infile:
+                self._digests = json.load(infile)
+
+    def _path(self, key):
+        return os.path.join(self.memo_dir, f'{key}.npz')
+
+    def digest(self, fname):
+        """Content digest of a file, rehashed only if its stamp changed"""
+        fname = str(fname)
+        stamp = file_stamp(fname)
+        entry = self._digests.get(fname)
+        if entry is None or entry['stamp'] != stamp:
+            entry = self._digests[fname] = {'stamp': stamp, 'digest': content_digest(fname)}
+            self._digests_changed = True
+            _UNSAVED.add(self)
+        return entry['digest']
+
+    def key(self, name, fnames, params):
+        """
+        Key of a result
+
+        Inputs:
+            name (str): function name
+            fnames (list): source files of the result
+            params (dict): function parameters, must be JSON serializable
+        Return:
+            key (str): hex digest
+        """
+        payload = json.dumps([MEMO_VERSION, name, [self.digest(fname) for fname in fnames],
+                              params], sort_keys=True, default=str)
+        return hashlib.blake2b(payload.encode(), digest_size=16).hexdigest()
+
+    def get(self, key):
+        """Stored array or None, marks key as recently used"""
+        if key not in self._items:
+            self.misses += 1
+            return None
+        path = self._path(key)
+        try:
+            with stage('memo.load'), np.load(path) as stored:
+                if stored['packed']:
+                    value = PackedMask(stored['value'], stored['shape']).to_dense()
+                    value = value.astype(stored['dtype'].item(), copy=False)
+                else:
+                    value = stored['value']
+            os.utime(path)
+        except FileNotFoundError:
+            # evicted by another process sharing the directory
+            self.nbytes -= self._items.pop(key)
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._items.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        """Store an array and evict least recently used results over budget"""
+        value = np.asarray(value)
+        packed = _is_binary(value)
+        stored = PackedMask.from_dense(value).bits if packed else value
+        path = self._path(key)
+        # written through a temporary file so readers never see a partial one
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as outfile:
+            np.savez_compressed(outfile, value=stored, packed=packed,
+                                shape=np.array(value.shape), dtype=value.dtype.str)
+        os.replace(tmp_path, path)
+
+        if key in self._items:
+            self.nbytes -= self._items.pop(key)
+        self._items[key] = os.path.getsize(path)
+        self.nbytes += self._items[key]
+        self._evict()
+
+    def cached(self, name, fnames, params, compute):
+        """
+        Stored result of name(fnames, params), computed and stored on a miss
+
+        Inputs:
+            name (str): function name
+            fnames (list): source files of the result
+            params (dict): function parameters
+            compute (callable): called without arguments on a miss
+        Return:
+            value (np.array): result
+        """
+        key = self.key(name, fnames, params)
+        value = self.get(key)
+        if value is None:
+            value = compute()
+            self.put(key, value)
+        return value
+
+    def _evict(self):
+        while self.nbytes > self.max_bytes and self._items:
+            key, nbytes = self._items.popitem(last=False)
+            self.nbytes -= nbytes
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+    def resize(self, max_bytes):
+        """Change disk budget, evicts right away if needed"""
+        self.max_bytes = max_bytes
+        self._evict()
+
+    def save(self):
+        """
+        Write file digests if any changed, through a temporary file unique
+        to the process so memos sharing the directory never write the same
+        temporary file
+        """
+        if not self._digests_changed:
+            return
+        path = os.path.join(self.memo_dir, DIGESTS_FNAME)
+        tmp_path = f'{path}.{os.getpid()}.{secrets.token_hex(4)}.tmp'
+        with open(tmp_path, 'w') as outfile:
+            json.dump(self._digests, outfile)
+        os.replace(tmp_path, path)
+        self._digests_changed = False
+        _UNSAVED.discard(self)
+
+    def clear(self):
+        """Remove every stored result"""
+        for key in self._items:
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+        self._items.clear()
+        self.nbytes = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+
+def cached_mask(memo, contour_fname, width, height):
+    """
+    poly_to_mask of a contour file, memoized if memo is given
+
+    Inputs:
+        memo (DiskMemo): result store, None computes right away
+        contour_fname (str): contour file path
+        width (int): image width
+        height (int): image height
+    Return:
+        mask (np.array): (height, width) boolean mask
+    """
+    from .parsing import parse_contour_array, poly_to_mask
+
+    def compute():
+        return poly_to_mask(parse_contour_array(contour_fname), width, height)
+
+    if memo is None:
+        return compute()
+    return memo.cached('poly_to_mask', [contour_fname],
+                       {'width': width, 'height': height}, compute)
+
+
+def cached_proposal(memo, dicom_fname, o_contour_fname, threshold="auto",
+                    kernel_type=0, kernel_sz=3):
+    """
+    i_contour_from_o_contour of a dicom and its o-contour file, memoized
+    if memo is given. The o-contour mask is memoized as well.
+
+    Inputs:
+        memo (DiskMemo): result store, None computes right away
+        dicom_fname (str): dicom file path
+        o_contour_fname (str): o-contour file path
+        threshold, kernel_type, kernel_sz: see i_contour_from_o_contour
+    Return:
+        i_contour_proposal (np.array): proposed 0/1 uint8 mask
+    """
+    from .heuristics import i_contour_from_o_contour
+    from .parsing import parse_dicom_file
+
+    def compute():
+        dicom_array = parse_dicom_file(dicom_fname)
+        height, width = dicom_array.shape
+        o_contour_array = cached_mask(memo, o_contour_fname, width, height)
+        return i_contour_from_o_contour(dicom_array, o_contour_array, threshold,
+                                        kernel_type, kernel_sz)
+
+    if memo is None:
+        return compute()
+    params = {'threshold': threshold, 'kernel_type': kernel_type, 'kernel_sz': kernel_sz}
+    return memo.cached('i_contour_from_o_contour', [dicom_fname, o_contour_fname],
+                       params, compute)
+
+
+def patient_proposals(memo, patient, threshold="auto", kernel_type=0, kernel_sz=3):
+    """
+    Memoized i-contour proposals of every slice of a patient with an
+    o-contour, only slices whose files or parameters changed are computed.
+    File digests are saved once for the patient.
+
+    Inputs:
+        memo (DiskMemo): result store, None computes every proposal
+        patient (Patient): patient object
+        threshold, kernel_type, kernel_sz: see i_contour_from_o_contour
+    Return:
+        proposals (dict): {slice_no: i_contour_proposal}
+    """
+    if not hasattr(patient, 'all_files_dict'):
+        patient.create_file_dicts(False)
+
+    proposals = {}
+    for slice_no, slice_dict in patient.all_files_dict.items():
+        if slice_dict['o_contour_fname'] is not None:
+            proposals[slice_no] = cached_proposal(memo, slice_dict['dicom_fname'],
+                                                  slice_dict['o_contour_fname'],
+                                                  threshold, kernel_type, kernel_sz)
+    if memo is not None:
+        memo.save()
+    return proposals
+
+
+def test_disk_memo():
+    """unit test for DiskMemo, hits, invalidation on rewritten files and disk budget"""
+    import shutil
+    import tempfile
+    from .benchmarks import write_synthetic_cohort
+    from .heuristics import i_contour_from_o_contour
+    from .parsing import parse_dicom_file, parse_contour_array, poly_to_mask
+
+    with tempfile.TemporaryDirectory() as root:
+        patient = write_synthetic_cohort(root, n_patients=1, n_slices=4, size=32)[0]
+        memo_dir = os.path.join(root, 'memo')
+        memo = DiskMemo(memo_dir)
+        digests_path = os.path.join(memo_dir, DIGESTS_FNAME)
+        # digests are written once per batch, not per result
+        patient.create_file_dicts(False)
+        slice_dict = next(iter(patient.all_files_dict.values()))
+        cached_mask(memo, slice_dict['o_contour_fname'], 32, 32)
+        assert not os.path.exists(digests_path) and memo in _UNSAVED
+        _save_at_exit()
+        assert os.path.exists(digests_path) and memo not in _UNSAVED
+        memo.clear()
+        memo = DiskMemo(memo_dir)
+        proposals = patient_proposals(memo, patient)
+        assert (memo.hits, memo.misses) == (0, 2 * len(proposals))
+        assert not memo._digests_changed and memo not in _UNSAVED
+        assert not [fname for fname in os.listdir(memo_dir) if fname.endswith('.tmp')]
+        for slice_no, proposal in proposals.items():
+            slice_dict = patient.all_files_dict[slice_no]
+            dicom_array = parse_dicom_file(slice_dict['dicom_fname'])
+            o_contour_array = poly_to_mask(parse_contour_array(slice_dict['o_contour_fname']),
+                                           *dicom_array.shape[::-1])
+            expected = i_contour_from_o_contour(dicom_array, o_contour_array)
+            assert proposal.dtype == expected.dtype and np.array_equal(proposal, expected)
+
+        # results survive across sessions, other parameters are new results
+        memo = DiskMemo(memo_dir)
+        assert len(memo) == 2 * len(proposals)
+        for slice_no, proposal in patient_proposals(memo, patient).items():
+            assert np.array_equal(proposal, proposals[slice_no])
+        assert (memo.hits, memo.misses) == (len(proposals), 0)
+        patient_proposals(memo, patient, kernel_sz=5)
+        assert memo.misses == len(proposals)
+
+        # only results of a rewritten file are computed again
+        slice_nos = list(proposals)
+        slice_dict = patient.all_files_dict[slice_nos[0]]
+        shutil.copyfile(patient.all_files_dict[slice_nos[1]]['dicom_fname'],
+                        slice_dict['dicom_fname'])
+        memo = DiskMemo(memo_dir)
+        proposal = cached_proposal(memo, slice_dict['dicom_fname'], slice_dict['o_contour_fname'])
+        assert (memo.hits, memo.misses) == (1, 1)
+        memo.save()
+        assert DiskMemo(memo_dir).digest(slice_dict['dicom_fname']) == \
+            memo.digest(slice_dict['dicom_fname'])
+        dicom_array = parse_dicom_file(slice_dict['dicom_fname'])
+        assert np.array_equal(proposal, i_contour_from_o_contour(
+            dicom_array, cached_mask(None, slice_dict['o_contour_fname'], 32, 32)))
+
+        # least recently used results are evicted over budget
+        memo.put('a', np.arange(1000))
+        memo.put('b', np.zeros((32, 32), dtype=bool))
+        assert memo.get('b').dtype == bool
+        memo.resize(memo._items['a'] + memo._items['b'])
+        assert len(memo) == 2 and memo.get('a') is not None
+        memo.put('c', np.zeros((32, 32), dtype=bool))
+        assert 'b' not in memo and 'a' in memo and 'c' in memo
+        assert not os.path.exists(memo._path('b'))
+        # the budget holds for results of earlier sessions too
+        assert len(DiskMemo(memo_dir, max_bytes=memo.nbytes - 1)) == 1
+        DiskMemo(memo_dir).clear()
+        assert len(DiskMemo(memo_dir)) == 0
+    print("Test passed")
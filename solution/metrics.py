@@ -1,16 +1,224 @@
 import numpy as np
 
-def dice_score(pred, targ):
+def _as_bool(mask):
+    """View 0/1 uint8 masks as bool without a copy, cast anything else"""
+    mask = np.asarray(mask)
+    if mask.dtype == np.uint8 and mask.flags.c_contiguous:
+        return mask.view(bool)
+    return mask.astype(bool, copy=False)
+
+def _count(mask):
+    """
+    Number of foreground pixels of a (H, W) mask or of every sample of a
+    (N, H, W) batch. count_nonzero per sample is much faster than with axis
+    """
+    if mask.ndim == 2:
+        return np.count_nonzero(mask)
+    return np.array([np.count_nonzero(m) for m in mask], dtype=np.int64)
+
+def _ratio(num, den, empty_score):
+    """num / den with empty_score where den is 0, scalar or per sample"""
+    num = np.asarray(num, dtype=np.float64)
+    den = np.asarray(den, dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        score = np.where(den > 0, num / den, empty_score)
+    return score[()] if score.ndim == 0 else score
+
+def confusion_counts(pred, targ):
+    """
+    True positive, false positive and false negative pixel counts
+
+    pred (np.array): prediction boolean mask, (H, W) or (N, H, W)
+    targ (np.array): target boolean mask, same shape as pred
+    Return:
+        tp, fp, fn (int or np.array): counts, one per sample for batches
+    """
+    pred, targ = _as_bool(pred), _as_bool(targ)
+    tp = _count(pred & targ)
+    return tp, _count(pred) - tp, _count(targ) - tp
+
+def dice_score(pred, targ, empty_score=1.0):
     """
     Sorensen dice score:
     https://en.wikipedia.org/wiki/S%C3%B8rensen%E2%80%93Dice_coefficient
 
-    pred (np.array): prediction boolean mask
-    targ (np.array): target boolean mask
+    pred (np.array): prediction boolean mask, (H, W) or (N, H, W)
+    targ (np.array): target boolean mask, same shape as pred
+    empty_score (float): score when both masks are empty
+    Return:
+        score (float or np.array): one score per sample for batches
+    """
+    tp, fp, fn = confusion_counts(pred, targ)
+    return _ratio(2 * tp, 2 * tp + fp + fn, empty_score)
+
+def iou_score(pred, targ, empty_score=1.0):
+    """
+    Intersection over union (Jaccard index)
+
+    pred (np.array): prediction boolean mask, (H, W) or (N, H, W)
+    targ (np.array): target boolean mask, same shape as pred
+    empty_score (float): score when both masks are empty
+    Return:
+        score (float or np.array): one score per sample for batches
+    """
+    tp, fp, fn = confusion_counts(pred, targ)
+    return _ratio(tp, tp + fp + fn, empty_score)
+
+def precision_recall(pred, targ, empty_score=1.0):
     """
-    pred = pred.flatten()
-    targ = targ.flatten()
-    return 2 * sum(pred * targ) / (sum(pred) + sum(targ))
+    Pixel precision tp / (tp + fp) and recall tp / (tp + fn)
+
+    pred (np.array): prediction boolean mask, (H, W) or (N, H, W)
+    targ (np.array): target boolean mask, same shape as pred
+    empty_score (float): precision for an empty prediction,
+        recall for an empty target
+    Return:
+        precision, recall (float or np.array): one per sample for batches
+    """
+    tp, fp, fn = confusion_counts(pred, targ)
+    return _ratio(tp, tp + fp, empty_score), _ratio(tp, tp + fn, empty_score)
+
+def _surface(mask):
+    """Foreground pixels with a 4-connected background neighbour"""
+    from scipy import ndimage
+    return mask & ~ndimage.binary_erosion(mask, border_value=0)
+
+def _surface_distances(pred, targ, spacing):
+    """
+    Distances from pred surface pixels to the targ surface and back,
+    None if either mask is empty
+    """
+    from scipy import ndimage
+
+    pred_surface, targ_surface = _surface(pred), _surface(targ)
+    if not pred_surface.any() or not targ_surface.any():
+        return None
+    targ_dist = ndimage.distance_transform_edt(~targ_surface, sampling=spacing)
+    pred_dist = ndimage.distance_transform_edt(~pred_surface, sampling=spacing)
+    return targ_dist[pred_surface], pred_dist[targ_surface]
+
+def _surface_metric(pred, targ, spacing, reduce):
+    """
+    Apply reduce to surface distances of each sample. Both masks empty
+    gives 0, only one empty gives inf.
+    """
+    pred, targ = _as_bool(pred), _as_bool(targ)
+    single = pred.ndim == 2
+    if single:
+        pred, targ = pred[None], targ[None]
+
+    scores = np.empty(len(pred))
+    for k, (p, t) in enumerate(zip(pred, targ)):
+        distances = _surface_distances(p, t, spacing)
+        if distances is None:
+            scores[k] = 0.0 if not p.any() and not t.any() else np.inf
+        else:
+            scores[k] = reduce(*distances)
+    return scores[0] if single else scores
+
+def hausdorff_distance(pred, targ, spacing=None):
+    """
+    Symmetric Hausdorff distance between mask surfaces
+
+    pred (np.array): prediction boolean mask, (H, W) or (N, H, W)
+    targ (np.array): target boolean mask, same shape as pred
+    spacing (tuple): (row, col) pixel spacing, e.g. PixelSpacing in mm,
+        defaults to pixels
+    Return:
+        distance (float or np.array): one per sample for batches, 0 if both
+        masks are empty and inf if only one is
+    """
+    return _surface_metric(pred, targ, spacing,
+                           lambda d1, d2: max(d1.max(), d2.max()))
+
+def average_surface_distance(pred, targ, spacing=None):
+    """
+    Symmetric average surface distance, mean distance of the surface
+    pixels of each mask to the surface of the other mask
+
+    pred (np.array): prediction boolean mask, (H, W) or (N, H, W)
+    targ (np.array): target boolean mask, same shape as pred
+    spacing (tuple): (row, col) pixel spacing, defaults to pixels
+    Return:
+        distance (float or np.array): one per sample for batches, 0 if both
+        masks are empty and inf if only one is
+    """
+    return _surface_metric(pred, targ, spacing,
+                           lambda d1, d2: (d1.sum() + d2.sum()) / (len(d1) + len(d2)))
+
+class MetricAccumulator:
+    """
+    Streaming evaluation over batches of any size. Keeps per sample scores
+    and total confusion counts, so both the mean of per sample scores and
+    the pooled (micro) scores over all pixels are available. Accumulators
+    of separate workers can be merged.
+
+    Inputs:
+        surface (bool): also compute hausdorff and average surface distance
+        spacing (tuple): pixel spacing for surface distances
+        empty_score (float): score of samples with empty masks
+    """
+    def __init__(self, surface=False, spacing=None, empty_score=1.0):
+        self.surface = surface
+        self.spacing = spacing
+        self.empty_score = empty_score
+        self.tp = self.fp = self.fn = 0
+        self.scores = {'dice': [], 'iou': [], 'precision': [], 'recall': []}
+        if surface:
+            self.scores['hausdorff'] = []
+            self.scores['asd'] = []
+
+    def update(self, pred, targ):
+        """
+        Add a sample or a batch
+
+        pred (np.array): prediction boolean mask, (H, W) or (N, H, W)
+        targ (np.array): target boolean mask, same shape as pred
+        """
+        if np.ndim(pred) == 2:
+            pred, targ = np.asarray(pred)[None], np.asarray(targ)[None]
+        tp, fp, fn = confusion_counts(pred, targ)
+        self.tp += int(tp.sum())
+        self.fp += int(fp.sum())
+        self.fn += int(fn.sum())
+
+        empty = self.empty_score
+        self.scores['dice'].append(_ratio(2 * tp, 2 * tp + fp + fn, empty))
+        self.scores['iou'].append(_ratio(tp, tp + fp + fn, empty))
+        self.scores['precision'].append(_ratio(tp, tp + fp, empty))
+        self.scores['recall'].append(_ratio(tp, tp + fn, empty))
+        if self.surface:
+            self.scores['hausdorff'].append(hausdorff_distance(pred, targ, self.spacing))
+            self.scores['asd'].append(average_surface_distance(pred, targ, self.spacing))
+
+    def merge(self, other):
+        """Add counts and scores of another accumulator"""
+        self.tp += other.tp
+        self.fp += other.fp
+        self.fn += other.fn
+        for name in self.scores:
+            self.scores[name].extend(other.scores[name])
+        return self
+
+    def per_sample(self):
+        """Dict of per sample score arrays in update order"""
+        return {name: np.concatenate(values) if values else np.zeros(0)
+                for name, values in self.scores.items()}
+
+    def result(self):
+        """
+        Mean of per sample scores and pooled dice, iou, precision
+        and recall over all pixels seen
+        """
+        result = {f'mean_{name}': float(np.mean(values)) if len(values) else np.nan
+                  for name, values in self.per_sample().items()}
+        tp, fp, fn, empty = self.tp, self.fp, self.fn, self.empty_score
+        result['pooled_dice'] = float(_ratio(2 * tp, 2 * tp + fp + fn, empty))
+        result['pooled_iou'] = float(_ratio(tp, tp + fp + fn, empty))
+        result['pooled_precision'] = float(_ratio(tp, tp + fp, empty))
+        result['pooled_recall'] = float(_ratio(tp, tp + fn, empty))
+        result['n_samples'] = len(self.per_sample()['dice'])
+        return result
 
 def test_dice():
     """unit test for dice_score function"""
@@ -40,4 +248,111 @@ def test_dice():
 
     for pred, targ, ans in zip(preds, targs, answer):
         assert ans == dice_score(pred, targ)
-    print("Test passed")
\ No newline at end of file
+
+    # batches give the same per sample scores
+    assert np.array_equal(dice_score(np.stack(preds), np.stack(targs)), answer)
+
+    # empty masks
+    empty = np.zeros((3, 3))
+    assert dice_score(empty, empty) == 1.0
+    assert dice_score(preds[0], empty) == 0.0
+    print("Test passed")
+
+def _squares():
+    """Two 4x4 squares offset by 2 columns and the left half of the first"""
+    a = np.zeros((12, 12), dtype=np.uint8)
+    b = np.zeros((12, 12), dtype=np.uint8)
+    half = np.zeros((12, 12), dtype=np.uint8)
+    a[2:6, 2:6] = 1
+    b[2:6, 4:8] = 1
+    half[2:6, 2:4] = 1
+    return a, b, half
+
+
+def test_overlap_metrics():
+    """unit test for iou_score and precision_recall"""
+    a, b, half = _squares()
+    empty = np.zeros_like(a)
+
+    # 8 shared pixels out of 24, dice 16 / 32
+    assert iou_score(a, b) == 1 / 3
+    assert dice_score(a, b) == 0.5
+    assert precision_recall(a, b) == (0.5, 0.5)
+    assert iou_score(a, half) == 0.5
+    assert precision_recall(a, half) == (0.5, 1.0)
+    assert precision_recall(half, a) == (1.0, 0.5)
+
+    # empty masks
+    assert iou_score(empty, empty) == 1.0 and iou_score(empty, empty, empty_score=0.0) == 0.0
+    assert iou_score(a, empty) == 0.0 and iou_score(empty, a) == 0.0
+    assert precision_recall(empty, a) == (1.0, 0.0)
+    assert precision_recall(a, empty) == (0.0, 1.0)
+    assert precision_recall(empty, empty, empty_score=0.5) == (0.5, 0.5)
+
+    # batches give the same per sample scores
+    preds, targs = np.stack([a, a, empty]), np.stack([b, half, empty])
+    assert np.array_equal(iou_score(preds, targs), [1 / 3, 0.5, 1.0])
+    precision, recall = precision_recall(preds, targs)
+    assert np.array_equal(precision, [0.5, 0.5, 1.0]) and np.array_equal(recall, [0.5, 1.0, 1.0])
+    print("Test passed")
+
+
+def test_surface_metrics():
+    """unit test for hausdorff_distance and average_surface_distance"""
+    a, b, _ = _squares()
+    empty = np.zeros_like(a)
+
+    # left edge pixels of a are 2 columns from the surface of b and the
+    # 12 surface pixels of each square are on average 1 pixel away
+    assert hausdorff_distance(a, b) == 2.0
+    assert average_surface_distance(a, b) == 1.0
+    assert hausdorff_distance(a, a) == 0.0 and average_surface_distance(a, a) == 0.0
+    # columns half as wide as rows halve the distances
+    assert hausdorff_distance(a, b, spacing=(1.0, 0.5)) == 1.0
+    assert average_surface_distance(a, b, spacing=(1.0, 0.5)) == 0.5
+    assert hausdorff_distance(a, b, spacing=(2.0, 2.0)) == 4.0
+
+    # both masks empty give 0, only one empty gives inf
+    assert hausdorff_distance(empty, empty) == 0.0
+    assert average_surface_distance(a, empty) == np.inf
+    assert hausdorff_distance(empty, b) == np.inf
+    assert np.array_equal(hausdorff_distance(np.stack([a, a, empty]), np.stack([b, a, a])),
+                          [2.0, 0.0, np.inf])
+    print("Test passed")
+
+
+def test_metric_accumulator():
+    """unit test for MetricAccumulator, totals match per sample metrics"""
+    a, b, half = _squares()
+    empty = np.zeros_like(a)
+    preds, targs = [a, a, empty, half], [b, half, empty, a]
+
+    acc = MetricAccumulator(surface=True, spacing=(1.0, 0.5))
+    acc.update(np.stack(preds[:3]), np.stack(targs[:3]))
+    acc.update(preds[3], targs[3])
+    per_sample = acc.per_sample()
+    for name, metric in (('dice', dice_score), ('iou', iou_score)):
+        assert np.array_equal(per_sample[name], [metric(p, t) for p, t in zip(preds, targs)])
+    assert np.array_equal(per_sample['precision'],
+                          [precision_recall(p, t)[0] for p, t in zip(preds, targs)])
+    assert np.array_equal(per_sample['hausdorff'],
+                          [hausdorff_distance(p, t, (1.0, 0.5)) for p, t in zip(preds, targs)])
+
+    # pooled scores count pixels of all samples together
+    tp, fp, fn = (sum(counts) for counts in zip(*[confusion_counts(p, t)
+                                                   for p, t in zip(preds, targs)]))
+    assert (acc.tp, acc.fp, acc.fn) == (tp, fp, fn) == (24, 16, 16)
+    result = acc.result()
+    assert result['n_samples'] == 4
+    assert result['pooled_dice'] == 2 * tp / (2 * tp + fp + fn)
+    assert result['pooled_iou'] == tp / (tp + fp + fn)
+    assert result['mean_dice'] == np.mean(per_sample['dice'])
+
+    # accumulators of separate workers merge into the same totals
+    first, second = MetricAccumulator(surface=True, spacing=(1.0, 0.5)), \
+        MetricAccumulator(surface=True, spacing=(1.0, 0.5))
+    first.update(np.stack(preds[:2]), np.stack(targs[:2]))
+    second.update(np.stack(preds[2:]), np.stack(targs[2:]))
+    assert first.merge(second).result() == result
+    assert MetricAccumulator().result()['n_samples'] == 0
+    print("Test passed")
@@ -0,0 +1,365 @@
+"""Parsing core for DICOMS and contour files, shared by parsing.py and solution"""
+
+import io
+import os
+import numpy as np
+from PIL import Image, ImageDraw
+from .profiling import profiled
+
+# tags needed to decode pixel data and rescale it
+PIXEL_TAGS = ['SamplesPerPixel', 'PhotometricInterpretation', 'PlanarConfiguration',
+              'NumberOfFrames', 'Rows', 'Columns', 'BitsAllocated', 'BitsStored',
+              'HighBit', 'PixelRepresentation', 'RescaleIntercept', 'RescaleSlope',
+              'PixelData']
+# uncompressed transfer syntaxes: (byte order, explicit VR)
+NATIVE_SYNTAXES = {'1.2.840.10008.1.2': ('<', False),
+                   '1.2.840.10008.1.2.1': ('<', True),
+                   '1.2.840.10008.1.2.2': ('>', True)}
+PIXEL_DATA_TAG = b'\xe0\x7f\x10\x00'
+PIXEL_DATA_TAG_BE = b'\x7f\xe0\x00\x10'
+
+
+@profiled()
+def read_dicom(filename, pixels_only=False, stop_before_pixels=False):
+    """Read the given DICOM filename
+
+    :param filename: filepath to the DICOM file to parse or a file-like
+     object, e.g. io.BytesIO of prefetched bytes
+    :param pixels_only: only parse tags needed to decode pixels, readers
+     which can't skip tags parse every tag
+    :param stop_before_pixels: only read the header
+    :return: dicom dataset, None for invalid files
+    """
+    # imported on first read, contour parsing doesn't need dicom
+    import dicom
+    from dicom.errors import InvalidDicomError
+
+    try:
+        if pixels_only and not stop_before_pixels:
+            try:
+                return dicom.read_file(filename, specific_tags=PIXEL_TAGS)
+            except TypeError:
+                pass
+        return dicom.read_file(filename, stop_before_pixels=stop_before_pixels)
+    except InvalidDicomError:
+        return None
+
+
+def rescale_params(dcm):
+    """Rescale (slope, intercept) of a dataset, None if it is stored as is
+
+    Rescale is applied only if both slope and intercept are set and non zero
+    """
+    intercept = getattr(dcm, 'RescaleIntercept', 0.0)
+    slope = getattr(dcm, 'RescaleSlope', 0.0)
+    if intercept != 0.0 and slope != 0.0:
+        return float(slope), float(intercept)
+    return None
+
+
+@profiled(count_bytes=True)
+def rescale_pixels(dcm_image, params, dtype=None, out=None):
+    """Apply rescale (slope, intercept) to a pixel array in place
+
+    :param dcm_image: (rows, columns) stored pixel array
+    :param params: (slope, intercept) or None to keep stored values
+    :param dtype: output dtype, defaults to the stored dtype or float64
+     when rescaled
+    :param out: optional (rows, columns) array to write into, its dtype
+     overrides dtype
+    :return: (rows, columns) np.array, or out if it is given
+    """
+    if out is not None:
+        dtype = out.dtype
+
+    if params is None:
+        if out is not None:
+            np.copyto(out, dcm_image, casting='unsafe')
+            return out
+        return dcm_image if dtype is None else dcm_image.astype(dtype, copy=False)
+
+    # multiply into a single output and add the intercept in place,
+    # integer outputs are computed in float64 and cast
+    slope, intercept = params
+    work_dtype = dtype if dtype is not None and np.issubdtype(dtype, np.floating) else np.float64
+    if out is not None and out.dtype == work_dtype:
+        np.multiply(dcm_image, slope, out=out, casting='unsafe')
+        out += intercept
+        return out
+    result = np.multiply(dcm_image, slope, dtype=work_dtype)
+    result += intercept
+    if out is not None:
+        np.copyto(out, result, casting='unsafe')
+        return out
+    return result if dtype is None else result.astype(dtype, copy=False)
+
+
+def dicom_pixels(dcm, dtype=None, rescale=True, out=None):
+    """Pixel array of a dataset, rescaled in place
+
+    :param dcm: dicom dataset
+    :param dtype: output dtype, defaults to the stored dtype or float64
+     when rescaled
+    :param rescale: apply rescale slope and intercept, False decodes only
+    :param out: optional (rows, columns) array to write into, its dtype
+     overrides dtype
+    :return: (rows, columns) np.array, or out if it is given
+    """
+    params = rescale_params(dcm) if rescale else None
+    return rescale_pixels(_decode_pixels(dcm), params, dtype, out)
+
+
+@profiled('parsing.pixel_decode', count_bytes=True)
+def _decode_pixels(dcm):
+    return dcm.pixel_array
+
+
+def parse_dicom_array(filename, dtype=None, rescale=True, pixels_only=False, out=None):
+    """Parse the given DICOM filename into a pixel array
+
+    :param filename: filepath to the DICOM file to parse or a file-like object
+    :param dtype: output dtype, defaults to the stored dtype or float64
+     when rescaled
+    :param rescale: apply rescale slope and intercept, False decodes only
+    :param pixels_only: only parse tags needed to decode pixels
+    :param out: optional (rows, columns) array to write into
+    :return: (rows, columns) np.array, None for invalid files
+    """
+    dcm = read_dicom(filename, pixels_only=pixels_only)
+    if dcm is None:
+        return None
+    return dicom_pixels(dcm, dtype, rescale, out)
+
+
+def parse_dicom_file(filename):
+    """Parse the given DICOM filename
+
+    :param filename: filepath to the DICOM file to parse
+    :return: np.array with DICOM image data, None for invalid files
+    """
+    return parse_dicom_array(filename)
+
+
+def parse_dicom_shape(filename):
+    """Read image shape of the given DICOM filename from its header,
+    pixel data is not read
+
+    :param filename: filepath to the DICOM file to parse
+    :return: (rows, columns) tuple, None for invalid files
+    """
+    dcm = read_dicom(filename, stop_before_pixels=True)
+    if dcm is None:
+        return None
+    return int(dcm.Rows), int(dcm.Columns)
+
+
+def _pixel_offset(filename, nbytes, explicit_vr):
+    """Byte offset of native PixelData, the last element of the file,
+    None if the PixelData tag is not right before the last nbytes"""
+    header = 12 if explicit_vr else 8
+    with open(filename, 'rb') as infile:
+        infile.seek(0, os.SEEK_END)
+        offset = infile.tell() - nbytes
+        if offset < header:
+            return None
+        infile.seek(offset - header)
+        tag = infile.read(4)
+    if tag not in (PIXEL_DATA_TAG, PIXEL_DATA_TAG_BE):
+        return None
+    return offset
+
+
+@profiled()
+def parse_dicom_meta(filename):
+    """Read shape, dtype, rescale and spatial tags of the given DICOM
+    filename from its header, pixel data is not read
+
+    Uncompressed single frame images also get the byte offset of their
+    pixel data, so read_dicom_pixels can read it without parsing again.
+
+    :param filename: filepath to the DICOM file to parse
+    :return: dict with 'fname', 'shape', 'dtype', 'rescale',
+     'slice_location', 'image_position', 'pixel_spacing' and
+     'pixel_offset', None for invalid files
+    """
+    dcm = read_dicom(filename, stop_before_pixels=True)
+    if dcm is None:
+        return None
+    shape = [int(dcm.Rows), int(dcm.Columns)]
+    rescale = rescale_params(dcm)
+
+    def floats(keyword):
+        value = getattr(dcm, keyword, None)
+        return None if value is None else [float(v) for v in value]
+
+    slice_location = getattr(dcm, 'SliceLocation', None)
+    meta = {'fname': str(filename),
+            'shape': shape,
+            'dtype': None,
+            'rescale': list(rescale) if rescale is not None else None,
+            'slice_location': float(slice_location) if slice_location is not None else None,
+            'image_position': floats('ImagePositionPatient'),
+            'pixel_spacing': floats('PixelSpacing'),
+            'pixel_offset': None}
+
+    # direct reads only for native, single sample and frame, full bit depth
+    syntax = str(getattr(getattr(dcm, 'file_meta', None), 'TransferSyntaxUID', ''))
+    bits = int(getattr(dcm, 'BitsAllocated', 0))
+    signed = int(getattr(dcm, 'PixelRepresentation', 0)) == 1
+    if (syntax in NATIVE_SYNTAXES and bits in (8, 16, 32) and
+            int(getattr(dcm, 'SamplesPerPixel', 1)) == 1 and
+            int(getattr(dcm, 'NumberOfFrames', 1) or 1) == 1 and
+            (not signed or int(getattr(dcm, 'BitsStored', bits)) == bits)):
+        byteorder, explicit_vr = NATIVE_SYNTAXES[syntax]
+        dtype = np.dtype(f"{byteorder}{'i' if signed else 'u'}{bits // 8}")
+        meta['dtype'] = dtype.str
+        meta['pixel_offset'] = _pixel_offset(filename, shape[0] * shape[1] * dtype.itemsize,
+                                              explicit_vr)
+    return meta
+
+
+@profiled(count_bytes=True)
+def read_dicom_pixels(meta, dtype=None, rescale=True, out=None, data=None):
+    """Read pixels of a DICOM file described by parse_dicom_meta, straight
+    from its pixel data offset without parsing the header again. Files
+    without an offset are parsed.
+
+    :param meta: dict from parse_dicom_meta
+    :param dtype: output dtype, defaults to the stored dtype or float64
+     when rescaled
+    :param rescale: apply rescale slope and intercept, False decodes only
+    :param out: optional (rows, columns) array to write into
+    :param data: optional bytes of the whole file, e.g. from a
+     PrefetchReader, decoded instead of reading the file
+    :return: (rows, columns) np.array, or out if it is given
+    """
+    if meta['pixel_offset'] is None:
+        source = meta['fname'] if data is None else io.BytesIO(data)
+        return parse_dicom_array(source, dtype, rescale, out=out)
+
+    stored = np.dtype(meta['dtype'])
+    params = tuple(meta['rescale']) if rescale and meta['rescale'] else None
+    if data is not None:
+        dcm_image = np.frombuffer(data, dtype=stored, count=meta['shape'][0] * meta['shape'][1],
+                                  offset=meta['pixel_offset'])
+        if (params is None and out is None and stored.isnative and
+                (dtype is None or np.dtype(dtype) == stored)):
+            # nothing else copies the read only view of data
+            dcm_image = dcm_image.copy()
+        return _finish_pixels(dcm_image, meta, stored, params, dtype, out)
+    with open(meta['fname'], 'rb') as infile:
+        infile.seek(meta['pixel_offset'])
+        # read into out when no conversion is needed
+        if (params is None and out is not None and out.dtype == stored and
+                out.flags.c_contiguous):
+            infile.readinto(out)
+            return out
+        dcm_image = np.fromfile(infile, dtype=stored, count=meta['shape'][0] * meta['shape'][1])
+    return _finish_pixels(dcm_image, meta, stored, params, dtype, out)
+
+
+def _finish_pixels(dcm_image, meta, stored, params, dtype, out):
+    """Reshape, byteswap to native and rescale pixels read by read_dicom_pixels"""
+    dcm_image = dcm_image.reshape(meta['shape'])
+    if not stored.isnative:
+        dcm_image = dcm_image.astype(stored.newbyteorder('='))
+    return rescale_pixels(dcm_image, params, dtype, out)
+
+
+@profiled()
+def parse_contour_array(filename, dtype=np.float64):
+    """
+    Parse the given contour filename in a single call
+
+    Inputs:
+        filename (str): filepath to the contourfile to parse or a
+            file-like object, e.g. io.BytesIO of prefetched bytes
+        dtype (np.dtype): dtype of the coordinates, float32 halves memory
+            but rounds large coordinates, so masks may differ
+    Return:
+        coords (np.array): (N, 2) array holding x, y coordinates of the contour
+    """
+    if hasattr(filename, 'read'):
+        coords = np.array(filename.read().split(), dtype=dtype)
+    else:
+        with open(filename, 'r') as infile:
+            coords = np.array(infile.read().split(), dtype=dtype)
+    return coords.reshape(-1, 2)
+
+
+def parse_contour_file(filename):
+    """Parse the given contour filename
+
+    :param filename: filepath to the contourfile to parse
+    :return: list of tuples holding x, y coordinates of the contour
+    """
+    return [tuple(coords) for coords in parse_contour_array(filename).tolist()]
+
+
+@profiled(count_bytes=True)
+def poly_to_mask(polygon, width, height, out=None):
+    """Convert polygon to mask
+
+    :param polygon: list of pairs of x, y coords [(x1, y1), (x2, y2), ...]
+     or (N, 2) np.array in units of pixels
+    :param width: scalar image width
+    :param height: scalar image height
+    :param out: optional (height, width) bool or uint8 array to write into
+    :return: Boolean mask of shape (height, width), or out if it is given
+    """
+
+    # PIL reads a flat list of coords faster than an array
+    if isinstance(polygon, np.ndarray):
+        polygon = polygon.ravel().tolist()
+
+    # https://stackoverflow.com/questions/3654289/scipy-create-2d-polygon-mask/3732128#3732128
+    img = Image.new(mode='L', size=(width, height), color=0)
+    ImageDraw.Draw(img).polygon(xy=polygon, outline=0, fill=1)
+    if out is not None:
+        np.copyto(out, np.asarray(img), casting='unsafe')
+        return out
+    # pixels are 0 or 1, a bool view saves a copy
+    mask = np.array(img).view(bool)
+    return mask
+
+
+def test_parsing():
+    """unit test for direct pixel reads and contour parsing"""
+    import tempfile
+    from .benchmarks import write_synthetic_cohort
+
+    with tempfile.TemporaryDirectory() as root:
+        patient = write_synthetic_cohort(root, n_patients=1, n_slices=2, size=32)[0]
+        patient.create_file_dicts(False)
+        for slice_dict in patient.all_files_dict.values():
+            dicom_fname = slice_dict['dicom_fname']
+            meta = parse_dicom_meta(dicom_fname)
+            assert meta['shape'] == list(parse_dicom_shape(dicom_fname))
+            assert meta['pixel_offset'] is not None
+            with open(dicom_fname, 'rb') as infile:
+                data = infile.read()
+            for rescale in (True, False):
+                expected = parse_dicom_array(dicom_fname, rescale=rescale)
+                for source in (None, data):
+                    pixels = read_dicom_pixels(meta, rescale=rescale, data=source)
+                    assert pixels.dtype == expected.dtype
+                    assert np.array_equal(pixels, expected)
+                    out = np.empty(expected.shape, dtype=np.float32)
+                    assert read_dicom_pixels(meta, rescale=rescale, out=out, data=source) is out
+                    assert np.array_equal(out, expected.astype(np.float32))
+            assert np.array_equal(parse_dicom_file(io.BytesIO(data)), parse_dicom_file(dicom_fname))
+
+            contour_fname = slice_dict['o_contour_fname']
+            coords = parse_contour_array(contour_fname)
+            assert coords.dtype == np.float64
+            assert coords.tolist() == [list(xy) for xy in parse_contour_file(contour_fname)]
+            with open(contour_fname, 'rb') as infile:
+                assert np.array_equal(parse_contour_array(io.BytesIO(infile.read())), coords)
+            assert parse_contour_array(contour_fname, np.float32).dtype == np.float32
+
+            mask = poly_to_mask(coords, 32, 32)
+            assert mask.dtype == bool and np.array_equal(mask, poly_to_mask(coords.tolist(), 32, 32))
+            out = np.ones((32, 32), dtype=np.uint8)
+            assert poly_to_mask(coords, 32, 32, out=out) is out
+            assert np.array_equal(out, mask)
+    print("Test passed")
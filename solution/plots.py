@@ -1,8 +1,51 @@
 import os
-import matplotlib.pyplot as plt
-import seaborn as sns
 import numpy as np
 from .heuristics import extract_patient_arrays
+from .lazy import LazySliceDict
+from .masks import dense_mask
+
+# '1' draws on plain Agg figures which can only be saved, pyplot is never
+# imported, e.g. for batch jobs without a display
+HEADLESS_ENV_VAR = 'HEART_HEADLESS'
+
+_headless = os.environ.get(HEADLESS_ENV_VAR, '') not in ('', '0')
+
+
+def set_headless(headless=True):
+    """Turn headless mode on or off, see HEADLESS_ENV_VAR"""
+    global _headless
+    _headless = headless
+
+
+def _subplots(nrows=1, ncols=1, figsize=None, squeeze=True):
+    """(fig, axes) from pyplot, or a plain Agg figure in headless mode"""
+    if _headless:
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        from matplotlib.figure import Figure
+        fig = Figure(figsize=figsize)
+        FigureCanvasAgg(fig)
+        return fig, fig.subplots(nrows=nrows, ncols=ncols, squeeze=squeeze)
+    import matplotlib.pyplot as plt
+    return plt.subplots(nrows=nrows, ncols=ncols, figsize=figsize, squeeze=squeeze)
+
+
+def _finish(fig, save_path, block=False):
+    """
+    Save and close a figure, or show it when save_path is None. block uses
+    plt.show which waits for the window to close, else fig.show.
+    """
+    if save_path is not None:
+        fig.savefig(save_path)
+        if not _headless:
+            import matplotlib.pyplot as plt
+            plt.close(fig)
+    elif _headless:
+        raise ValueError('headless figures can only be saved, give save_path')
+    elif block:
+        import matplotlib.pyplot as plt
+        plt.show()
+    else:
+        fig.show()
 
 
 def show_img_msk_fromarray(img_arr, msk_arr, alpha=0.35, sz=7, cmap='inferno',
@@ -21,17 +64,11 @@ def show_img_msk_fromarray(img_arr, msk_arr, alpha=0.35, sz=7, cmap='inferno',
     """
 
     msk_arr = np.ma.masked_where(msk_arr == 0, msk_arr)
-    plt.figure(figsize=(sz, sz))
-    plt.subplot(1, 2, 1)
-    plt.imshow(img_arr)
-    plt.imshow(msk_arr, cmap=cmap, alpha=alpha)
-    plt.subplot(1, 2, 2)
-    plt.imshow(img_arr)
-    if save_path is None:
-        plt.show()
-    else:
-        plt.savefig(save_path)
-        plt.close()
+    fig, (ax1, ax2) = _subplots(1, 2, figsize=(sz, sz))
+    ax1.imshow(img_arr)
+    ax1.imshow(msk_arr, cmap=cmap, alpha=alpha)
+    ax2.imshow(img_arr)
+    _finish(fig, save_path, block=True)
 
 
 def save_images(all_patients, contour_type='i_contour',
@@ -55,18 +92,25 @@ def save_images(all_patients, contour_type='i_contour',
         dirname = main_dir + f'{contour_type}/{patient.dicom_id}/'
         os.makedirs(dirname, exist_ok=True)
 
-        # create numpy arrays for the patient
-        patient.create_numpy_arrays()
+        # arrays already loaded, e.g. by create_numpy_arrays or from an
+        # archive, are used as they are, else slices are parsed lazily and
+        # only the ones with given contour type
+        if not hasattr(patient, 'all_numpy_dict'):
+            patient.create_numpy_arrays(lazy=True)
+        if isinstance(patient.all_numpy_dict, LazySliceDict):
+            slice_nos = patient.all_numpy_dict.slices_with([contour_type])
+        else:
+            slice_nos = list(patient.all_numpy_dict)
 
         # loop over slices in numpy array dict
-        for slice_no in patient.all_numpy_dict:
+        for slice_no in slice_nos:
             slice_dict = patient.all_numpy_dict[slice_no]
 
             # only show image for given contour type
             if slice_dict[f'{contour_type}_array'] is not None:
 
                 img_array = slice_dict['dicom_array']
-                msk_array = slice_dict[f'{contour_type}_array']
+                msk_array = dense_mask(slice_dict[f'{contour_type}_array'])
 
                 show_img_msk_fromarray(img_array,
                                        msk_array,
@@ -75,27 +119,43 @@ def save_images(all_patients, contour_type='i_contour',
                                        save_path=dirname +f'slice_{slice_no}.png')
 
 
-def show_all_masks(dicom_array, i_contour_array, o_contour_array):
+def show_all_masks(dicom_array, i_contour_array, o_contour_array, save_path=None):
     sz = 30
     cmap="Wistia"
     alpha=0.5
-    plt.figure(figsize=(sz, sz))
+    fig, axes = _subplots(1, 3, figsize=(sz, sz))
 
     # raw image
-    plt.subplot(1, 3, 1)
-    plt.imshow(dicom_array)
+    axes[0].imshow(dicom_array)
 
     # i-contour
-    plt.subplot(1, 3, 2)
-    plt.imshow(dicom_array)
+    axes[1].imshow(dicom_array)
     mask_arr = np.ma.masked_where(i_contour_array == 0, i_contour_array)
-    plt.imshow(mask_arr, cmap=cmap, alpha=alpha)
+    axes[1].imshow(mask_arr, cmap=cmap, alpha=alpha)
 
     # o-contour
-    plt.subplot(1, 3, 3)
-    plt.imshow(dicom_array)
+    axes[2].imshow(dicom_array)
     mask_arr = np.ma.masked_where(o_contour_array == 0, o_contour_array)
-    plt.imshow(mask_arr, cmap=cmap, alpha=alpha)
+    axes[2].imshow(mask_arr, cmap=cmap, alpha=alpha)
+    # pyplot figures are left for notebooks to display once
+    if save_path is not None or _headless:
+        _finish(fig, save_path)
+
+def _density_plot(values, ax, bins=50):
+    """
+    Density histogram with a KDE line, seaborn.distplot which imports
+    pyplot, or the same drawn with scipy in headless mode
+    """
+    if not _headless:
+        import seaborn as sns
+        sns.distplot(values, bins=bins, ax=ax)
+        return
+    from scipy.stats import gaussian_kde
+    ax.hist(values, bins=bins, density=True, alpha=0.4)
+    if len(values) > 1 and values.min() < values.max():
+        grid = np.linspace(values.min(), values.max(), 200)
+        ax.plot(grid, gaussian_kde(values)(grid))
+
 
 def plot_roi_densities(patient, slice_idxs, patient_idx=0, save_path=None):
     """
@@ -109,8 +169,8 @@ def plot_roi_densities(patient, slice_idxs, patient_idx=0, save_path=None):
         save_path (str): file destination for saving the figure
     """
     # set subplots and title
-    fig, axes = plt.subplots(nrows=len(slice_idxs) // 3 +\
-                                   len(slice_idxs) % 3, ncols=3, figsize=(15, 10))
+    fig, axes = _subplots(nrows=len(slice_idxs) // 3 +\
+                                len(slice_idxs) % 3, ncols=3, figsize=(15, 10))
     fig.suptitle(f'Patient {patient_idx}', fontsize=20)
     # plot for all given slices
     for i, (ax, slice_idx) in enumerate(zip(axes.flat, slice_idxs)):
@@ -122,10 +182,66 @@ def plot_roi_densities(patient, slice_idxs, patient_idx=0, save_path=None):
         ax.set_title(f'ROI slice {slice_idx}')
         ax.set_xlabel('pixel intensity')
         # filter for roi and plot density
-        sns.distplot(roi_array.flatten()[roi_array.flatten() > 0], bins=50, ax=ax)
-    plt.tight_layout(rect=[0, 0.03, 1, 0.95])
-    if save_path is None:
-        fig.show()
-    else:
-        plt.savefig(save_path)
-        plt.close()
\ No newline at end of file
+        _density_plot(roi_array.flatten()[roi_array.flatten() > 0], ax)
+    fig.tight_layout(rect=[0, 0.03, 1, 0.95])
+    _finish(fig, save_path)
+
+def plot_roi_stats(table, dicom_id, regions=('blood_pool', 'myocardium'), save_path=None):
+    """
+    Plot ROI intensity histograms of a patient from a RoiStatsTable,
+    one subplot per slice and a line per region, without parsing dicoms.
+
+    Inputs:
+        table (RoiStatsTable): stats table, e.g. RoiStatsTable.load(path)
+        dicom_id (str): patient dicom id
+        regions (list): regions to plot
+        save_path (str): file destination for saving the figure
+    """
+    slice_nos = sorted(slice_no for slice_dicom_id, slice_no in table.slices
+                       if slice_dicom_id == dicom_id)
+    n_rows = max(int(np.ceil(len(slice_nos) / 3)), 1)
+    fig, axes = _subplots(nrows=n_rows, ncols=3, figsize=(15, 2.5 * max(n_rows, 4)),
+                          squeeze=False)
+    fig.suptitle(f'Patient {dicom_id}', fontsize=20)
+    for ax, slice_no in zip(axes.flat, slice_nos):
+        for region in regions:
+            stats = table.slices[dicom_id, slice_no][region]
+            if stats.count:
+                ax.stairs(stats.counts / (stats.count * stats.bin_width),
+                          stats.bin_edges(), label=region)
+        ax.set_title(f'ROI slice {slice_no}')
+        ax.set_xlabel('pixel intensity')
+        ax.legend()
+    for ax in axes.flat[len(slice_nos):]:
+        ax.set_visible(False)
+    fig.tight_layout(rect=[0, 0.03, 1, 0.95])
+    _finish(fig, save_path)
+
+
+def test_save_images():
+    """unit test for save_images and show_all_masks in headless mode"""
+    import tempfile
+    from .benchmarks import write_synthetic_cohort
+
+    headless = _headless
+    set_headless(True)
+    try:
+        with tempfile.TemporaryDirectory() as root:
+            patients = write_synthetic_cohort(root, n_patients=2, n_slices=4, size=32)
+            # loaded arrays are used as they are, others are parsed lazily
+            patients[0].create_numpy_arrays(False, packed_masks=True)
+            all_numpy_dict = patients[0].all_numpy_dict
+            main_dir = os.path.join(root, 'images') + '/'
+            save_images(patients, 'i_contour', main_dir)
+            assert patients[0].all_numpy_dict is all_numpy_dict
+            assert isinstance(patients[1].all_numpy_dict, LazySliceDict)
+            for patient in patients:
+                assert sorted(os.listdir(os.path.join(main_dir, 'i_contour', patient.dicom_id))) \
+                    == ['slice_2.png', 'slice_4.png']
+
+            save_path = os.path.join(root, 'masks.png')
+            assert show_all_masks(*extract_patient_arrays(patients[0], 2), save_path) is None
+            assert os.path.exists(save_path)
+    finally:
+        set_headless(headless)
+    print("Test passed")
@@ -0,0 +1,168 @@
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from . import profiling
+
+
+def read_bytes(fname):
+    """Whole file as bytes and seconds it took to read"""
+    start = time.perf_counter()
+    with open(fname, 'rb') as infile:
+        data = infile.read()
+    return data, time.perf_counter() - start
+
+
+class PrefetchReader:
+    """
+    Reads files ahead of a known access order on a thread pool and hands
+    back raw bytes for decoding, e.g. with io.BytesIO. At most window
+    files are read or waiting to be consumed at any time, so memory stays
+    bounded and reads overlap decoding and each other, which hides
+    latency of networked or cold storage.
+
+    Files are expected through get in the given order. A file requested
+    out of order, or not in the order at all, is read right away and
+    counted as a miss.
+
+    Inputs:
+        fnames (list): file paths in the order they will be requested,
+            repeated paths are read once per occurrence
+        window (int): maximum number of files in flight or buffered
+        workers (int): number of reader threads
+    """
+    def __init__(self, fnames, window=16, workers=4):
+        self.fnames = [str(fname) for fname in fnames]
+        self.window = max(window, 1)
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._futures = {}
+        self._outstanding = 0
+        self._next = 0
+        # consumer side metrics, updated only by the thread calling get
+        self.reads = 0
+        self.misses = 0
+        self.nbytes = 0
+        self.read_seconds = 0.0
+        self.max_read_seconds = 0.0
+        self.wait_seconds = 0.0
+        self._depth_sum = 0
+        self.max_depth = 0
+        self._fill()
+
+    def _fill(self):
+        """Submit reads until the window is full"""
+        while self._outstanding < self.window and self._next < len(self.fnames):
+            fname = self.fnames[self._next]
+            self._futures.setdefault(fname, deque()).append(
+                self._executor.submit(read_bytes, fname))
+            self._outstanding += 1
+            self._next += 1
+
+    def get(self, fname):
+        """
+        Bytes of a file, waits for its read if it is still in flight
+
+        Inputs:
+            fname (str): file path
+        Return:
+            data (bytes): file content
+        """
+        fname = str(fname)
+        futures = self._futures.get(fname)
+        depth = self._outstanding
+        if futures:
+            future = futures.popleft()
+            if not futures:
+                del self._futures[fname]
+            self._outstanding -= 1
+            start = time.perf_counter()
+            data, seconds = future.result()
+            wait = time.perf_counter() - start
+        else:
+            self.misses += 1
+            data, seconds = read_bytes(fname)
+            wait = seconds
+        self._fill()
+
+        self.reads += 1
+        self.nbytes += len(data)
+        self.read_seconds += seconds
+        self.max_read_seconds = max(self.max_read_seconds, seconds)
+        self.wait_seconds += wait
+        self._depth_sum += depth
+        self.max_depth = max(self.max_depth, depth)
+        if profiling.enabled():
+            profiling.record('prefetch.read', seconds, len(data))
+            profiling.record('prefetch.wait', wait)
+        return data
+
+    def __iter__(self):
+        """(fname, bytes) of the remaining files in order"""
+        while self._next < len(self.fnames) or self._outstanding:
+            # the oldest outstanding read comes next
+            fname = self.fnames[self._next - self._outstanding]
+            yield fname, self.get(fname)
+
+    def metrics(self):
+        """
+        Reader metrics so far
+
+        Return:
+            metrics (dict): reads, misses, bytes, mean and max read
+                latency, total consumer wait and mean and max queue depth,
+                the number of reads in flight or buffered when a file was
+                requested
+        """
+        return {'reads': self.reads,
+                'misses': self.misses,
+                'bytes': self.nbytes,
+                'mean_read_seconds': self.read_seconds / self.reads if self.reads else 0.0,
+                'max_read_seconds': self.max_read_seconds,
+                'wait_seconds': self.wait_seconds,
+                'mean_depth': self._depth_sum / self.reads if self.reads else 0.0,
+                'max_depth': self.max_depth}
+
+    def close(self):
+        """Cancel reads not started yet and stop the threads"""
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        self._futures.clear()
+        self._outstanding = 0
+        self._next = len(self.fnames)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def test_prefetch_reader():
+    """unit test for PrefetchReader, same bytes as plain reads in any order"""
+    import os
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as root:
+        fnames = []
+        for i in range(6):
+            fnames.append(os.path.join(root, f'{i}.bin'))
+            with open(fnames[-1], 'wb') as outfile:
+                outfile.write(bytes([i]) * (i + 1))
+        expected = {fname: read_bytes(fname)[0] for fname in fnames}
+
+        # repeated files are read once per occurrence
+        order = fnames + fnames[:2]
+        with PrefetchReader(order, window=3, workers=2) as reader:
+            assert [reader.get(fname) for fname in order] == [expected[f] for f in order]
+            metrics = reader.metrics()
+        assert metrics['reads'] == len(order) and metrics['misses'] == 0
+        assert metrics['bytes'] == sum(len(expected[f]) for f in order)
+        assert metrics['max_depth'] <= 3
+
+        # out of order requests are read right away and counted as misses
+        with PrefetchReader(fnames[:3], window=1) as reader:
+            assert reader.get(fnames[4]) == expected[fnames[4]]
+            assert reader.get(fnames[0]) == expected[fnames[0]]
+            assert reader.metrics()['misses'] == 1
+            assert list(reader) == [(fname, expected[fname]) for fname in fnames[1:3]]
+            assert reader.get(fnames[0]) == expected[fnames[0]]
+            assert reader.metrics()['misses'] == 2
+    print("Test passed")
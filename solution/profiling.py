@@ -0,0 +1,318 @@
+import contextlib
+import functools
+import glob
+import json
+import os
+import threading
+import time
+from multiprocessing import util
+
+# '1' enables profiling in this process and every worker started from it
+ENV_VAR = 'HEART_PROFILE'
+# directory in which every process dumps its stats when it exits
+DIR_ENV_VAR = 'HEART_PROFILE_DIR'
+
+_enabled = os.environ.get(ENV_VAR, '') not in ('', '0')
+_dump_dir = os.environ.get(DIR_ENV_VAR) or None
+# stage -> [calls, seconds, max seconds, bytes]
+_stats = {}
+_lock = threading.Lock()
+_NULL_STAGE = contextlib.nullcontext()
+
+
+def enabled():
+    return _enabled
+
+
+def enable(dump_dir=None):
+    """
+    Start recording stages. The environment variables are set as well, so
+    workers started afterwards with any start method record too.
+
+    Inputs:
+        dump_dir (str): if given, every process writes its stats there
+            when it exits, see collect
+    """
+    global _enabled, _dump_dir
+    _enabled = True
+    os.environ[ENV_VAR] = '1'
+    if dump_dir is not None:
+        _dump_dir = str(dump_dir)
+        os.makedirs(_dump_dir, exist_ok=True)
+        os.environ[DIR_ENV_VAR] = _dump_dir
+
+
+def disable():
+    """Stop recording, stats recorded so far are kept"""
+    global _enabled, _dump_dir
+    _enabled = False
+    _dump_dir = None
+    os.environ.pop(ENV_VAR, None)
+    os.environ.pop(DIR_ENV_VAR, None)
+
+
+@contextlib.contextmanager
+def profiling(dump_dir=None, reset=True):
+    """
+    Record stages inside the block, e.g.
+
+        with profiling('profile'):
+            for images, masks in loader:
+                ...
+        report(collect('profile'))
+
+    Inputs:
+        dump_dir (str): directory for stats of worker processes
+        reset (bool): clear stats of this process first
+    """
+    previous = _enabled, _dump_dir
+    if reset:
+        clear()
+    enable(dump_dir)
+    try:
+        yield
+    finally:
+        if previous[0]:
+            enable(previous[1])
+        else:
+            disable()
+
+
+def record(name, seconds, nbytes=0):
+    """Add a call of a stage"""
+    with _lock:
+        entry = _stats.get(name)
+        if entry is None:
+            entry = _stats[name] = [0, 0.0, 0.0, 0]
+        entry[0] += 1
+        entry[1] += seconds
+        entry[2] = max(entry[2], seconds)
+        entry[3] += nbytes
+
+
+class _Stage:
+    __slots__ = ('name', 'nbytes', 'start')
+
+    def __init__(self, name, nbytes):
+        self.name = name
+        self.nbytes = nbytes
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        record(self.name, time.perf_counter() - self.start, self.nbytes)
+
+
+def stage(name, nbytes=0):
+    """
+    Context manager timing a block as a stage, a shared no-op when
+    profiling is disabled. Bytes can be set on the returned object inside
+    the block once they are known.
+    """
+    if not _enabled:
+        return _NULL_STAGE
+    return _Stage(name, nbytes)
+
+
+def profiled(name=None, count_bytes=False):
+    """
+    Decorator timing every call of a function as a stage. When disabled
+    the only cost is a flag check.
+
+    Inputs:
+        name (str): stage name, defaults to module.function
+        count_bytes (bool): add nbytes of the returned array
+    """
+    def decorator(func):
+        stage_name = name or f'{func.__module__.rsplit(".", 1)[-1]}.{func.__name__}'
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            result = func(*args, **kwargs)
+            record(stage_name, time.perf_counter() - start,
+                   getattr(result, 'nbytes', 0) if count_bytes else 0)
+            return result
+        return wrapper
+    return decorator
+
+
+def stats():
+    """
+    Stats of this process
+
+    Return:
+        stats (dict): stage -> {'calls', 'seconds', 'max_seconds', 'bytes'}
+    """
+    with _lock:
+        return {name: {'calls': calls, 'seconds': seconds,
+                       'max_seconds': max_seconds, 'bytes': nbytes}
+                for name, (calls, seconds, max_seconds, nbytes) in _stats.items()}
+
+
+def clear():
+    with _lock:
+        _stats.clear()
+
+
+def merge_stats(all_stats):
+    """Sum stats of several processes, see stats"""
+    merged = {}
+    for process_stats in all_stats:
+        for name, entry in process_stats.items():
+            total = merged.setdefault(name, {'calls': 0, 'seconds': 0.0,
+                                             'max_seconds': 0.0, 'bytes': 0})
+            total['calls'] += entry['calls']
+            total['seconds'] += entry['seconds']
+            total['max_seconds'] = max(total['max_seconds'], entry['max_seconds'])
+            total['bytes'] += entry['bytes']
+    return merged
+
+
+def dump(dump_dir=None):
+    """
+    Write stats of this process to dump_dir/profile-<pid>.json, replacing
+    the previous dump of the process, so it can be called periodically
+
+    Return:
+        path (str): file written, None if there is no directory or no stats
+    """
+    dump_dir = dump_dir if dump_dir is not None else _dump_dir
+    process_stats = stats()
+    if dump_dir is None or not process_stats:
+        return None
+    path = os.path.join(str(dump_dir), f'profile-{os.getpid()}.json')
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as outfile:
+        json.dump({'pid': os.getpid(), 'stages': process_stats}, outfile)
+    os.replace(tmp_path, path)
+    return path
+
+
+def collect(dump_dir, include_self=True):
+    """
+    Stats of every process which dumped into dump_dir, e.g. DataLoader
+    workers, merged with those of this process
+
+    Inputs:
+        dump_dir (str): directory given to profiling or enable
+        include_self (bool): add current stats of this process
+    Return:
+        stats (dict): merged stats, see stats
+    """
+    all_stats = []
+    for path in sorted(glob.glob(os.path.join(str(dump_dir), 'profile-*.json'))):
+        with open(path, 'r') as infile:
+            dumped = json.load(infile)
+        # a dump of this process may be older than its current stats
+        if not (include_self and dumped['pid'] == os.getpid()):
+            all_stats.append(dumped['stages'])
+    if include_self:
+        all_stats.append(stats())
+    return merge_stats(all_stats)
+
+
+def report(all_stats=None, json_path=None, verbose=True):
+    """
+    Per stage table sorted by total time. Stages nest, e.g. a dataset
+    sample includes parsing its files, so times of nested stages are
+    included in their parents.
+
+    Inputs:
+        all_stats (dict): stats to report, defaults to this process
+        json_path (str): if given, rows are written there as JSON
+        verbose (bool): print the table
+    Return:
+        rows (list): one dict per stage with totals, means and throughput
+    """
+    all_stats = stats() if all_stats is None else all_stats
+    rows = []
+    for name, entry in sorted(all_stats.items(), key=lambda item: -item[1]['seconds']):
+        calls, seconds = entry['calls'], entry['seconds']
+        rows.append({'stage': name, 'calls': calls, 'seconds': seconds,
+                     'mean_ms': seconds / calls * 1e3 if calls else 0.0,
+                     'max_ms': entry['max_seconds'] * 1e3,
+                     'mbytes': entry['bytes'] / 1e6,
+                     'mb_per_s': entry['bytes'] / 1e6 / seconds if seconds else 0.0})
+    if json_path is not None:
+        with open(json_path, 'w') as outfile:
+            json.dump(rows, outfile, indent=1)
+    if verbose:
+        print(f"{'stage':<44}{'calls':>9}{'total s':>10}{'mean ms':>10}"
+              f"{'max ms':>10}{'MB':>10}{'MB/s':>10}")
+        for row in rows:
+            print(f"{row['stage']:<44}{row['calls']:>9}{row['seconds']:>10.3f}"
+                  f"{row['mean_ms']:>10.3f}{row['max_ms']:>10.3f}"
+                  f"{row['mbytes']:>10.1f}{row['mb_per_s']:>10.1f}")
+    return rows
+
+
+def _dump_at_exit():
+    if _enabled and _dump_dir is not None:
+        dump()
+
+
+def _register_dump():
+    # multiprocessing runs these finalizers when a worker process ends,
+    # atexit handlers aren't run there
+    util.Finalize(None, _dump_at_exit, exitpriority=10)
+
+
+def _after_fork(_):
+    # forked workers start with an empty finalizer registry and must not
+    # report stats of their parent again
+    global _lock
+    _lock = threading.Lock()
+    _stats.clear()
+    _register_dump()
+
+
+def test_profiling():
+    """unit test for stage recording, dumps and merged stats"""
+    import tempfile
+
+    @profiled('test.sum', count_bytes=True)
+    def total(values):
+        return memoryview(bytes(values))
+
+    clear()
+    disable()
+    total([1, 2])
+    with stage('test.block'):
+        pass
+    # nothing is recorded while disabled
+    assert stats() == {}
+
+    with tempfile.TemporaryDirectory() as dump_dir:
+        with profiling(dump_dir):
+            total([1, 2, 3])
+            total([1])
+            with stage('test.block') as block:
+                block.nbytes = 5
+        assert not enabled()
+        process_stats = stats()
+        assert process_stats['test.sum']['calls'] == 2
+        assert process_stats['test.sum']['bytes'] == 4
+        assert process_stats['test.block']['bytes'] == 5
+        assert dump(dump_dir) == os.path.join(dump_dir, f'profile-{os.getpid()}.json')
+
+        # dumps of other processes are added, that of this process replaced
+        with open(os.path.join(dump_dir, 'profile-0.json'), 'w') as outfile:
+            json.dump({'pid': 0, 'stages': {'test.sum': {'calls': 1, 'seconds': 10.0,
+                                                         'max_seconds': 10.0, 'bytes': 1}}},
+                      outfile)
+        merged = collect(dump_dir)
+        assert merged['test.sum']['calls'] == 3 and merged['test.sum']['bytes'] == 5
+        assert merged['test.sum']['max_seconds'] == 10.0
+        assert merged['test.block'] == process_stats['test.block']
+        assert [row['stage'] for row in report(merged, verbose=False)][0] == 'test.sum'
+    clear()
+    print("Test passed")
+
+
+_register_dump()
+util.register_after_fork(_after_fork, _after_fork)
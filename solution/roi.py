@@ -0,0 +1,166 @@
+import numpy as np
+from .masks import PackedMask
+
+# bounding boxes are (r0, r1, c0, c1), half open so array[r0:r1, c0:c1]
+# is the box
+
+
+def polygon_bbox(polygon, shape, margin=0):
+    """
+    Bounding box of every pixel poly_to_mask can set for a polygon,
+    computed from its coordinates without rasterizing
+
+    Inputs:
+        polygon (np.array): (N, 2) x, y coordinates in pixels
+        shape (tuple): (H, W) of the image
+        margin (int): pixels added on every side
+    Return:
+        bbox (tuple): (r0, r1, c0, c1) clipped to the image, None for an
+            empty polygon or one outside the image
+    """
+    polygon = np.asarray(polygon, dtype=np.float64).reshape(-1, 2)
+    if not len(polygon):
+        return None
+    (x_min, y_min), (x_max, y_max) = polygon.min(axis=0), polygon.max(axis=0)
+    return clip_bbox((int(np.floor(y_min)) - margin, int(np.ceil(y_max)) + 1 + margin,
+                      int(np.floor(x_min)) - margin, int(np.ceil(x_max)) + 1 + margin), shape)
+
+
+def mask_bbox(mask, margin=0):
+    """
+    Bounding box of foreground pixels of a (H, W) mask or PackedMask
+
+    Inputs:
+        mask (np.array, PackedMask): (H, W) mask
+        margin (int): pixels added on every side
+    Return:
+        bbox (tuple): (r0, r1, c0, c1) clipped to the mask, None if empty
+    """
+    if isinstance(mask, PackedMask):
+        bbox = mask.bbox()
+    else:
+        rows = np.flatnonzero(mask.any(axis=1))
+        if not len(rows):
+            return None
+        cols = np.flatnonzero(mask[rows[0]:rows[-1] + 1].any(axis=0))
+        bbox = rows[0], rows[-1] + 1, cols[0], cols[-1] + 1
+    if bbox is None:
+        return None
+    r0, r1, c0, c1 = bbox
+    return clip_bbox((r0 - margin, r1 + margin, c0 - margin, c1 + margin), mask.shape)
+
+
+def clip_bbox(bbox, shape):
+    """Clip a bbox to an image, None if nothing is left"""
+    h, w = shape
+    r0, r1, c0, c1 = bbox
+    r0, r1, c0, c1 = max(r0, 0), min(r1, h), max(c0, 0), min(c1, w)
+    if r0 >= r1 or c0 >= c1:
+        return None
+    return int(r0), int(r1), int(c0), int(c1)
+
+
+def bbox_contains(outer, inner):
+    """True if bbox inner lies inside bbox outer"""
+    return (outer[0] <= inner[0] and inner[1] <= outer[1] and
+            outer[2] <= inner[2] and inner[3] <= outer[3])
+
+
+def centered_box(bbox, size, shape):
+    """
+    Fixed size box centered on a bbox, shifted to stay inside the image
+    when it fits. Boxes larger than the image stick out evenly and are
+    zero padded by crop_array.
+
+    Inputs:
+        bbox (tuple): (r0, r1, c0, c1) to center on, None centers on the image
+        size (tuple): (h, w) of the box
+        shape (tuple): (H, W) of the image
+    Return:
+        box (tuple): (r0, r1, c0, c1), may reach outside the image
+    """
+    if bbox is None:
+        bbox = (0, shape[0], 0, shape[1])
+    starts = []
+    for lo, hi, length, full in ((bbox[0], bbox[1], size[0], shape[0]),
+                                 (bbox[2], bbox[3], size[1], shape[1])):
+        start = (lo + hi - length) // 2
+        if length <= full:
+            start = min(max(start, 0), full - length)
+        else:
+            start = (full - length) // 2
+        starts.append(start)
+    return starts[0], starts[0] + size[0], starts[1], starts[1] + size[1]
+
+
+def crop_array(array, box, out=None):
+    """
+    Copy box of a (H, W) array, parts of the box outside the array are 0
+
+    Inputs:
+        array (np.array): (H, W) array
+        box (tuple): (r0, r1, c0, c1), may reach outside the array
+        out (np.array): optional (r1 - r0, c1 - c0) array to write into
+    Return:
+        crop (np.array): out or a new array of array dtype
+    """
+    r0, r1, c0, c1 = box
+    if out is None:
+        out = np.empty((r1 - r0, c1 - c0), dtype=array.dtype)
+    h, w = array.shape
+    inner = clip_bbox(box, (h, w))
+    if inner != box:
+        out[...] = 0
+    if inner is not None:
+        i0, i1, j0, j1 = inner
+        np.copyto(out[i0 - r0:i1 - r0, j0 - c0:j1 - c0], array[i0:i1, j0:j1], casting='unsafe')
+    return out
+
+
+def paste_array(crop, box, shape, dtype=None):
+    """Zero (H, W) array with crop pasted at box inside the image"""
+    out = np.zeros(shape, dtype=crop.dtype if dtype is None else dtype)
+    r0, r1, c0, c1 = box
+    out[r0:r1, c0:c1] = crop
+    return out
+
+
+def test_roi():
+    """unit test for bounding boxes, crops and pastes"""
+    from .parsing import poly_to_mask
+
+    mask = np.zeros((10, 12), dtype=np.uint8)
+    mask[2:5, 3:9] = 1
+    assert mask_bbox(mask) == (2, 5, 3, 9)
+    assert mask_bbox(PackedMask.from_dense(mask), margin=3) == (0, 8, 0, 12)
+    assert mask_bbox(np.zeros((3, 3))) is None
+
+    # the polygon bbox holds every rasterized pixel
+    rng = np.random.RandomState(0)
+    for _ in range(20):
+        polygon = rng.rand(6, 2) * 40 - 5
+        rasterized = poly_to_mask(polygon, 30, 30)
+        bbox = polygon_bbox(polygon, (30, 30))
+        if rasterized.any():
+            assert bbox_contains(bbox, mask_bbox(rasterized))
+
+    assert clip_bbox((-2, 5, 8, 20), (10, 12)) == (0, 5, 8, 12)
+    assert clip_bbox((10, 12, 0, 4), (10, 12)) is None
+    assert bbox_contains((0, 10, 0, 10), (2, 5, 0, 10))
+    assert not bbox_contains((0, 10, 0, 10), (2, 11, 0, 10))
+
+    # boxes stay inside the image when they fit, else stick out evenly
+    assert centered_box((2, 5, 3, 9), (4, 4), (10, 12)) == (1, 5, 4, 8)
+    assert centered_box((0, 2, 0, 2), (4, 4), (10, 12)) == (0, 4, 0, 4)
+    assert centered_box(None, (14, 12), (10, 12)) == (-2, 12, 0, 12)
+
+    array = np.arange(120).reshape(10, 12)
+    crop = crop_array(array, (-2, 12, 3, 9))
+    assert np.array_equal(crop[2:12], array[:, 3:9])
+    assert not crop[:2].any() and not crop[12:].any()
+    out = np.empty((3, 6), dtype=np.float32)
+    assert crop_array(array, (2, 5, 3, 9), out=out) is out
+    assert np.array_equal(out, array[2:5, 3:9])
+    assert np.array_equal(paste_array(crop_array(mask, (2, 5, 3, 9)), (2, 5, 3, 9),
+                                      mask.shape), mask)
+    print("Test passed")
@@ -0,0 +1,232 @@
+import itertools
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import numpy as np
+from .heuristics import (extract_all_mask_slices, extract_patient_arrays, get_kernel,
+                         otsu_thresholds, threshold_roi_batch)
+from .metrics import dice_score
+
+
+def search_state(patient, pad, thresholds=("auto",)):
+    """
+    Per patient state shared by every grid combination: image and mask
+    stacks of slices having both contours, cropped to the region around
+    the contours, and the auto (Otsu) threshold of every slice.
+
+    Inputs:
+        patient (Patient): patient object
+        pad (int): margin around the contours, must cover the morphology
+            so cropped proposals equal uncropped ones
+        thresholds (list): thresholds which will be evaluated
+    Return:
+        state (dict): 'dicom_id', 'slice_nos', 'dicom_arrays',
+            'o_contour_arrays', 'i_contour_arrays', 'auto_thresholds'
+    """
+    slice_nos = sorted(extract_all_mask_slices(patient))
+    arrays = [extract_patient_arrays(patient, slice_no) for slice_no in slice_nos]
+
+    # slices of a patient may be raw or rescaled and Otsu bins integer and
+    # float images differently, so thresholds are computed per source dtype
+    auto_thresholds = np.empty(len(slice_nos))
+    dtypes = [dicom_array.dtype for dicom_array, _, _ in arrays]
+    for dtype in set(dtypes):
+        idx = [k for k, d in enumerate(dtypes) if d == dtype]
+        auto_thresholds[idx] = otsu_thresholds(np.stack([arrays[k][0] for k in idx]),
+                                               np.stack([arrays[k][2] for k in idx]))
+
+    dicom_arrays = o_contour_arrays = i_contour_arrays = None
+    if slice_nos:
+        dicom_arrays = np.stack([dicom_array for dicom_array, _, _ in arrays])
+        i_contour_arrays = np.stack([i_contour for _, i_contour, _ in arrays])
+        o_contour_arrays = np.stack([o_contour for _, _, o_contour in arrays])
+
+        # a negative threshold marks every pixel outside the o-contour,
+        # cropping would drop part of those proposals
+        used = [auto_thresholds if isinstance(t, str) and t == "auto" else [t]
+                for t in thresholds]
+        can_crop = all(np.all(np.asarray(t)[~np.isnan(t)] >= 0) for t in used)
+
+        # crop every slice to the padded bounding box of all contours
+        support = (o_contour_arrays | i_contour_arrays).any(axis=0)
+        if can_crop and support.any():
+            rows, cols = np.nonzero(support)
+            h, w = support.shape
+            r0, r1 = max(rows.min() - pad, 0), min(rows.max() + pad + 1, h)
+            c0, c1 = max(cols.min() - pad, 0), min(cols.max() + pad + 1, w)
+            crop = (slice(None), slice(r0, r1), slice(c0, c1))
+            dicom_arrays = np.ascontiguousarray(dicom_arrays[crop])
+            o_contour_arrays = np.ascontiguousarray(o_contour_arrays[crop])
+            i_contour_arrays = np.ascontiguousarray(i_contour_arrays[crop])
+
+    return {'dicom_id': patient.dicom_id,
+            'slice_nos': slice_nos,
+            'dicom_arrays': dicom_arrays,
+            'o_contour_arrays': o_contour_arrays,
+            'i_contour_arrays': i_contour_arrays,
+            'auto_thresholds': auto_thresholds}
+
+
+def _evaluate(args):
+    """
+    Dice scores of every (closing, opening) combination for one threshold.
+    Each closing is computed once and shared by all openings.
+
+    Inputs:
+        args (tuple): (state, threshold, closings, openings)
+    Return:
+        rows (list): dicts with dicom_id, parameters and per slice scores
+    """
+    import cv2
+
+    state, threshold, closings, openings = args
+    thresholds = state['auto_thresholds'] if threshold == "auto" else threshold
+    proposals = threshold_roi_batch(state['dicom_arrays'], state['o_contour_arrays'],
+                                    thresholds)
+    targets = state['i_contour_arrays']
+
+    rows = []
+    closed = np.empty_like(proposals)
+    opened = np.empty_like(proposals)
+    for close_type, close_sz in closings:
+        kernel = get_kernel(close_type, close_sz)
+        for proposal, out in zip(proposals, closed):
+            cv2.morphologyEx(proposal, cv2.MORPH_CLOSE, kernel, dst=out)
+
+        for open_type, open_sz in openings:
+            kernel = get_kernel(open_type, open_sz)
+            for proposal, out in zip(closed, opened):
+                cv2.morphologyEx(proposal, cv2.MORPH_OPEN, kernel, dst=out)
+            scores = dice_score(opened, targets)
+            rows.append({'dicom_id': state['dicom_id'],
+                         'threshold': threshold,
+                         'kernel_type': [close_type, open_type],
+                         'kernel_sz': [close_sz, open_sz],
+                         'scores': scores})
+    return rows
+
+
+def _params_key(row):
+    return (row['threshold'], tuple(row['kernel_type']), tuple(row['kernel_sz']))
+
+
+def grid_search(patients, thresholds=("auto",), kernel_types=(0, 1, 2),
+                kernel_sizes=(3, 5, 7), workers=None, backend='process'):
+    """
+    Evaluate i_contour_from_o_contour over a full parameter grid against
+    i_contour_array ground truth. Closing and opening kernels are searched
+    independently, results can be passed straight to i_contour_from_o_contour
+    as threshold, kernel_type=[closing, opening], kernel_sz=[closing, opening].
+    ROI crops and Otsu thresholds are computed once per patient and
+    (patient, threshold) pairs are evaluated in parallel.
+
+    Inputs:
+        patients (list): list of Patient objects
+        thresholds (list): fixed thresholds and/or "auto"
+        kernel_types (list): kernel types to try, see KERNEL_TYPE
+        kernel_sizes (list): kernel sizes to try
+        workers (int): number of workers, defaults to number of cpus,
+            1 evaluates serially in this process
+        backend (str): either 'process' or 'thread'
+    Return:
+        results (list): one dict per combination ranked by mean slice dice,
+            with keys 'threshold', 'kernel_type', 'kernel_sz', 'mean_dice',
+            'patient_mean_dice', 'n_slices'
+        best_settings (dict): dicom_id -> best combination of the patient
+            with keys 'threshold', 'kernel_type', 'kernel_sz', 'mean_dice',
+            'n_slices'
+    """
+    if backend not in ('process', 'thread'):
+        raise ValueError("backend must be either 'process' or 'thread'")
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    kernels = list(itertools.product(kernel_types, kernel_sizes))
+    # closing then opening can grow a proposal by both kernel radii,
+    # crops keep twice that margin so borders never change the result
+    pad = 2 * max(kernel_sizes) + 1
+    states = [search_state(patient, pad, thresholds) for patient in patients]
+    tasks = [(state, threshold, kernels, kernels)
+             for state in states if len(state['slice_nos'])
+             for threshold in thresholds]
+
+    if workers == 1:
+        task_rows = list(map(_evaluate, tasks))
+    else:
+        executor_cls = ProcessPoolExecutor if backend == 'process' else ThreadPoolExecutor
+        with executor_cls(max_workers=workers) as executor:
+            task_rows = list(executor.map(_evaluate, tasks))
+
+    # group per patient scores of each combination
+    combos = {}
+    for rows in task_rows:
+        for row in rows:
+            combos.setdefault(_params_key(row), []).append(row)
+
+    results, best_settings = [], {}
+    for rows in combos.values():
+        scores = np.concatenate([row['scores'] for row in rows])
+        results.append({'threshold': rows[0]['threshold'],
+                        'kernel_type': rows[0]['kernel_type'],
+                        'kernel_sz': rows[0]['kernel_sz'],
+                        'mean_dice': float(scores.mean()),
+                        'patient_mean_dice': float(np.mean([row['scores'].mean()
+                                                            for row in rows])),
+                        'n_slices': len(scores)})
+        for row in rows:
+            mean_dice = float(row['scores'].mean())
+            best = best_settings.get(row['dicom_id'])
+            if best is None or mean_dice > best['mean_dice']:
+                best_settings[row['dicom_id']] = {'threshold': row['threshold'],
+                                                  'kernel_type': row['kernel_type'],
+                                                  'kernel_sz': row['kernel_sz'],
+                                                  'mean_dice': mean_dice,
+                                                  'n_slices': len(row['scores'])}
+
+    results.sort(key=lambda row: row['mean_dice'], reverse=True)
+    return results, best_settings
+
+
+def test_grid_search():
+    """unit test for grid_search, scores equal i_contour_from_o_contour on whole slices"""
+    import tempfile
+    from .benchmarks import write_synthetic_cohort
+    from .heuristics import i_contour_from_o_contour
+
+    def slice_scores(patient, params):
+        scores = []
+        for slice_no in sorted(extract_all_mask_slices(patient)):
+            dicom_array, i_contour_array, o_contour_array = \
+                extract_patient_arrays(patient, slice_no)
+            proposal = i_contour_from_o_contour(dicom_array, o_contour_array,
+                                                params['threshold'], params['kernel_type'],
+                                                params['kernel_sz'], crop=False)
+            scores.append(dice_score(proposal, i_contour_array))
+        return scores
+
+    with tempfile.TemporaryDirectory() as root:
+        patients = write_synthetic_cohort(root, n_patients=2, n_slices=4, size=64)
+        for patient in patients:
+            patient.create_numpy_arrays(False)
+        thresholds = ("auto", 450)
+        results, best_settings = grid_search(patients, thresholds, kernel_types=(0, 2),
+                                             kernel_sizes=(3, 5), workers=1)
+        assert len(results) == len(thresholds) * 4 * 4
+        assert [row['mean_dice'] for row in results] == \
+            sorted((row['mean_dice'] for row in results), reverse=True)
+
+        for row in results[:2] + results[-2:]:
+            patient_scores = [slice_scores(patient, row) for patient in patients]
+            assert row['n_slices'] == sum(len(scores) for scores in patient_scores)
+            assert np.isclose(row['mean_dice'], np.mean(np.concatenate(patient_scores)))
+            assert np.isclose(row['patient_mean_dice'],
+                              np.mean([np.mean(scores) for scores in patient_scores]))
+
+        for patient in patients:
+            best = best_settings[patient.dicom_id]
+            assert np.isclose(best['mean_dice'], np.mean(slice_scores(patient, best)))
+            assert best['mean_dice'] >= np.mean(slice_scores(patient, results[0])) - 1e-12
+
+        # thread workers give the same results
+        assert grid_search(patients, thresholds, kernel_types=(0, 2), kernel_sizes=(3, 5),
+                           workers=2, backend='thread') == (results, best_settings)
+    print("Test passed")
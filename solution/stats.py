@@ -0,0 +1,349 @@
+import numpy as np
+from .heuristics import extract_all_mask_slices, extract_patient_arrays
+
+# blood pool is inside the i-contour, myocardium between i- and o-contours
+REGIONS = ['roi', 'blood_pool', 'myocardium']
+QUANTILES = [0.05, 0.25, 0.5, 0.75, 0.95]
+
+
+class RegionStats:
+    """
+    Mergeable intensity statistics of a region: count, sum, sum of squares,
+    min, max and a histogram of bin_width wide bins starting at multiples
+    of bin_width. Stats of slices can be merged into patient and cohort
+    stats without touching pixels again.
+
+    Inputs:
+        bin_width (float): histogram bin width, 1 gives exact quantiles
+            for integer images
+    """
+    def __init__(self, bin_width=1):
+        self.bin_width = bin_width
+        self.count = 0
+        self.sum = 0.0
+        self.sumsq = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+        # counts[k] is the number of values in bin hist_lo + k
+        self.hist_lo = 0
+        self.counts = np.zeros(0, dtype=np.int64)
+
+    def update(self, values):
+        """Add pixel values, (M,) array"""
+        if len(values) == 0:
+            return self
+        values64 = values.astype(np.float64, copy=False)
+        self.count += len(values)
+        self.sum += float(values64.sum())
+        self.sumsq += float(np.dot(values64, values64))
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+
+        if np.issubdtype(values.dtype, np.integer) and self.bin_width == 1:
+            bins = values.astype(np.int64, copy=False)
+        else:
+            bins = np.floor(values64 / self.bin_width).astype(np.int64)
+        lo = int(bins.min())
+        self._add_counts(lo, np.bincount(bins - lo))
+        return self
+
+    def _add_counts(self, lo, counts):
+        """Add a histogram starting at bin lo, growing ours if needed"""
+        if len(self.counts) == 0:
+            self.hist_lo, self.counts = lo, counts.astype(np.int64)
+            return
+        new_lo = min(self.hist_lo, lo)
+        new_hi = max(self.hist_lo + len(self.counts), lo + len(counts))
+        if new_lo != self.hist_lo or new_hi != self.hist_lo + len(self.counts):
+            grown = np.zeros(new_hi - new_lo, dtype=np.int64)
+            grown[self.hist_lo - new_lo:self.hist_lo - new_lo + len(self.counts)] = self.counts
+            self.hist_lo, self.counts = new_lo, grown
+        self.counts[lo - self.hist_lo:lo - self.hist_lo + len(counts)] += counts
+
+    def merge(self, other):
+        """Add stats of another region with the same bin_width"""
+        if other.bin_width != self.bin_width:
+            raise ValueError('bin_width of merged stats must match')
+        if other.count == 0:
+            return self
+        self.count += other.count
+        self.sum += other.sum
+        self.sumsq += other.sumsq
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self._add_counts(other.hist_lo, other.counts)
+        return self
+
+    def copy(self):
+        return RegionStats(self.bin_width).merge(self)
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else np.nan
+
+    @property
+    def std(self):
+        if not self.count:
+            return np.nan
+        return np.sqrt(max(self.sumsq / self.count - self.mean ** 2, 0.0))
+
+    def bin_edges(self):
+        """Edges of histogram bins, len(counts) + 1"""
+        return (self.hist_lo + np.arange(len(self.counts) + 1)) * self.bin_width
+
+    def quantile(self, q):
+        """
+        Quantiles from the histogram, lower edge of the bin where the
+        cumulative count reaches q * count (inverted cdf)
+
+        Inputs:
+            q (float, list): quantiles between 0 and 1
+        """
+        if not self.count:
+            return np.full(np.shape(q), np.nan)[()]
+        cumsum = np.cumsum(self.counts)
+        k = np.searchsorted(cumsum, np.ceil(np.asarray(q) * self.count).clip(1))
+        return ((self.hist_lo + k) * self.bin_width)[()]
+
+    def summary(self):
+        """Dict of count, mean, std, min, max and QUANTILES"""
+        summary = {'count': self.count, 'mean': self.mean, 'std': self.std,
+                   'min': self.min if self.count else np.nan,
+                   'max': self.max if self.count else np.nan}
+        for q, value in zip(QUANTILES, np.atleast_1d(self.quantile(QUANTILES))):
+            summary[f'q{int(q * 100):02d}'] = float(value)
+        return summary
+
+
+def slice_region_values(dicom_array, i_contour_array, o_contour_array):
+    """
+    Pixel values of every region of a slice, gathered through flat indices
+    so temporaries are only as large as the regions
+
+    Inputs:
+        dicom_array (np.array): (H, W) image
+        i_contour_array (np.array): (H, W) boolean mask for i-contour
+        o_contour_array (np.array): (H, W) boolean mask for o-contour
+    Return:
+        values (dict): region -> (M,) pixel values
+    """
+    pixels = dicom_array.ravel()
+    i_mask = i_contour_array.ravel()
+    o_idx = np.flatnonzero(o_contour_array)
+    i_idx = np.flatnonzero(i_mask)
+    return {'roi': pixels[o_idx],
+            'blood_pool': pixels[i_idx],
+            'myocardium': pixels[o_idx[i_mask[o_idx] == 0]]}
+
+
+class RoiStatsTable:
+    """
+    Streaming ROI intensity statistics of a cohort, RegionStats per slice
+    and region, merged into patient and cohort totals on demand. Tables of
+    separate runs can be merged and saved, so plots can read histograms
+    without parsing DICOMs again.
+
+    Inputs:
+        bin_width (float): histogram bin width of all stats
+    """
+    def __init__(self, bin_width=1):
+        self.bin_width = bin_width
+        # (dicom_id, slice_no) -> {region: RegionStats}
+        self.slices = {}
+
+    def add_slice(self, dicom_id, slice_no, dicom_array, i_contour_array, o_contour_array):
+        """Compute stats of every region of a slice in one pass"""
+        values = slice_region_values(dicom_array, i_contour_array, o_contour_array)
+        self.slices[dicom_id, slice_no] = {region: RegionStats(self.bin_width).update(values[region])
+                                           for region in REGIONS}
+        return self
+
+    def add_patient(self, patient):
+        """Add every slice of a patient having both contours"""
+        for slice_no in sorted(extract_all_mask_slices(patient)):
+            self.add_slice(patient.dicom_id, slice_no,
+                           *extract_patient_arrays(patient, slice_no))
+        return self
+
+    def merge(self, other):
+        """Add slices of another table"""
+        if other.bin_width != self.bin_width:
+            raise ValueError('bin_width of merged tables must match')
+        self.slices.update(other.slices)
+        return self
+
+    def patient_stats(self, dicom_id):
+        """{region: RegionStats} of all slices of a patient"""
+        total = {region: RegionStats(self.bin_width) for region in REGIONS}
+        for (slice_dicom_id, _), slice_stats in self.slices.items():
+            if slice_dicom_id == dicom_id:
+                for region in REGIONS:
+                    total[region].merge(slice_stats[region])
+        return total
+
+    def cohort_stats(self):
+        """{region: RegionStats} of all slices"""
+        total = {region: RegionStats(self.bin_width) for region in REGIONS}
+        for slice_stats in self.slices.values():
+            for region in REGIONS:
+                total[region].merge(slice_stats[region])
+        return total
+
+    def dicom_ids(self):
+        return list(dict.fromkeys(dicom_id for dicom_id, _ in self.slices))
+
+    def rows(self, level='slice'):
+        """
+        Summary table as a list of dicts, e.g. for pd.DataFrame
+
+        Inputs:
+            level (str): 'slice', 'patient' or 'cohort'
+        """
+        if level == 'slice':
+            items = [((dicom_id, slice_no), stats)
+                     for (dicom_id, slice_no), stats in self.slices.items()]
+        elif level == 'patient':
+            items = [((dicom_id, None), self.patient_stats(dicom_id))
+                     for dicom_id in self.dicom_ids()]
+        elif level == 'cohort':
+            items = [((None, None), self.cohort_stats())]
+        else:
+            raise ValueError("level must be one of 'slice', 'patient' or 'cohort'")
+
+        rows = []
+        for (dicom_id, slice_no), stats in items:
+            for region in REGIONS:
+                rows.append({'dicom_id': dicom_id, 'slice_no': slice_no,
+                             'region': region, **stats[region].summary()})
+        return rows
+
+    def save(self, path):
+        """
+        Save every slice stats into one .npz, histograms are concatenated
+        and row k is counts[offsets[k]:offsets[k + 1]]
+        """
+        keys, regions, scalars, hist_los, histograms = [], [], [], [], []
+        for (dicom_id, slice_no), stats in self.slices.items():
+            for region in REGIONS:
+                s = stats[region]
+                keys.append((str(dicom_id), slice_no))
+                regions.append(region)
+                scalars.append((s.count, s.sum, s.sumsq, s.min, s.max))
+                hist_los.append(s.hist_lo)
+                histograms.append(s.counts)
+        offsets = np.zeros(len(histograms) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(h) for h in histograms])
+        np.savez(path,
+                 bin_width=self.bin_width,
+                 dicom_ids=np.array([k[0] for k in keys], dtype=str),
+                 slice_nos=np.array([k[1] for k in keys], dtype=np.int64),
+                 regions=np.array(regions, dtype=str),
+                 scalars=np.array(scalars, dtype=np.float64).reshape(-1, 5),
+                 hist_los=np.array(hist_los, dtype=np.int64),
+                 offsets=offsets,
+                 counts=np.concatenate(histograms) if histograms else np.zeros(0, np.int64))
+
+    @classmethod
+    def load(cls, path):
+        """Load a table written by save"""
+        with np.load(path) as data:
+            table = cls(data['bin_width'].item())
+            scalars, counts, offsets = data['scalars'], data['counts'], data['offsets']
+            for k, (dicom_id, slice_no, region) in enumerate(zip(
+                    data['dicom_ids'].tolist(), data['slice_nos'].tolist(),
+                    data['regions'].tolist())):
+                s = RegionStats(table.bin_width)
+                count, s.sum, s.sumsq, s.min, s.max = scalars[k].tolist()
+                s.count = int(count)
+                s.hist_lo = int(data['hist_los'][k])
+                s.counts = counts[offsets[k]:offsets[k + 1]]
+                table.slices.setdefault((dicom_id, slice_no), {})[region] = s
+        return table
+
+
+def cohort_roi_stats(all_patients, bin_width=1):
+    """
+    ROI statistics of a cohort streamed patient by patient
+
+    Inputs:
+        all_patients (list): list of Patient objects
+        bin_width (float): histogram bin width
+    Return:
+        table (RoiStatsTable): stats of every slice having both contours
+    """
+    table = RoiStatsTable(bin_width)
+    for patient in all_patients:
+        table.add_patient(patient)
+    return table
+
+
+def test_region_stats():
+    """unit test for RegionStats, merged stats equal stats of all values"""
+    rng = np.random.RandomState(0)
+    parts = [rng.randint(-50, 400, size=n).astype(np.int16) for n in (100, 1, 37)]
+    values = np.concatenate(parts)
+
+    merged = RegionStats()
+    for part in parts:
+        merged.merge(RegionStats().update(part))
+    merged.merge(RegionStats().update(np.zeros(0, np.int16)))
+    for stats in (RegionStats().update(values), merged):
+        assert stats.count == len(values)
+        assert stats.min == values.min() and stats.max == values.max()
+        assert np.isclose(stats.mean, values.mean()) and np.isclose(stats.std, values.std())
+        assert stats.counts.sum() == len(values)
+        assert np.array_equal(stats.quantile(QUANTILES),
+                              np.quantile(values, QUANTILES, method='inverted_cdf'))
+
+    # float values fall in bins of bin_width
+    stats = RegionStats(bin_width=0.5).update(values * 0.25)
+    assert np.all(np.abs(stats.quantile(QUANTILES) -
+                         np.quantile(values * 0.25, QUANTILES, method='inverted_cdf')) < 0.5)
+    assert np.isnan(RegionStats().quantile(0.5)) and np.isnan(RegionStats().mean)
+    try:
+        RegionStats().merge(RegionStats(bin_width=2))
+        assert False, 'ValueError expected'
+    except ValueError:
+        pass
+    print("Test passed")
+
+
+def test_roi_stats_table():
+    """unit test for RoiStatsTable, stats of every region and save/load round trip"""
+    import os
+    import tempfile
+    from .benchmarks import write_synthetic_cohort
+
+    with tempfile.TemporaryDirectory() as root:
+        patients = write_synthetic_cohort(root, n_patients=2, n_slices=4, size=32)
+        for patient in patients:
+            patient.create_numpy_arrays(False)
+        table = cohort_roi_stats(patients)
+        assert len(table.slices) == sum(len(extract_all_mask_slices(p)) for p in patients)
+
+        cohort_values = {region: [] for region in REGIONS}
+        for patient in patients:
+            for slice_no in extract_all_mask_slices(patient):
+                dicom_array, i_contour_array, o_contour_array = \
+                    extract_patient_arrays(patient, slice_no)
+                i_mask, o_mask = i_contour_array > 0, o_contour_array > 0
+                for region, mask in (('roi', o_mask), ('blood_pool', i_mask),
+                                     ('myocardium', o_mask & ~i_mask)):
+                    stats = table.slices[patient.dicom_id, slice_no][region]
+                    assert stats.count == mask.sum()
+                    assert np.isclose(stats.sum, dicom_array[mask].sum())
+                    cohort_values[region].append(dicom_array[mask])
+        for region, stats in table.cohort_stats().items():
+            values = np.concatenate(cohort_values[region])
+            assert stats.count == len(values) and stats.max == values.max()
+            assert np.isclose(stats.mean, values.mean())
+
+        path = os.path.join(root, 'roi_stats.npz')
+        table.save(path)
+        loaded = RoiStatsTable.load(path)
+        for level in ('slice', 'patient', 'cohort'):
+            assert loaded.rows(level) == table.rows(level)
+        merged = RoiStatsTable().add_patient(patients[0]).merge(
+            RoiStatsTable().add_patient(patients[1]))
+        assert merged.rows('cohort') == table.rows('cohort')
+    print("Test passed")